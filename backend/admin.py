@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .order import export_to_csv
 from .models import User, Shop, Category, Product, ProductItem, Order, OrderItem, Contact, EmailTokenConfirm, Coupon, \
-    ProductProperty, Profile
+    ProductProperty, Profile, ShopOrder, OutboxMessage
 
 
 def admin_export_to_csv(modeladmin, request, queryset):
@@ -130,6 +130,15 @@ class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
 
+class ShopOrderInline(admin.TabularInline):
+    """
+    Встраиваемая форма для просмотра частей заказа по магазинам в административном интерфейсе Django.
+    """
+    model = ShopOrder
+    extra = 0
+    readonly_fields = ('shop', 'created_at', 'subtotal', 'total')
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     """
@@ -139,9 +148,12 @@ class OrderAdmin(admin.ModelAdmin):
     list_filter = ('state',)
     search_fields = ('user__email', 'user__username')
     date_hierarchy = 'created_at'
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, ShopOrderInline]
     actions = [admin_export_to_csv]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user', 'contact', 'coupon').with_total_price()
+
 
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
@@ -162,3 +174,14 @@ class EmailTokenConfirmAdmin(admin.ModelAdmin):
     list_display = ('user', 'key', 'created_at')
     list_filter = ('user', 'created_at')
     search_fields = ('user__email', 'user__username')
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    """
+    Административный интерфейс для исходящей очереди задач Celery.
+    """
+    list_display = ('id', 'dedup_key', 'created_at', 'attempts', 'available_at', 'sent_at')
+    search_fields = ('dedup_key',)
+    readonly_fields = ('tasks', 'dedup_key', 'created_at', 'sent_at', 'last_error')
+    date_hierarchy = 'created_at'
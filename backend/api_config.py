@@ -70,6 +70,8 @@ class APIResponseSchema:
             True, "Object not found"), description="Not found")},
         409: {status.HTTP_409_CONFLICT: OpenApiResponse(response=get_response_object(
             True, "Object saving error"), description="Conflict")},
+        422: {status.HTTP_422_UNPROCESSABLE_ENTITY: OpenApiResponse(response=get_response_object(
+            True, "Idempotency-Key was used with a different request"), description="Unprocessable entity")},
         429: {status.HTTP_429_TOO_MANY_REQUESTS: OpenApiResponse(response=get_response_object(
             True, "Too many requests"), description="Too many requests")},
         500: {status.HTTP_500_INTERNAL_SERVER_ERROR: OpenApiResponse(response=get_response_object(
@@ -93,6 +95,41 @@ class APIResponseSchema:
 
 class APIConfig:
 
+    @staticmethod
+    def fieldset_parameters():
+        return [
+            OpenApiParameter(name="fields", type=OpenApiTypes.STR, location='query', required=False,
+                             description="Список выводимых полей через запятую, вложенные поля указываются через "
+                                         "точку (например: id,state,ordered_items.quantity)"),
+            OpenApiParameter(name="expand", type=OpenApiTypes.STR, location='query', required=False,
+                             description="Список вложенных объектов, выводимых полностью, остальные выводятся "
+                                         "идентификаторами. По умолчанию все вложенные объекты выводятся полностью"),
+        ]
+
+    @staticmethod
+    def idempotency_parameters():
+        return [
+            OpenApiParameter(name="Idempotency-Key", type=OpenApiTypes.STR, location=OpenApiParameter.HEADER,
+                             required=False,
+                             description="Ключ идемпотентности: повторный запрос с тем же ключом в течение суток "
+                                         "получает ответ на первый запрос без повторного выполнения"),
+        ]
+
+    @staticmethod
+    def order_history_parameters():
+        return APIConfig.fieldset_parameters() + [
+            OpenApiParameter(name="state", type=OpenApiTypes.STR, location='query', required=False,
+                             description="Фильтр по состоянию заказа"),
+            OpenApiParameter(name="created_after", type=OpenApiTypes.DATETIME, location='query', required=False,
+                             description="Заказы, созданные не раньше указанной даты"),
+            OpenApiParameter(name="created_before", type=OpenApiTypes.DATETIME, location='query', required=False,
+                             description="Заказы, созданные не позже указанной даты"),
+            OpenApiParameter(name="cursor", type=OpenApiTypes.STR, location='query', required=False,
+                             description="Курсор следующей страницы (из ссылки next предыдущего ответа)"),
+            OpenApiParameter(name="page_size", type=OpenApiTypes.INT, location='query', required=False,
+                             description="Количество заказов на странице (по умолчанию 30, не более 100)"),
+        ]
+
     @staticmethod
     def get_category_config():
         return {
@@ -122,6 +159,7 @@ class APIConfig:
             "tags": ["Покупатель"],
             "operation_id": "get_buyer_orders",
             "deprecated": False,
+            "parameters": APIConfig.order_history_parameters(),
             "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 429, 500],
                                                              APIResponseSchema.responses, OrderSerializer)
         }
@@ -135,9 +173,9 @@ class APIConfig:
             "tags": ["Покупатель"],
             "operation_id": "confirm_buyer_order",
             "deprecated": False,
-            "parameters": None,
+            "parameters": APIConfig.idempotency_parameters(),
             "request": OrderConfirmSerializer,
-            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 429, 500],
+            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 422, 429, 500],
                                                              APIResponseSchema.responses)
         }
 
@@ -149,6 +187,7 @@ class APIConfig:
             "tags": ["Покупатель"],
             "operation_id": "get_shopping_cart",
             "deprecated": False,
+            "parameters": APIConfig.fieldset_parameters(),
             "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 429, 500],
                                                              APIResponseSchema.responses, OrderSerializer)
         }
@@ -161,8 +200,9 @@ class APIConfig:
             "tags": ["Покупатель"],
             "operation_id": "create_shopping_cart",
             "deprecated": False,
+            "parameters": APIConfig.idempotency_parameters(),
             "request": OrderItemCreateUpdateSerializer(many=True),
-            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 429, 500],
+            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 422, 429, 500],
                                                              APIResponseSchema.responses)
         }
 
@@ -251,6 +291,7 @@ class APIConfig:
             "tags": ["Менеджер"],
             "operation_id": "get_manager_orders",
             "deprecated": False,
+            "parameters": APIConfig.order_history_parameters(),
             "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 429, 500],
                                                              APIResponseSchema.responses, OrderSerializer)
         }
@@ -258,13 +299,16 @@ class APIConfig:
     @staticmethod
     def update_manager_order_config():
         return {
-            "description": "Обновление статуса заказа",
-            "summary": "Обновление статуса заказа",
+            "description": "Обновление статуса одного или нескольких заказов. В теле запроса передается объект "
+                           "{id, state} или список таких объектов. Переходы между состояниями проверяются: "
+                           "CREATED -> CONFIRMED -> ASSEMBLED -> SENT -> DELIVERED, отмена (CANCELED) "
+                           "возможна до отправки заказа",
+            "summary": "Обновление статуса заказов",
             "tags": ["Менеджер"],
             "operation_id": "update_manager_order",
             "deprecated": False,
-            "request": OrderStateSerializer,
-            "responses": APIResponseSchema.get_response_list([200, 401, 403, 404, 409, 429, 500],
+            "request": OrderStateSerializer(many=True),
+            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 429, 500],
                                                              APIResponseSchema.responses)
         }
 
@@ -285,12 +329,29 @@ class APIConfig:
                 OpenApiParameter(name="search", type=OpenApiTypes.STR, location='query', required=False,
                                  description="Поиск по названию товара"),
                 OpenApiParameter(name="ordering", type=OpenApiTypes.STR, location='query', required=False,
-                                 description="Сортировка по id или price (цене)")
+                                 description="Сортировка по id или price (цене)"),
+                *APIConfig.fieldset_parameters(),
             ],
             "responses": APIResponseSchema.get_response_list([200, 400, 404, 429, 500],
                                                              APIResponseSchema.responses, ProductItemSerializer)
         }
 
+    @staticmethod
+    def get_products_batch_config():
+        return {
+            "description": "Получить список товаров по идентификаторам (не более 300)",
+            "summary": "Получить список товаров по идентификаторам",
+            "tags": ["Товары"],
+            "operation_id": "get_products_batch",
+            "deprecated": False,
+            "parameters": [
+                OpenApiParameter(name="ids", type=OpenApiTypes.STR, location='query', required=True,
+                                 description="Идентификаторы товаров через запятую")
+            ],
+            "responses": APIResponseSchema.get_response_list([200, 400, 429, 500],
+                                                             APIResponseSchema.responses, ProductItemSerializer)
+        }
+
     @staticmethod
     def get_popular_products_config():
         return {
@@ -301,12 +362,35 @@ class APIConfig:
             "deprecated": False,
             "parameters": [
                 OpenApiParameter(name="amount", type=int, location='query', required=False,
-                                 description="Количество популярных товаров")
+                                 description="Количество популярных товаров"),
+                OpenApiParameter(name="period", type=str, location='query', required=False,
+                                 enum=["24h", "7d", "all"], default="all",
+                                 description="Период рейтинга: последние 24 часа, 7 дней или все время"),
+                OpenApiParameter(name="category_id", type=int, location='query', required=False,
+                                 description="Идентификатор категории (рейтинг товаров категории)"),
+                OpenApiParameter(name="shop_id", type=int, location='query', required=False,
+                                 description="Идентификатор магазина (рейтинг товаров магазина)")
             ],
             "responses": APIResponseSchema.get_response_list([200, 400, 404, 429, 500],
                                                              APIResponseSchema.responses, ProductSerializer)
         }
 
+    @staticmethod
+    def get_related_products_config():
+        return {
+            "description": "Получить список товаров, которые чаще всего покупают вместе с товаром",
+            "summary": "Получить список товаров, которые покупают вместе с товаром",
+            "tags": ["Товары"],
+            "operation_id": "get_related_products",
+            "deprecated": False,
+            "parameters": [
+                OpenApiParameter(name="amount", type=int, location='query', required=False,
+                                 description="Количество товаров (не более 100)")
+            ],
+            "responses": APIResponseSchema.get_response_list([200, 429, 500],
+                                                             APIResponseSchema.responses, ProductSerializer)
+        }
+
     @staticmethod
     def import_seller_goods_config():
         return {
@@ -328,10 +412,25 @@ class APIConfig:
             "tags": ["Продавец"],
             "operation_id": "get_seller_orders",
             "deprecated": False,
+            "parameters": APIConfig.order_history_parameters(),
             "responses": APIResponseSchema.get_response_list([200, 401, 403, 404, 429, 500],
                                                              APIResponseSchema.responses, OrderSerializer)
         }
 
+    @staticmethod
+    def update_seller_order_config():
+        return {
+            "description": "Изменение состояния части заказа, относящейся к магазину продавца "
+                           "(CONFIRMED, ASSEMBLED, SENT или DELIVERED)",
+            "summary": "Изменение состояния заказа магазина",
+            "tags": ["Продавец"],
+            "operation_id": "update_seller_order",
+            "deprecated": False,
+            "request": OrderStateSerializer,
+            "responses": APIResponseSchema.get_response_list([200, 400, 401, 403, 404, 409, 429, 500],
+                                                             APIResponseSchema.responses)
+        }
+
     @staticmethod
     def create_shop_config():
         return {
@@ -398,6 +497,7 @@ class APIConfig:
             "tags": ["Продавец"],
             "operation_id": "get_seller_products",
             "deprecated": False,
+            "parameters": APIConfig.fieldset_parameters(),
             "responses": APIResponseSchema.get_response_list([200, 400, 403, 404, 429, 500],
                                                              APIResponseSchema.responses, serializer=ProductItemSerializer)
         }
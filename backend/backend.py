@@ -1,27 +1,287 @@
-import redis
-from django.conf import settings
+from collections import defaultdict
+from decimal import Decimal
 from django.db import transaction
 from django.contrib.auth.password_validation import validate_password
 from django.db import IntegrityError
-from django.db.models import Q
+from django.db.models import Case, When, Value, Prefetch, F, JSONField
 from django.http import JsonResponse
 from rest_framework.request import Request
 from rest_framework.response import Response
+from .cache import stampede_cached_as, reference_cached, get_product_items, set_product_items
+from .fieldsets import parse_fieldset, get_fieldset_params, is_requested, prune_data
 from .models import EmailTokenConfirm, Shop, ProductItem, Order, \
-    OrderStateChoices, OrderItem, Contact, Coupon, Product
-from .order import create_order_report, update_ordered_items_quantity, get_mail_attachment
-from .serializers import UserSerializer, ShopSerializer, OrderSerializer, OrderItemSerializer, ContactSerializer, \
+    OrderStateChoices, OrderItem, Contact, Coupon, Product, ProductProperty, ShopOrder
+from .ranking import add_to_ranking, get_top_product_ids, get_scope_key, get_cached_top, set_cached_top, \
+    RANKING_PERIOD_ALL
+from .related import add_to_related, get_related_product_ids
+from .cart import is_redis_cart, get_cart_items, add_cart_items, update_cart_items, delete_cart_items, \
+    clear_cart, materialize_cart
+from .order import update_ordered_items_quantity, freeze_order_prices, can_change_state, get_source_states, \
+    set_orders_state, get_order_state
+from .pagination import paginate_by_cursor, get_paginated_data, ORDERS_PAGE_SIZE
+from .serializers import UserSerializer, ShopSerializer, OrderSerializer, ContactSerializer, \
     ProductItemSerializer, CouponSerializer, OrderItemUpdateSerializer, OrderItemCreateUpdateSerializer, \
     OrderItemDeleteSerializer, OrderStateSerializer, OrderConfirmSerializer, ProductSerializer, \
-    ContactUpdateSerializer, ContactDeleteSerializer, CouponDeleteSerializer, CouponCreateSerializer
+    ContactUpdateSerializer, ContactDeleteSerializer, CouponDeleteSerializer, CouponCreateSerializer, \
+    ProductItemBatchSerializer, OrderHistoryFilterSerializer, ShopOrderSerializer, SellerOrderSerializer
 from rest_framework import status as http_status
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
-from .signals import new_order
+from .signals import new_order, orders_state_changed
 from .tasks import import_goods
 
 
-redis_db = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+SELLER_ORDER_STATES = (OrderStateChoices.CONFIRMED, OrderStateChoices.ASSEMBLED, OrderStateChoices.SENT,
+                       OrderStateChoices.DELIVERED)
+
+
+def update_by_ids(queryset, field: str, values: dict) -> int:
+    """
+    Функция обновляет поле объектов с переданными идентификаторами одним запросом UPDATE ... CASE.
+    Обновляются только объекты, входящие в queryset.
+
+    Параметры:
+        queryset (QuerySet): Запрос объектов, которые разрешено изменять
+        field (str): Имя обновляемого поля
+        values (dict): Словарь id объекта -> новое значение поля
+    Возвращает:
+        int: Количество обновленных объектов
+    """
+    if not values:
+        return 0
+    output_field = queryset.model._meta.get_field(field)
+    return queryset.filter(id__in=values).update(**{field: Case(
+        *[When(id=obj_id, then=Value(value)) for obj_id, value in values.items()], output_field=output_field)})
+
+
+def delete_by_ids(queryset, ids) -> int:
+    """
+    Функция удаляет объекты с переданными идентификаторами, входящие в queryset, одним запросом с id__in
+
+    Параметры:
+        queryset (QuerySet): Запрос объектов, которые разрешено удалять
+        ids: Идентификаторы удаляемых объектов
+    Возвращает:
+        int: Количество удаленных объектов (включая каскадно удаленные)
+    """
+    if not ids:
+        return 0
+    return queryset.filter(id__in=ids).delete()[0]
+
+
+def get_serialized_product_items(item_ids: list[int]) -> dict:
+    """
+    Функция возвращает сериализованные товары магазинов по идентификаторам.
+    Товары берутся из кэша, а отсутствующие в кэше загружаются из БД одним запросом и кэшируются.
+
+    Параметры:
+        item_ids (list[int]): Идентификаторы товаров
+    Возвращает:
+        dict: Словарь id товара -> сериализованный товар (только существующие товары)
+    """
+    items = get_product_items(item_ids)
+    missing_ids = [item_id for item_id in item_ids if item_id not in items]
+    if missing_ids:
+        products = with_product_item_relations(ProductItem.objects.filter(id__in=missing_ids).nocache())
+        loaded_items = ProductItemSerializer(products, many=True).data
+        set_product_items(loaded_items)
+        items.update({item['id']: item for item in loaded_items})
+    return items
+
+
+def with_order_relations(orders, fields: dict | None = None, expand: dict | None = None, ordered_items=None):
+    """
+    Функция добавляет к запросу заказов только те select_related/prefetch_related,
+    которые нужны для вывода запрошенных полей (см. параметры fields и expand).
+
+    Параметры:
+        orders (QuerySet): Запрос заказов
+        fields (dict | None): Дерево запрошенных полей
+        expand (dict | None): Дерево раскрываемых вложенных полей
+        ordered_items (QuerySet | None): Запрос позиций заказов, если выводятся не все позиции
+    Возвращает:
+        QuerySet: Запрос заказов с необходимыми связями
+    """
+    if is_requested('contact', fields, expand, expanded=True):
+        orders = orders.select_related('contact')
+    if is_requested('total_price', fields, expand):
+        orders = orders.with_total_price()
+    if not is_requested('ordered_items', fields, expand):
+        return orders
+    if ordered_items is not None:
+        orders = orders.prefetch_related(Prefetch('ordered_items', queryset=ordered_items))
+    if is_requested('ordered_items.product_item.product', fields, expand, expanded=True):
+        orders = orders.prefetch_related('ordered_items__product_item__product__category')
+    elif is_requested('ordered_items.product_item', fields, expand, expanded=True):
+        orders = orders.prefetch_related('ordered_items__product_item')
+    else:
+        orders = orders.prefetch_related('ordered_items')
+    if is_requested('ordered_items.product_item.product_properties', fields, expand, expanded=True):
+        orders = orders.prefetch_related('ordered_items__product_item__product_properties__property')
+    elif is_requested('ordered_items.product_item.product_properties', fields, expand):
+        orders = orders.prefetch_related('ordered_items__product_item__product_properties')
+    return orders
+
+
+def serialize_orders(order_ids: list[int]) -> dict:
+    """
+    Функция сериализует заказы со всеми вложенными объектами
+
+    Параметры:
+        order_ids (list[int]): Идентификаторы заказов
+    Возвращает:
+        dict: Словарь id заказа -> сериализованный заказ
+    """
+    orders = with_order_relations(Order.objects.filter(id__in=order_ids).nocache())
+    return {order['id']: order for order in OrderSerializer(orders, many=True).data}
+
+
+def _load_snapshots(orders: list[Order]) -> list[dict]:
+    """
+    Функция возвращает снимки заказов. Заказы без снимка (оформленные до появления снимков) сериализуются заново,
+    и их снимки сохраняются одним запросом UPDATE ... CASE, чтобы следующие запросы читали их из снимков.
+    Снимок сохраняется, только если состояние заказа не изменилось с момента сериализации.
+    """
+    missing = [order.id for order in orders if order.snapshot is None]
+    serialized = serialize_orders(missing) if missing else {}
+    if serialized:
+        Order.objects.filter(id__in=serialized, snapshot__isnull=True).exclude(
+            state=OrderStateChoices.PREPARING).update(snapshot=Case(
+                *[When(id=order_id, state=snapshot['state'], then=Value(snapshot, output_field=JSONField()))
+                  for order_id, snapshot in serialized.items()],
+                default=F('snapshot'), output_field=JSONField()))
+    return [order.snapshot if order.snapshot is not None else serialized[order.id] for order in orders]
+
+
+def get_orders_snapshots(orders: list[Order], fields: dict | None = None) -> list:
+    """
+    Функция возвращает сериализованные заказы из их снимков
+
+    Параметры:
+        orders (list[Order]): Заказы с загруженным полем snapshot
+        fields (dict | None): Дерево запрошенных полей
+    Возвращает:
+        list: Список заказов только с запрошенными полями
+    """
+    return [prune_data(snapshot, fields) for snapshot in _load_snapshots(orders)]
+
+
+def get_shop_orders_snapshots(shop_orders: list[ShopOrder], fields: dict | None = None) -> list:
+    """
+    Функция возвращает сериализованные заказы магазина из снимков заказов.
+    В заказах остаются только позиции магазина, в поле shop_order выводится часть заказа магазина.
+
+    Параметры:
+        shop_orders (list[ShopOrder]): Части заказов с загруженным заказом
+        fields (dict | None): Дерево запрошенных полей
+    Возвращает:
+        list: Список заказов только с запрошенными полями
+    """
+    snapshots = _load_snapshots([shop_order.order for shop_order in shop_orders])
+    return [prune_data({**snapshot, 'ordered_items': [item for item in snapshot['ordered_items']
+                                                      if item['product_item']['shop'] == shop_order.shop_id],
+                        'shop_order': ShopOrderSerializer(shop_order).data}, fields)
+            for shop_order, snapshot in zip(shop_orders, snapshots)]
+
+
+def filter_orders(orders, state: str | None = None, created_after=None, created_before=None):
+    """
+    Функция применяет к запросу заказов (или частей заказов) фильтры истории заказов
+
+    Параметры:
+        orders (QuerySet): Запрос заказов
+        state (str | None): Фильтр по состоянию заказа
+        created_after (datetime | None): Заказы, созданные не раньше указанной даты
+        created_before (datetime | None): Заказы, созданные не позже указанной даты
+    Возвращает:
+        QuerySet: Отфильтрованный запрос
+    """
+    if state is not None:
+        orders = orders.filter(state=state)
+    if created_after is not None:
+        orders = orders.filter(created_at__gte=created_after)
+    if created_before is not None:
+        orders = orders.filter(created_at__lte=created_before)
+    return orders
+
+
+def get_orders_page(orders, fields: dict | None = None, expand: dict | None = None, cursor: str | None = None,
+                    page_size: int = ORDERS_PAGE_SIZE, **filters) -> tuple[list, str | None]:
+    """
+    Функция возвращает страницу истории заказов, отсортированной по убыванию даты создания.
+    Если раскрываемые поля не переданы, заказы выводятся из снимков, сохраненных при оформлении заказа.
+
+    Параметры:
+        orders (QuerySet): Запрос заказов
+        fields (dict | None): Дерево запрошенных полей
+        expand (dict | None): Дерево раскрываемых вложенных полей
+        cursor (str | None): Курсор страницы
+        page_size (int): Количество заказов на странице
+        filters: Фильтры истории заказов (см. filter_orders)
+    Возвращает:
+        tuple[list, str | None]: Сериализованные заказы страницы и курсор следующей страницы
+    """
+    orders = filter_orders(orders, **filters)
+    if expand is None:
+        page, next_cursor = paginate_by_cursor(orders.only('id', 'created_at', 'snapshot'), cursor, page_size)
+        return get_orders_snapshots(page, fields), next_cursor
+    page, next_cursor = paginate_by_cursor(with_order_relations(orders, fields, expand), cursor, page_size)
+    return OrderSerializer(page, many=True, context={'fields': fields, 'expand': expand}).data, next_cursor
+
+
+def get_shop_orders_page(shop_id: int, fields: dict | None = None, expand: dict | None = None,
+                         cursor: str | None = None, page_size: int = ORDERS_PAGE_SIZE,
+                         **filters) -> tuple[list, str | None]:
+    """
+    Функция возвращает страницу заказов магазина. Заказы выбираются по частям заказов магазина (ShopOrder)
+    диапазоном индекса (shop, state, created_at, id), фильтр state применяется к состоянию части заказа.
+    В заказах выводятся только позиции магазина и часть заказа магазина (shop_order).
+    Запросы не кэшируются cacheops: результат кэшируется целиком вызывающим методом (см. stampede_cached_as).
+
+    Параметры:
+        shop_id (int): Идентификатор магазина
+        fields (dict | None): Дерево запрошенных полей
+        expand (dict | None): Дерево раскрываемых вложенных полей
+        cursor (str | None): Курсор страницы
+        page_size (int): Количество заказов на странице
+        filters: Фильтры истории заказов (см. filter_orders)
+    Возвращает:
+        tuple[list, str | None]: Сериализованные заказы страницы и курсор следующей страницы
+    """
+    shop_orders = filter_orders(ShopOrder.objects.filter(shop_id=shop_id).nocache(), **filters)
+    if expand is None:
+        page, next_cursor = paginate_by_cursor(
+            shop_orders.select_related('order').only('id', 'shop_id', 'created_at', 'state', 'subtotal', 'total',
+                                                     'order__id', 'order__snapshot'), cursor, page_size)
+        return get_shop_orders_snapshots(page, fields), next_cursor
+    page, next_cursor = paginate_by_cursor(shop_orders, cursor, page_size)
+    orders = with_order_relations(Order.objects.filter(id__in=[shop_order.order_id for shop_order in page]).nocache(),
+                                  fields, expand, OrderItem.objects.filter(product_item__shop_id=shop_id)).in_bulk()
+    for shop_order in page:
+        orders[shop_order.order_id].shop_order = shop_order
+    return SellerOrderSerializer([orders[shop_order.order_id] for shop_order in page], many=True,
+                                 context={'fields': fields, 'expand': expand}).data, next_cursor
+
+
+def with_product_item_relations(products, fields: dict | None = None, expand: dict | None = None):
+    """
+    Функция добавляет к запросу товаров только те select_related/prefetch_related,
+    которые нужны для вывода запрошенных полей (см. параметры fields и expand).
+
+    Параметры:
+        products (QuerySet): Запрос товаров
+        fields (dict | None): Дерево запрошенных полей
+        expand (dict | None): Дерево раскрываемых вложенных полей
+    Возвращает:
+        QuerySet: Запрос товаров с необходимыми связями
+    """
+    if is_requested('product', fields, expand, expanded=True):
+        products = products.select_related('product__category')
+    if is_requested('product_properties', fields, expand, expanded=True):
+        products = products.prefetch_related('product_properties__property')
+    elif is_requested('product_properties', fields, expand):
+        products = products.prefetch_related('product_properties')
+    return products
 
 
 class UserBackend:
@@ -238,24 +498,95 @@ class SellerBackend:
     @staticmethod
     def get_orders(request):
         """
-        Метод возвращает список заказов, связанных с магазином текущего пользователя
+        Метод возвращает страницу списка заказов, связанных с магазином текущего пользователя
 
         Параметры:
-            request (Request): Объект запроса.
+            request (Request): Объект запроса. GET-параметры: state, created_after, created_before - фильтры,
+                cursor, page_size - пагинация, fields, expand - выводимые поля.
         Возвращает:
-            Response: Объект ответа, содержащий список заказов с информацией о них:
-                id, ordered_items, created_at, state, contact, total_price
-        """
-        orders = Order.objects.filter(
-            ordered_items__product_item__shop__user_id=request.user.id).exclude(
-            state=OrderStateChoices.PREPARING).prefetch_related(
-            'ordered_items__product_item__product__category',
-            'ordered_items__product_item__product_properties__property').select_related(
-            'contact').distinct().cache(ops=['all'], timeout=60 * 15)
-        if orders is None:
-            return JsonResponse({'success': False, 'error': 'No orders found'}, status=http_status.HTTP_404_NOT_FOUND)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+            Response: Объект ответа, содержащий ссылку на следующую страницу (next) и список заказов (results)
+                с информацией о них: id, ordered_items, created_at, state, contact, total_price.
+                В ordered_items выводятся только позиции магазина продавца.
+                - Если параметры фильтрации или курсор невалидны, возвращает ошибку со статусом HTTP 400.
+        """
+        serializer = OrderHistoryFilterSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        results, next_cursor = SellerBackend.get_orders_data(
+            request.user.id, request.query_params.get('fields'), request.query_params.get('expand'),
+            **serializer.validated_data)
+        return Response(get_paginated_data(request, results, next_cursor))
+
+    @staticmethod
+    @stampede_cached_as(Order, OrderItem, ShopOrder, ProductItem, ProductProperty, Contact, timeout=60 * 15)
+    def get_orders_data(user_id: int, fields: str | None = None, expand: str | None = None,
+                        **filters) -> tuple[list, str | None]:
+        """
+        Метод возвращает страницу сериализованного списка заказов, связанных с магазином продавца.
+        Заказы выбираются по частям заказов магазина, в заказах выводятся только позиции магазина.
+        Результат кэшируется отдельно для каждой страницы с защитой от одновременного пересчета (cache stampede).
+
+        Параметры:
+            user_id (int): Идентификатор продавца.
+            fields (str | None): Запрошенные поля (GET-параметр fields).
+            expand (str | None): Раскрываемые вложенные поля (GET-параметр expand).
+            filters: Фильтры и параметры пагинации (см. get_orders_page)
+        Возвращает:
+            tuple[list, str | None]: Список заказов страницы и курсор следующей страницы
+        """
+        shop_id = Shop.objects.filter(user_id=user_id).values_list('id', flat=True).first()
+        if shop_id is None:
+            return [], None
+        return get_shop_orders_page(shop_id, parse_fieldset(fields), parse_fieldset(expand), **filters)
+
+    @staticmethod
+    def change_order_state(request, sender):
+        """
+        Метод изменяет состояние части заказа, относящейся к магазину текущего пользователя.
+        Заказ блокируется до изменения части заказа. Если после изменения наименее продвинутое состояние частей
+        заказа (см. get_order_state) отличается от состояния заказа, оно устанавливается всему заказу
+        с проверкой перехода, а покупатель получает уведомление.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий данные о заказе:
+                - id (int): Идентификатор заказа.
+                - state (str): Новое состояние части заказа (CONFIRMED, ASSEMBLED, SENT или DELIVERED).
+        Возвращает:
+            JsonResponse: JSON-ответ, содержащий результат операции.
+                - Если состояние успешно изменено, возвращает {'success': True} со статусом HTTP 200.
+                - Если данные невалидны или состояние не может быть установлено продавцом,
+                  возвращает ошибку со статусом HTTP 400.
+                - Если заказ магазина не найден, возвращает ошибку со статусом HTTP 404.
+                - Если переход из текущего состояния недопустим (см. ORDER_STATE_TRANSITIONS),
+                  возвращает ошибку со статусом HTTP 409.
+        """
+        serializer = OrderStateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        order_id, state = serializer.validated_data['id'], serializer.validated_data['state']
+        if state not in SELLER_ORDER_STATES:
+            return JsonResponse({'success': False, 'error': 'Order state cannot be set by seller'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            order = (Order.objects.select_for_update(of=('self',))
+                     .filter(id=order_id, shop_orders__shop__user_id=request.user.id)
+                     .only('id', 'user_id', 'state').first())
+            if order is None:
+                return JsonResponse({'success': False, 'error': 'Shop order not found'},
+                                    status=http_status.HTTP_404_NOT_FOUND)
+            if not ShopOrder.objects.filter(order_id=order_id, shop__user_id=request.user.id,
+                                            state__in=get_source_states(state)).invalidated_update(state=state):
+                return JsonResponse({'success': False, 'error': 'Invalid state transition'},
+                                    status=http_status.HTTP_409_CONFLICT)
+            order_state = get_order_state(ShopOrder.objects.filter(order_id=order_id).values_list('state', flat=True))
+            if order_state is not None and order_state != order.state:
+                if not can_change_state(order.state, order_state):
+                    transaction.set_rollback(True)
+                    return JsonResponse({'success': False, 'error': 'Invalid state transition'},
+                                        status=http_status.HTTP_409_CONFLICT)
+                set_orders_state({order.id: order_state})
+                new_order.send(sender=sender, user_id=order.user_id, order_id=order.id, order_state=order_state)
+        return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
 
     @staticmethod
     def get_seller_products(request):
@@ -267,11 +598,12 @@ class SellerBackend:
         Возвращает:
             Response: Объект ответа, содержащий список товаров продавца
         """
-        products = (ProductItem.objects.filter(shop__user_id=request.user.id).select_related(
-            'product').distinct()).cache(ops=['all'], timeout=60 * 15)
+        fieldset = get_fieldset_params(request)
+        products = with_product_item_relations(ProductItem.objects.filter(shop__user_id=request.user.id).distinct(),
+                                               **fieldset).cache(ops=['all'], timeout=60 * 15)
         if products is None:
             return JsonResponse({'success': False, 'error': 'No products found'}, status=http_status.HTTP_404_NOT_FOUND)
-        serializer = ProductItemSerializer(products, many=True)
+        serializer = ProductItemSerializer(products, many=True, context=fieldset)
         return Response(serializer.data)
 
 
@@ -295,40 +627,100 @@ class ProductsBackend:
         return Response(serializer.data)
 
     @staticmethod
-    def update_product_ranking(product_ids: list[int]) -> None:
+    def get_products_batch(request):
+        """
+        Метод возвращает список товаров по переданным идентификаторам (не более 300).
+        Товары берутся из кэша, а отсутствующие в кэше загружаются из БД одним запросом и кэшируются.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий GET-параметр ids - идентификаторы товаров через запятую.
+        Возвращает:
+            Response: Объект ответа, содержащий список найденных товаров в порядке переданных идентификаторов.
+                - Если параметр ids невалиден, возвращает ошибку со статусом HTTP 400.
+        """
+        serializer = ProductItemBatchSerializer(data={'ids': request.query_params.get('ids', '').split(',')})
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        item_ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        items = get_serialized_product_items(item_ids)
+        return Response([items[item_id] for item_id in item_ids if item_id in items])
+
+    @staticmethod
+    def update_product_ranking(ranking_items: list[tuple[int, int, int, int]]) -> None:
         """
         Обновляет рейтинг товаров в Redis.
-        Этот метод принимает список идентификаторов товаров и увеличивает их рейтинг в Redis на единицу.
-        Рейтинг товаров хранится в Redis в виде отсортированного множества с именем 'product_ranking'.
+        Этот метод увеличивает рейтинг товаров на заказанное количество одним конвейером запросов к Redis.
+        Рейтинг хранится в отсортированных множествах: общем 'product_ranking', по категориям и по магазинам,
+        а также в часовых и суточных корзинах для рейтинга за последние 24 часа и 7 дней.
 
         Параметры:
-            product_ids (list[int]): Список идентификаторов товаров, рейтинг которых нужно обновить.
+            ranking_items (list[tuple]): Позиции заказа в виде (id товара, id категории, id магазина, количество).
         Возвращает:
             None
         """
-        for product_id in product_ids:
-            redis_db.zincrby(name='product_ranking', amount=1, value=product_id)
+        add_to_ranking(ranking_items)
         return None
 
     @staticmethod
-    def get_product_ranking(count: int):
+    def get_product_ranking(count: int, period: str = RANKING_PERIOD_ALL, category_id: int = None,
+                            shop_id: int = None):
         """
         Возвращает список самых популярных товаров.
-        Этот метод извлекает из Redis рейтинг товаров и возвращает список самых популярных товаров.
-        Рейтинг товаров хранится в Redis в виде отсортированного множества с именем 'product_ranking'.
+        Этот метод извлекает из Redis первые count позиций рейтинга товаров за период
+        и возвращает список самых популярных товаров.
+        Сериализованный список кэшируется в Redis и обновляется раз в минуту или после
+        накопления изменений рейтинга, поэтому обычно запрос выполняется без обращений к БД.
 
         Параметры:
             count (int): Количество самых популярных товаров, которые нужно вернуть.
+            period (str): Период рейтинга: 24h, 7d или all (за все время).
+            category_id (int): Идентификатор категории, если нужен рейтинг товаров категории.
+            shop_id (int): Идентификатор магазина, если нужен рейтинг товаров магазина.
         Возвращает:
             list[Product]: Список самых популярных товаров, отсортированных по их рейтингу.
         """
-        product_ranking = redis_db.zrange('product_ranking', 0, -1, desc=True)[:count]
-        product_ranking_ids = [int(prod_id) for prod_id in product_ranking]
-        most_popular_products = list(Product.objects.filter(id__in=product_ranking_ids))
-        most_popular_products.sort(key=lambda x: product_ranking_ids.index(x.id))
+        scope_key = get_scope_key(category_id, shop_id)
+        data, changes = get_cached_top(scope_key, period, count)
+        if data is not None:
+            return Response(data, status=http_status.HTTP_200_OK)
+        product_ranking_ids = get_top_product_ids(count, period, category_id, shop_id)
+        products = Product.objects.in_bulk(product_ranking_ids)
+        most_popular_products = [products[prod_id] for prod_id in product_ranking_ids if prod_id in products]
         serializer = ProductSerializer(most_popular_products, many=True)
         if serializer.data is None:
             return JsonResponse({'success': False, 'error': 'No products found'}, status=http_status.HTTP_404_NOT_FOUND)
+        set_cached_top(scope_key, period, count, serializer.data, changes)
+        return Response(serializer.data, status=http_status.HTTP_200_OK)
+
+    @staticmethod
+    def update_related_products(product_ids: list[int]) -> None:
+        """
+        Обновляет индекс совместных покупок товаров в Redis.
+        Для каждого товара заказа увеличивается рейтинг остальных товаров этого заказа
+        в отсортированном множестве 'product_related:<id товара>'.
+
+        Параметры:
+            product_ids (list[int]): Список идентификаторов товаров заказа.
+        Возвращает:
+            None
+        """
+        add_to_related(product_ids)
+        return None
+
+    @staticmethod
+    def get_related_products(product_id: int, count: int):
+        """
+        Возвращает список товаров, которые чаще всего покупают вместе с товаром.
+
+        Параметры:
+            product_id (int): Идентификатор товара.
+            count (int): Количество товаров, которые нужно вернуть.
+        Возвращает:
+            list[Product]: Список товаров, отсортированных по количеству совместных покупок.
+        """
+        related_ids = get_related_product_ids(product_id, count)
+        products = Product.objects.in_bulk(related_ids)
+        serializer = ProductSerializer([products[prod_id] for prod_id in related_ids if prod_id in products], many=True)
         return Response(serializer.data, status=http_status.HTTP_200_OK)
 
 
@@ -346,14 +738,12 @@ class BuyerBackend:
                 - Если корзина найдена, возвращает список заказанных товаров в формате JSON.
                 - Если корзина не найдена, возвращает ошибку со статусом HTTP 404.
         """
-        cart = (Order.objects.filter(user_id=request.user.id,
-                                      state=OrderStateChoices.PREPARING).prefetch_related(
-            'ordered_items__product_item__product__category',
-            'ordered_items__product_item__product_properties__property'
-        ).select_related('contact').distinct())
+        fieldset = get_fieldset_params(request)
+        cart = with_order_relations(Order.objects.filter(user_id=request.user.id,
+                                                         state=OrderStateChoices.PREPARING).distinct(), **fieldset)
         if cart is None:
             return JsonResponse({'success': False, 'error': 'No cart found'}, status=http_status.HTTP_404_NOT_FOUND)
-        serializer = OrderSerializer(cart, many=True)
+        serializer = OrderSerializer(cart, many=True, context=fieldset)
         return Response(serializer.data)
 
     @staticmethod
@@ -362,6 +752,10 @@ class BuyerBackend:
         Создает и/или обновляет корзину покупателя.
         Этот метод принимает список товаров, которые нужно добавить в корзину, и обновляет корзину покупателя.
         Если корзина не существует, она создается автоматически.
+        Товары проверяются одним запросом, отсутствующие в корзине позиции создаются одним запросом
+        INSERT ... ON CONFLICT DO NOTHING, после чего количества всех позиций увеличиваются одним запросом
+        UPDATE ... CASE: количество товара, который уже есть в корзине, и количества повторяющихся в запросе
+        товаров суммируются.
 
         Параметры:
             request (Request): Объект запроса, содержащий список товаров для добавления в корзину.
@@ -372,23 +766,30 @@ class BuyerBackend:
                 - Если возникает конфликт при сохранении товара, возвращает ошибку со статусом HTTP 409.
         """
         items_serializer = OrderItemCreateUpdateSerializer(data=request.data, many=True)
-        adding_items_list = []
-        if items_serializer.is_valid():
-            adding_items_list = items_serializer.validated_data
-        else:
-            JsonResponse({'success': False, 'error': str(items_serializer.errors)}, status=http_status.HTTP_400_BAD_REQUEST)
+        if not items_serializer.is_valid():
+            return JsonResponse({'success': False, 'error': str(items_serializer.errors)},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        adding_items = {}
+        for item in items_serializer.validated_data:
+            adding_items[item['product_item']] = adding_items.get(item['product_item'], 0) + item['quantity']
+        existing_ids = set(ProductItem.objects.filter(id__in=adding_items).values_list('id', flat=True))
+        missing_ids = sorted(set(adding_items) - existing_ids)
+        if missing_ids:
+            return JsonResponse({'success': False, 'error': f'Product items not found: {missing_ids}'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
         cart, _ = Order.objects.get_or_create(user_id=request.user.id, state=OrderStateChoices.PREPARING)
-        for item in adding_items_list:
-            item.update({'order': cart.id})
-            serializer = OrderItemSerializer(data=item)
-            if serializer.is_valid():
-                try:
-                    serializer.save()
-                except IntegrityError as err:
-                    return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
-            else:
-                JsonResponse({'success': False, 'error': str(items_serializer.errors)},
-                             status=http_status.HTTP_400_BAD_REQUEST)
+        added_quantity = Case(*[When(product_item_id=product_item_id, then=Value(quantity))
+                                for product_item_id, quantity in adding_items.items()],
+                              output_field=OrderItem._meta.get_field('quantity'))
+        try:
+            with transaction.atomic():
+                OrderItem.objects.bulk_create(
+                    [OrderItem(order_id=cart.id, product_item_id=product_item_id, quantity=0)
+                     for product_item_id in adding_items], ignore_conflicts=True)
+                OrderItem.objects.filter(order_id=cart.id, product_item_id__in=adding_items).update(
+                    quantity=F('quantity') + added_quantity)
+        except IntegrityError as err:
+            return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
         return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
 
     @staticmethod
@@ -412,11 +813,11 @@ class BuyerBackend:
         else:
             return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
         cart, _ = Order.objects.get_or_create(user_id=request.user.id, state=OrderStateChoices.PREPARING)
-        for item in updating_items_list:
-            try:
-                OrderItem.objects.filter(order_id=cart.id, id=item['id']).update(quantity=item['quantity'])
-            except IntegrityError as err:
-                return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
+        try:
+            update_by_ids(OrderItem.objects.filter(order_id=cart.id), 'quantity',
+                          {item['id']: item['quantity'] for item in updating_items_list})
+        except IntegrityError as err:
+            return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
         return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
 
     @staticmethod
@@ -444,11 +845,8 @@ class BuyerBackend:
         if cart is None:
             return JsonResponse({'success': False, 'error': 'No active shopping cart found'},
                                 status=http_status.HTTP_404_NOT_FOUND)
-        query = Q()
-        for item_id in deleting_items_list:
-            query |= Q(order_id=cart.id, id=item_id)
         try:
-            deleted_items_count = OrderItem.objects.filter(query).delete()[0]
+            deleted_items_count = delete_by_ids(OrderItem.objects.filter(order_id=cart.id), deleting_items_list)
         except IntegrityError as err:
             return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
         if deleted_items_count > 0:
@@ -459,44 +857,48 @@ class BuyerBackend:
     @staticmethod
     def get_orders(request):
         """
-        Возвращает историю заказов покупателя.
-        Метод использует кэш для ускорения работы и снижения нагрузки на базу данных.
+        Возвращает страницу истории заказов покупателя.
+        Если параметр expand не передан, заказы выводятся из снимков, сохраненных при оформлении заказа.
+        Метод использует кэш для ускорения работы и снижения нагрузки на базу данных, каждая страница
+        кэшируется отдельно.
 
         Параметры:
-            request (Request): Объект запроса, содержащий информацию о пользователе.
+            request (Request): Объект запроса, содержащий информацию о пользователе. GET-параметры:
+                state, created_after, created_before - фильтры, cursor, page_size - пагинация,
+                fields, expand - выводимые поля.
         Возвращает:
-            Response: JSON-ответ, содержащий список заказов покупателя.
+            Response: JSON-ответ, содержащий ссылку на следующую страницу (next) и список заказов покупателя (results).
                 - Ответ со статусом HTTP 200 при успешном получении списка заказов.
-                - Если список заказов не найден, возвращает ошибку со статусом HTTP 404.
-        """
-        orders = (Order.objects.filter(user_id=request.user.id).exclude(
-            state=OrderStateChoices.PREPARING).prefetch_related(
-            'ordered_items__product_item__product__category',
-            'ordered_items__product_item__product_properties__property'
-        ).select_related('contact').distinct()).cache(ops=['all'], timeout=60 * 10)
-        if orders is None:
-            return JsonResponse({'success': False, 'error': 'No orders found'}, status=http_status.HTTP_404_NOT_FOUND)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+                - Если параметры фильтрации или курсор невалидны, возвращает ошибку со статусом HTTP 400.
+        """
+        serializer = OrderHistoryFilterSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        orders = Order.objects.filter(user_id=request.user.id).exclude(
+            state=OrderStateChoices.PREPARING).cache(ops=['all'], timeout=60 * 10)
+        results, next_cursor = get_orders_page(orders, **get_fieldset_params(request), **serializer.validated_data)
+        return Response(get_paginated_data(request, results, next_cursor))
 
     @staticmethod
     def confirm_order(request, sender):
         """
         Метод для подтверждения заказа покупателя.
-        Если заказ успешно подтвержден, изменяет статус заказа, генерирует отчет о заказе и отправляет уведомление
-        по email о новом заказе с прикрепленным отчетом.
+        Если заказ успешно подтвержден, изменяет статус заказа, а после фиксации транзакции запускает задачи Celery,
+        которые генерируют отчет о заказе и отправляют уведомление по email о новом заказе с прикрепленным отчетом.
         Также при успешном подтверждении заказа обновляет количество оставшихся товаров магазина и обновляет статистику
         самых популярных товаров.
 
         Параметры:
             request (Request): Объект запроса, содержащий данные о заказе:
-                - id (int): Идентификатор заказа.
+                - id (int, optional): Идентификатор заказа. Если не передан, оформляется текущая корзина покупателя.
                 - contact (int): Идентификатор контакта.
                 - coupon (str, optional): Скидочный купон.
         Возвращает:
             JsonResponse: JSON-ответ, содержащий результат операции.
                 - Если заказ успешно подтвержден, возвращает {'success': True} со статусом HTTP 200.
                 - Если данные о заказе невалидны или введен невалидный/неверный купон, возвращает ошибку со статусом HTTP 400.
+                - Если заказ пуст или часть позиций нельзя заказать (магазин неактивен, недостаточно товара),
+                  возвращает ошибку со статусом HTTP 400 и список таких позиций в поле items.
                 - Если заказ или контакт не найден, возвращает ошибку со статусом HTTP 404.
                 - Если возникает конфликт при сохранении заказа в БД, возвращает ошибку со статусом HTTP 409.
         """
@@ -505,18 +907,23 @@ class BuyerBackend:
             return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
         order_id = serializer.validated_data.get('id')
         contact_id = serializer.validated_data.get('contact')
-        order = Order.objects.filter(user_id=request.user.id, id=order_id, state=OrderStateChoices.PREPARING).first()
+        if is_redis_cart():
+            materialize_cart(request.user.id)
+        orders = Order.objects.filter(user_id=request.user.id, state=OrderStateChoices.PREPARING)
+        order = (orders.filter(id=order_id) if order_id is not None else orders).first()
         contact = Contact.objects.filter(user_id=request.user.id, id=contact_id).first()
         if order is None or contact is None:
             return JsonResponse({'success': False, 'error': 'Active shopping cart or contact not found'},
                                 status=http_status.HTTP_404_NOT_FOUND)
-        if not order.is_valid():
-            return JsonResponse(
-                {'success': False, 'error': 'Shops product quantity is not enough to confirm your order or order is empty'},
-                status=http_status.HTTP_400_BAD_REQUEST)
+        invalid_items = order.get_invalid_items()
+        if invalid_items is None:
+            return JsonResponse({'success': False, 'error': 'Order is empty'}, status=http_status.HTTP_400_BAD_REQUEST)
+        if invalid_items:
+            return JsonResponse({'success': False, 'error': 'Some ordered items cannot be confirmed',
+                                 'items': invalid_items}, status=http_status.HTTP_400_BAD_REQUEST)
         coupon_code = serializer.validated_data.get('coupon_code')
         if coupon_code:
-            coupon = Coupon.objects.filter(code__exact=coupon_code).first()
+            coupon = CouponBackend.get_coupon_by_code(coupon_code)
             if coupon is None or not coupon.is_valid():
                 return JsonResponse({'success': False, 'error': 'Coupon not found or invalid'},
                                     status=http_status.HTTP_400_BAD_REQUEST)
@@ -524,18 +931,142 @@ class BuyerBackend:
         order.contact_id = contact_id
         order.state = OrderStateChoices.CREATED
         try:
-            order.save()
+            with transaction.atomic():
+                freeze_order_prices(order, coupon.discount if coupon_code else 0)
+                order.save()
+                stock_reserved = update_ordered_items_quantity(order)
+                if stock_reserved:
+                    order.snapshot = serialize_orders([order.id])[order.id]
+                    Order.objects.filter(id=order.id).update(snapshot=order.snapshot)
+                    new_order.send(sender=sender, user_id=request.user.id, order_id=order.id, order_state=order.state)
+                else:
+                    transaction.set_rollback(True)
         except IntegrityError as err:
             return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
-        update_ordered_items_quantity(order)
-        product_ids = [item.product_item.product_id for item in order.ordered_items.all()]
-        ProductsBackend.update_product_ranking(product_ids)
-        report_path = create_order_report(order)
-        attachment = get_mail_attachment(report_path)
-        new_order.send(sender=sender, user_id=request.user.id, order_id=order.id, order_state=order.state, report_file=attachment)
+        if not stock_reserved:
+            return JsonResponse({'success': False, 'error': 'Shops product quantity is not enough to confirm your order'},
+                                status=http_status.HTTP_409_CONFLICT)
+        ranking_items = list(order.ordered_items.values_list(
+            'product_item__product_id', 'product_item__product__category_id', 'product_item__shop_id', 'quantity'))
+        ProductsBackend.update_product_ranking(ranking_items)
+        ProductsBackend.update_related_products([item[0] for item in ranking_items])
+        if is_redis_cart():
+            clear_cart(request.user.id, dict(order.ordered_items.values_list('product_item_id', 'quantity')))
         return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
 
 
+class RedisCartBackend:
+    """
+    Корзина покупателя, хранящаяся в Redis (настройка CART_BACKEND = 'redis').
+    Корзина хранится в хеше 'cart:<id покупателя>' (id товара магазина -> количество) и сохраняется в БД
+    при оформлении заказа или периодической задачей. Идентификатором позиции корзины является id товара магазина.
+    """
+
+    @staticmethod
+    def get_shopping_cart(request):
+        """
+        Возвращает корзину покупателя из Redis.
+        Данные товаров берутся из кэша товаров, поэтому обычно запрос выполняется без обращений к БД.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий информацию о пользователе.
+        Возвращает:
+            Response: JSON-ответ со списком из одной корзины или пустым списком, если корзина пуста.
+        """
+        cart_items = get_cart_items(request.user.id)
+        if not cart_items:
+            return Response([])
+        items = get_serialized_product_items(list(cart_items))
+        ordered_items = [{'id': item_id, 'product_item': items[item_id], 'quantity': quantity, 'price': None}
+                         for item_id, quantity in cart_items.items() if item_id in items]
+        total_price = sum((Decimal(item['product_item']['price']) * item['quantity'] for item in ordered_items),
+                          Decimal('0.00'))
+        return Response([{'id': None, 'ordered_items': ordered_items, 'created_at': None,
+                          'state': OrderStateChoices.PREPARING, 'contact': None,
+                          'total_price': str(total_price.quantize(Decimal('0.01')))}])
+
+    @staticmethod
+    def create_update_shopping_cart(request):
+        """
+        Добавляет товары в корзину покупателя в Redis.
+        Количество товара, который уже есть в корзине, увеличивается на переданное.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий список товаров для добавления в корзину.
+        Возвращает:
+            JsonResponse: JSON-ответ, содержащий результат операции.
+                - Если товары добавлены успешно, возвращает {'success': True} со статусом HTTP 200.
+                - Если данные о товарах невалидны или товары не найдены, возвращает ошибку со статусом HTTP 400.
+        """
+        items_serializer = OrderItemCreateUpdateSerializer(data=request.data, many=True)
+        if not items_serializer.is_valid() or not items_serializer.validated_data:
+            return JsonResponse({'success': False, 'error': str(items_serializer.errors)},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        adding_items = {}
+        for item in items_serializer.validated_data:
+            adding_items[item['product_item']] = adding_items.get(item['product_item'], 0) + item['quantity']
+        existing_ids = set(get_product_items(list(adding_items)))
+        missing_ids = set(adding_items) - existing_ids
+        if missing_ids:
+            existing_ids |= set(ProductItem.objects.filter(id__in=missing_ids).values_list('id', flat=True))
+        missing_ids = sorted(set(adding_items) - existing_ids)
+        if missing_ids:
+            return JsonResponse({'success': False, 'error': f'Product items not found: {missing_ids}'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        add_cart_items(request.user.id, adding_items)
+        return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
+
+    @staticmethod
+    def update_shopping_cart(request):
+        """
+        Обновляет количество товаров в корзине покупателя в Redis.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий список позиций корзины (id товара магазина) и их количества.
+        Возвращает:
+            JsonResponse: JSON-ответ, содержащий результат операции.
+                - Если корзина обновлена успешно, возвращает {'success': True} со статусом HTTP 200.
+                - Если данные о товарах невалидны, возвращает ошибку со статусом HTTP 400.
+        """
+        serializer = OrderItemUpdateSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        if serializer.validated_data:
+            update_cart_items(request.user.id, {item['id']: item['quantity'] for item in serializer.validated_data})
+        return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
+
+    @staticmethod
+    def delete_shopping_cart_items(request):
+        """
+        Удаляет товары из корзины покупателя в Redis.
+
+        Параметры:
+            request (Request): Объект запроса, содержащий список позиций корзины (id товаров магазина) для удаления.
+        Возвращает:
+            JsonResponse: JSON-ответ, содержащий результат операции.
+                - Если товары удалены успешно, возвращает {'success': True} со статусом HTTP 204.
+                - Если данные о товарах невалидны, возвращает ошибку со статусом HTTP 400.
+                - Если товары не найдены в корзине, возвращает ошибку со статусом HTTP 404.
+        """
+        serializer = OrderItemDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        deleting_items_list = serializer.validated_data['items']
+        deleted_items_count = delete_cart_items(request.user.id, deleting_items_list) if deleting_items_list else 0
+        if deleted_items_count > 0:
+            return JsonResponse({'success': True, 'message': f'Deleted {deleted_items_count} item(s)'},
+                                status=http_status.HTTP_204_NO_CONTENT)
+        return JsonResponse({'success': False, 'error': 'No items found to delete'}, status=http_status.HTTP_404_NOT_FOUND)
+
+
+def get_cart_backend():
+    """
+    Функция возвращает класс для работы с корзиной покупателя в соответствии с настройкой CART_BACKEND:
+    BuyerBackend (корзина в БД) или RedisCartBackend (корзина в Redis)
+    """
+    return RedisCartBackend if is_redis_cart() else BuyerBackend
+
+
 class ContactBackend:
     @staticmethod
     def get_contacts(request):
@@ -628,10 +1159,7 @@ class ContactBackend:
         else:
             return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
         if deleting_items_list:
-            query = Q()
-            for item_id in deleting_items_list:
-                query |= Q(user_id=request.user.id, id=item_id)
-            deleted_contacts_count = Contact.objects.filter(query).delete()[0]
+            deleted_contacts_count = delete_by_ids(Contact.objects.filter(user_id=request.user.id), deleting_items_list)
             if deleted_contacts_count > 0:
                 return JsonResponse({'success': True, "message": f"deleted {deleted_contacts_count} item(s)"},
                                     status=http_status.HTTP_204_NO_CONTENT)
@@ -639,6 +1167,20 @@ class ContactBackend:
 
 
 class CouponBackend:
+    @staticmethod
+    @reference_cached(Coupon)
+    def get_coupon_by_code(code: str) -> Coupon | None:
+        """
+        Возвращает купон по его коду.
+        Результат кэшируется во внутрипроцессном кэше справочных данных.
+
+        Параметры:
+            code (str): Код купона.
+        Возвращает:
+            Coupon | None: Объект купона или None, если купон не найден.
+        """
+        return Coupon.objects.filter(code__exact=code).first()
+
     @staticmethod
     def get_coupons(request):
         """
@@ -729,10 +1271,7 @@ class CouponBackend:
             return JsonResponse({'success': False, 'error': str(serializer.errors)}, status=http_status.HTTP_400_BAD_REQUEST)
         deleting_items_list = serializer.validated_data.get('items')
         if deleting_items_list:
-            query = Q()
-            for item_id in deleting_items_list:
-                query |= Q(id=item_id)
-            deleted_coupons_count = Coupon.objects.filter(query).delete()[0]
+            deleted_coupons_count = delete_by_ids(Coupon.objects.all(), deleting_items_list)
             if deleted_coupons_count > 0:
                 return JsonResponse({'success': True, 'message': f'Deleted {deleted_coupons_count} item(s)'},
                                     status=http_status.HTTP_204_NO_CONTENT)
@@ -743,53 +1282,102 @@ class ManagerBackend(CouponBackend):
     @staticmethod
     def get_orders(request):
         """
-        Возвращает список всех заказов.
+        Возвращает страницу списка всех заказов.
 
         Параметры:
-            request (Request): Объект запроса.
+            request (Request): Объект запроса. GET-параметры: state, created_after, created_before - фильтры,
+                cursor, page_size - пагинация, fields, expand - выводимые поля.
         Возвращает:
-            Response: JSON-ответ, содержащий список заказов, включая список заказанных товаров, их свойства и категории.
-                - Если список заказов найден, возвращает список заказов в формате JSON.
-                - Если список заказов не найден, возвращает ошибку со статусом HTTP 404.
-        """
-        orders = (Order.objects.all().exclude(
-            state=OrderStateChoices.PREPARING).prefetch_related(
-            'ordered_items__product_item__product__category',
-            'ordered_items__product_item__product_properties__property'
-        ).select_related('contact').distinct()).cache(ops=['all'], timeout=60 * 15)
-        if orders is None:
-            return JsonResponse({'success': False, 'error': 'No orders found'}, status=http_status.HTTP_404_NOT_FOUND)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+            Response: JSON-ответ, содержащий ссылку на следующую страницу (next) и список заказов (results),
+            включая список заказанных товаров, их свойства и категории.
+                - Если параметры фильтрации или курсор невалидны, возвращает ошибку со статусом HTTP 400.
+        """
+        serializer = OrderHistoryFilterSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': serializer.errors}, status=http_status.HTTP_400_BAD_REQUEST)
+        results, next_cursor = ManagerBackend.get_orders_data(
+            request.query_params.get('fields'), request.query_params.get('expand'), **serializer.validated_data)
+        return Response(get_paginated_data(request, results, next_cursor))
+
+    @staticmethod
+    @stampede_cached_as(Order, OrderItem, ProductItem, ProductProperty, Contact, timeout=60 * 15)
+    def get_orders_data(fields: str | None = None, expand: str | None = None, **filters) -> tuple[list, str | None]:
+        """
+        Метод возвращает страницу сериализованного списка всех заказов.
+        Результат кэшируется отдельно для каждой страницы с защитой от одновременного пересчета (cache stampede).
+
+        Параметры:
+            fields (str | None): Запрошенные поля (GET-параметр fields).
+            expand (str | None): Раскрываемые вложенные поля (GET-параметр expand).
+            filters: Фильтры и параметры пагинации (см. get_orders_page)
+        Возвращает:
+            tuple[list, str | None]: Список заказов страницы, включая список заказанных товаров, их свойства
+            и категории, и курсор следующей страницы
+        """
+        return get_orders_page(Order.objects.exclude(state=OrderStateChoices.PREPARING).nocache(),
+                               parse_fieldset(fields), parse_fieldset(expand), **filters)
 
     @staticmethod
     def change_orders_state(request, sender, *args, **kwargs):
         """
-        Метод для изменения состояния заказа.
+        Метод для изменения состояния одного или нескольких заказов.
+        Переходы проверяются по графу состояний заказа (см. ORDER_STATE_TRANSITIONS) для заказа и всех его частей
+        (части, уже находящиеся в новом состоянии, не изменяются), допустимые изменения применяются в одной
+        транзакции набором запросов UPDATE, товары отмененных частей заказов возвращаются на склад одним запросом.
+        Уведомления покупателям отправляются одной задачей Celery, записанной в outbox в той же транзакции.
 
         Параметры:
-            request (Request): Объект запроса, содержащий данные о заказе:
+            request (Request): Объект запроса, содержащий данные о заказе или список таких объектов:
                 - id (str): Идентификатор заказа.
                 - state (str): Новое состояние заказа.
         Возвращает:
-            JsonResponse: JSON-ответ, содержащий результат операции.
-                - Если состояние заказа успешно изменено, возвращает {'success': True} со статусом HTTP 200.
-                - Если данные о заказе невалидны, возвращает ошибку со статусом HTTP 400.
-                - Если заказ не найден, возвращает ошибку со статусом HTTP 404.
-                - Если возникает конфликт при изменении состояния заказа, возвращает ошибку со статусом HTTP 409.
+            JsonResponse: JSON-ответ, содержащий результат операции: идентификаторы измененных заказов (updated)
+            и ошибки по остальным заказам (errors).
+                - Если состояние хотя бы одного заказа изменено, возвращает ответ со статусом HTTP 200.
+                - Если данные о заказах невалидны или идентификаторы повторяются, возвращает ошибку со статусом HTTP 400.
+                - Если ни один заказ не найден, возвращает ошибку со статусом HTTP 404.
+                - Если ни один переход недопустим или возникает конфликт при изменении состояния заказов,
+                  возвращает ошибку со статусом HTTP 409.
         """
-        serializer = OrderStateSerializer(data=request.data)
-        if serializer.is_valid():
-            order = Order.objects.filter(id=request.data['id']).first()
-            if order is None:
-                return JsonResponse({'success': False}, status=http_status.HTTP_404_NOT_FOUND)
-            order.state = request.data['state']
-            try:
-                order.save()
-                new_order.send(sender=sender, user_id=order.user_id, order_id=order.id, order_state=order.state)
-                if order.state == OrderStateChoices.CANCELED:
-                    update_ordered_items_quantity(order)
-                return JsonResponse({'success': True}, status=http_status.HTTP_200_OK)
-            except IntegrityError as err:
-                return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
-        return JsonResponse({'success': False, 'error': str(serializer.errors)}, status=http_status.HTTP_400_BAD_REQUEST)
+        serializer = OrderStateSerializer(data=request.data if isinstance(request.data, list) else [request.data],
+                                          many=True, allow_empty=False)
+        if not serializer.is_valid():
+            return JsonResponse({'success': False, 'error': str(serializer.errors)},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        new_states = {item['id']: item['state'] for item in serializer.validated_data}
+        if len(new_states) != len(serializer.validated_data):
+            return JsonResponse({'success': False, 'error': 'Duplicate order ids'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        errors, changed = [], {}
+        try:
+            with transaction.atomic():
+                orders = {order_id: (user_id, state) for order_id, user_id, state in Order.objects.select_for_update()
+                          .filter(id__in=new_states).values_list('id', 'user_id', 'state')}
+                shop_states = defaultdict(set)
+                for order_id, state in (ShopOrder.objects.select_for_update().filter(order_id__in=orders)
+                                        .values_list('order_id', 'state')):
+                    shop_states[order_id].add(state)
+                for order_id, state in new_states.items():
+                    invalid_shop_states = sorted(shop_state for shop_state in shop_states[order_id]
+                                                 if shop_state != state and not can_change_state(shop_state, state))
+                    if order_id not in orders:
+                        errors.append({'id': order_id, 'error': 'Order not found'})
+                    elif not can_change_state(orders[order_id][1], state):
+                        errors.append({'id': order_id,
+                                       'error': f"Invalid state transition {orders[order_id][1]} -> {state}"})
+                    elif invalid_shop_states:
+                        errors.append({'id': order_id, 'error': f"Invalid shop order state transition "
+                                                                f"{', '.join(invalid_shop_states)} -> {state}"})
+                    else:
+                        changed[order_id] = state
+                set_orders_state(changed)
+                orders_state_changed.send(sender=sender, orders=[(orders[order_id][0], order_id, state)
+                                                                 for order_id, state in changed.items()])
+        except IntegrityError as err:
+            return JsonResponse({'success': False, 'error': str(err)}, status=http_status.HTTP_409_CONFLICT)
+        if changed:
+            return JsonResponse({'success': True, 'updated': list(changed), 'errors': errors},
+                                status=http_status.HTTP_200_OK)
+        if not orders:
+            return JsonResponse({'success': False, 'errors': errors}, status=http_status.HTTP_404_NOT_FOUND)
+        return JsonResponse({'success': False, 'errors': errors}, status=http_status.HTTP_409_CONFLICT)
@@ -0,0 +1,353 @@
+import hashlib
+import math
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from redis.exceptions import RedisError
+from cacheops.redis import redis_client
+
+
+STAMPEDE_PREFIX = 'stampede:'
+STAMPEDE_STALE_TIMEOUT = 60 * 5
+STAMPEDE_LOCK_TIMEOUT = 10
+STAMPEDE_WAIT_INTERVAL = 0.05
+STAMPEDE_BETA = 1.0
+
+PRODUCT_ITEM_CACHE_KEY = 'product_item:{}'
+PRODUCT_ITEM_CACHE_TIMEOUT = 60 * 10
+
+REFERENCE_CHANNEL = 'reference:invalidate'
+REFERENCE_CACHE_SIZE = 512
+REFERENCE_CACHE_TIMEOUT = 30
+
+_release_lock_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+"""
+
+
+def _get_table(sample) -> str:
+    """
+    Функция возвращает имя таблицы БД для образца кэширования (модель, объект модели или QuerySet)
+    """
+    if isinstance(sample, type) and issubclass(sample, models.Model):
+        return sample._meta.db_table
+    if isinstance(sample, models.Model):
+        return sample.__class__._meta.db_table
+    return sample.model._meta.db_table
+
+
+def get_version_key(table: str) -> str:
+    """
+    Функция возвращает ключ Redis со счетчиком версий данных таблицы
+    """
+    return f"{STAMPEDE_PREFIX}version:{table}"
+
+
+def bump_version(table: str) -> None:
+    """
+    Функция увеличивает версию данных таблицы.
+    Все значения, закэшированные с предыдущей версией, считаются устаревшими и пересчитываются
+    одним воркером, остальные воркеры в это время получают устаревшее значение.
+
+    Параметры:
+        table (str): Имя таблицы БД
+    """
+    try:
+        redis_client.incr(get_version_key(table))
+    except RedisError:
+        pass
+
+
+def get_product_items(item_ids: list[int]) -> dict:
+    """
+    Функция возвращает закэшированные сериализованные товары одним запросом к Redis
+
+    Параметры:
+        item_ids (list[int]): Идентификаторы товаров
+    Возвращает:
+        dict: Словарь id товара -> сериализованный товар (только найденные в кэше)
+    """
+    try:
+        cached = cache.get_many([PRODUCT_ITEM_CACHE_KEY.format(item_id) for item_id in item_ids])
+    except RedisError:
+        return {}
+    return {item['id']: item for item in cached.values()}
+
+
+def set_product_items(items: list[dict]) -> None:
+    """
+    Функция кэширует сериализованные товары одним конвейером запросов к Redis
+
+    Параметры:
+        items (list[dict]): Сериализованные товары
+    """
+    try:
+        cache.set_many({PRODUCT_ITEM_CACHE_KEY.format(item['id']): item for item in items},
+                       timeout=PRODUCT_ITEM_CACHE_TIMEOUT)
+    except RedisError:
+        pass
+
+
+def invalidate_product_items(item_ids) -> None:
+    """
+    Функция удаляет товары из кэша после изменения их данных
+
+    Параметры:
+        item_ids: Идентификаторы товаров
+    """
+    try:
+        cache.delete_many([PRODUCT_ITEM_CACHE_KEY.format(item_id) for item_id in item_ids])
+    except RedisError:
+        pass
+
+
+def _is_fresh(record: dict, versions: list) -> bool:
+    """
+    Функция проверяет актуальность закэшированного значения.
+    Помимо сравнения версий таблиц используется вероятностный досрочный пересчет (XFetch):
+    чем ближе окончание TTL и чем дольше вычисляется значение, тем выше вероятность пересчитать его заранее.
+    """
+    if record['versions'] != versions:
+        return False
+    early_gap = -record['delta'] * STAMPEDE_BETA * math.log(1.0 - random.random())
+    return time.time() + early_gap < record['expires']
+
+
+def stampede_cached_as(*samples, timeout: int, extra=None, stale_timeout: int = STAMPEDE_STALE_TIMEOUT,
+                       lock_timeout: int = STAMPEDE_LOCK_TIMEOUT):
+    """
+    Декоратор кэширования результата функции с защитой от одновременного пересчета (cache stampede).
+    Значение пересчитывается только воркером, получившим короткую блокировку в Redis, остальные воркеры
+    возвращают устаревшее значение или, если его нет, ожидают результат.
+    Значение инвалидируется при инвалидации cacheops любой из моделей, переданных в samples.
+
+    Параметры:
+        samples: Модели, объекты моделей или QuerySet, от которых зависит результат функции
+        timeout (int): Время жизни актуального значения в секундах
+        extra: Дополнительная часть ключа кэша (значение или функция от аргументов)
+        stale_timeout (int): Сколько секунд после timeout значение может отдаваться как устаревшее
+        lock_timeout (int): Время жизни блокировки пересчета в секундах
+    """
+    tables = sorted({_get_table(sample) for sample in samples})
+    version_keys = [get_version_key(table) for table in tables]
+
+    def decorator(func):
+        func_name = f"{func.__module__}.{func.__qualname__}"
+
+        def _get_key(args, kwargs):
+            extra_val = extra(*args, **kwargs) if callable(extra) else extra
+            key_data = repr((func_name, args, sorted(kwargs.items()), extra_val, tables))
+            return STAMPEDE_PREFIX + hashlib.md5(key_data.encode()).hexdigest()
+
+        def _compute_and_store(cache_key, versions, args, kwargs):
+            started_at = time.time()
+            result = func(*args, **kwargs)
+            finished_at = time.time()
+            record = {'value': result, 'delta': finished_at - started_at,
+                      'expires': finished_at + timeout, 'versions': versions}
+            try:
+                redis_client.set(cache_key, pickle.dumps(record, pickle.HIGHEST_PROTOCOL),
+                                 ex=timeout + stale_timeout)
+            except RedisError:
+                pass
+            return result
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(settings, 'CACHEOPS_ENABLED', True):
+                return func(*args, **kwargs)
+            cache_key = _get_key(args, kwargs)
+            lock_key = cache_key + ':lock'
+            try:
+                cached, *versions = redis_client.mget(cache_key, *version_keys)
+            except RedisError:
+                return func(*args, **kwargs)
+            record = pickle.loads(cached) if cached is not None else None
+            if record is not None and _is_fresh(record, versions):
+                return record['value']
+
+            token = uuid.uuid4().hex
+            deadline = time.time() + lock_timeout
+            try:
+                while not redis_client.set(lock_key, token, nx=True, ex=lock_timeout):
+                    if record is not None:
+                        return record['value']
+                    if time.time() > deadline:
+                        return func(*args, **kwargs)
+                    time.sleep(STAMPEDE_WAIT_INTERVAL)
+                    cached = redis_client.get(cache_key)
+                    if cached is not None:
+                        return pickle.loads(cached)['value']
+            except RedisError:
+                return func(*args, **kwargs)
+            try:
+                return _compute_and_store(cache_key, versions, args, kwargs)
+            finally:
+                try:
+                    redis_client.eval(_release_lock_script, 1, lock_key, token)
+                except RedisError:
+                    pass
+
+        return wrapper
+    return decorator
+
+
+class LocalCache:
+    """
+    Внутрипроцессный LRU-кэш с коротким временем жизни значений (L1).
+    Значения привязываются к таблицам БД и сбрасываются при инвалидации этих таблиц.
+    Ведет счетчики попаданий и промахов.
+    """
+
+    def __init__(self, max_size: int = REFERENCE_CACHE_SIZE, timeout: int = REFERENCE_CACHE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.tables = set()
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> tuple[bool, object]:
+        """
+        Метод возвращает пару (найдено ли значение, значение)
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def get_generation(self, tables) -> tuple:
+        """
+        Метод возвращает текущие поколения данных таблиц
+        """
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in tables)
+
+    def set(self, key, value, tables, generation: tuple) -> None:
+        """
+        Метод сохраняет значение, если таблицы не были инвалидированы с момента начала его вычисления
+        """
+        with self._lock:
+            if generation != tuple(self._generations.get(table, 0) for table in tables):
+                return
+            self._data[key] = (time.monotonic() + self.timeout, value, tables)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, table: str = None) -> None:
+        """
+        Метод удаляет значения, зависящие от таблицы (или все значения, если таблица не указана)
+        """
+        with self._lock:
+            if table is None:
+                self._data.clear()
+                self._generations = {key: value + 1 for key, value in self._generations.items()}
+                return
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for key in [key for key, entry in self._data.items() if table in entry[2]]:
+                del self._data[key]
+
+    def stats(self) -> dict:
+        """
+        Метод возвращает статистику кэша: количество попаданий, промахов и хранимых значений
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+reference_cache = LocalCache()
+_subscriber = {'pid': None, 'thread': None}
+
+
+def _handle_invalidation_message(message: dict) -> None:
+    table = message.get('data')
+    reference_cache.invalidate(table.decode() if isinstance(table, bytes) else table)
+
+
+def _ensure_subscribed() -> None:
+    """
+    Функция запускает в текущем процессе фоновый поток, который слушает канал инвалидации
+    справочных данных в Redis. При форке воркера поток запускается заново.
+    """
+    if _subscriber['pid'] == os.getpid():
+        return
+    _subscriber['pid'] = os.getpid()
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{REFERENCE_CHANNEL: _handle_invalidation_message})
+        _subscriber['thread'] = pubsub.run_in_thread(sleep_time=1, daemon=True)
+    except RedisError:
+        _subscriber['pid'] = None
+
+
+def invalidate_reference(table: str) -> None:
+    """
+    Функция сбрасывает справочные данные таблицы в L1-кэше текущего процесса
+    и оповещает остальные процессы через Redis pub/sub.
+    Оповещение отправляется для любой таблицы: текущий процесс (например, воркер Celery или процесс
+    административной панели) может не кэшировать таблицу, которую кэшируют другие процессы,
+    а получатели пропускают таблицы, значений которых у них нет.
+
+    Параметры:
+        table (str): Имя таблицы БД
+    """
+    reference_cache.invalidate(table)
+    try:
+        redis_client.publish(REFERENCE_CHANNEL, table)
+    except RedisError:
+        pass
+
+
+def reference_cached(*samples, extra=None):
+    """
+    Декоратор двухуровневого кэширования редко изменяемых справочных данных
+    (категории, магазины, свойства, купоны).
+    Первый уровень - внутрипроцессный LRU-кэш reference_cache с коротким временем жизни,
+    второй уровень - запросы, закэшированные cacheops в Redis.
+
+    Параметры:
+        samples: Модели, объекты моделей или QuerySet, от которых зависит результат функции
+        extra: Дополнительная часть ключа кэша (значение или функция от аргументов)
+    """
+    tables = tuple(sorted({_get_table(sample) for sample in samples}))
+    reference_cache.tables.update(tables)
+
+    def decorator(func):
+        func_name = f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(settings, 'CACHEOPS_ENABLED', True):
+                return func(*args, **kwargs)
+            _ensure_subscribed()
+            extra_val = extra(*args, **kwargs) if callable(extra) else extra
+            cache_key = (func_name, args, tuple(sorted(kwargs.items())), extra_val)
+            found, value = reference_cache.get(cache_key)
+            if found:
+                return value
+            generation = reference_cache.get_generation(tables)
+            value = func(*args, **kwargs)
+            reference_cache.set(cache_key, value, tables, generation)
+            return value
+
+        return wrapper
+    return decorator
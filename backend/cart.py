@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.db import transaction
+from .models import Order, OrderItem, OrderStateChoices, ProductItem
+from .ranking import redis_db
+
+
+CART_KEY = 'cart:{}'
+CART_DIRTY_KEY = 'cart:dirty'
+CART_TIMEOUT = 60 * 60 * 24 * 30
+CART_FLUSH_BATCH_SIZE = 100
+
+_update_existing_script = redis_db.register_script("""
+    local updated = 0
+    for i = 1, #ARGV, 2 do
+        if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+            redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+            updated = updated + 1
+        end
+    end
+    return updated
+""")
+
+_remove_ordered_script = redis_db.register_script("""
+    for i = 2, #ARGV, 2 do
+        if redis.call('hexists', KEYS[1], ARGV[i]) == 1
+                and redis.call('hincrby', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+            redis.call('hdel', KEYS[1], ARGV[i])
+        end
+    end
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('sadd', KEYS[2], ARGV[1])
+    else
+        redis.call('srem', KEYS[2], ARGV[1])
+    end
+""")
+
+
+def is_redis_cart() -> bool:
+    """
+    Функция проверяет, хранятся ли корзины покупателей в Redis (настройка CART_BACKEND = 'redis')
+    """
+    return getattr(settings, 'CART_BACKEND', 'db') == 'redis'
+
+
+def get_cart_items(user_id: int) -> dict[int, int]:
+    """
+    Функция возвращает содержимое корзины покупателя из Redis
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+    Возвращает:
+        dict[int, int]: Словарь id товара магазина -> количество
+    """
+    return {int(item_id): int(quantity) for item_id, quantity in redis_db.hgetall(CART_KEY.format(user_id)).items()}
+
+
+def _touch_cart(pipe, user_id: int) -> None:
+    pipe.expire(CART_KEY.format(user_id), CART_TIMEOUT)
+    pipe.sadd(CART_DIRTY_KEY, user_id)
+
+
+def add_cart_items(user_id: int, items: dict[int, int]) -> None:
+    """
+    Функция добавляет товары в корзину покупателя в Redis, количество уже добавленных товаров увеличивается
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+        items (dict[int, int]): Словарь id товара магазина -> количество
+    """
+    with redis_db.pipeline() as pipe:
+        for item_id, quantity in items.items():
+            pipe.hincrby(CART_KEY.format(user_id), item_id, quantity)
+        _touch_cart(pipe, user_id)
+        pipe.execute()
+
+
+def update_cart_items(user_id: int, items: dict[int, int]) -> int:
+    """
+    Функция изменяет количество товаров, которые уже есть в корзине покупателя в Redis
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+        items (dict[int, int]): Словарь id товара магазина -> количество
+    Возвращает:
+        int: Количество измененных позиций корзины
+    """
+    args = [value for item in items.items() for value in item]
+    with redis_db.pipeline() as pipe:
+        _update_existing_script(keys=[CART_KEY.format(user_id)], args=args, client=pipe)
+        _touch_cart(pipe, user_id)
+        return pipe.execute()[0]
+
+
+def delete_cart_items(user_id: int, item_ids: list[int]) -> int:
+    """
+    Функция удаляет товары из корзины покупателя в Redis
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+        item_ids (list[int]): Идентификаторы товаров магазина
+    Возвращает:
+        int: Количество удаленных позиций корзины
+    """
+    with redis_db.pipeline() as pipe:
+        pipe.hdel(CART_KEY.format(user_id), *item_ids)
+        _touch_cart(pipe, user_id)
+        return pipe.execute()[0]
+
+
+def clear_cart(user_id: int, items: dict[int, int]) -> None:
+    """
+    Функция удаляет из корзины покупателя в Redis товары оформленного заказа.
+    Количество каждого товара уменьшается на заказанное, и товар удаляется, если больше ничего не осталось,
+    поэтому товары, добавленные в корзину параллельным запросом во время оформления заказа, сохраняются.
+    Если корзина опустела, она удаляется, иначе помечается измененной, чтобы оставшиеся товары были сохранены в БД.
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+        items (dict[int, int]): Словарь id товара магазина -> заказанное количество
+    """
+    args = [value for item in items.items() for value in item]
+    _remove_ordered_script(keys=[CART_KEY.format(user_id), CART_DIRTY_KEY], args=[user_id, *args])
+
+
+def materialize_cart(user_id: int, dirty: bool = None) -> Order | None:
+    """
+    Функция сохраняет корзину покупателя из Redis в БД (заказ в состоянии PREPARING и его позиции).
+    Позиции, которых нет в корзине в Redis, удаляются, товары, которые больше не существуют, пропускаются.
+    Если корзина в Redis пуста и не изменялась с момента последнего сохранения, БД не изменяется.
+
+    Параметры:
+        user_id (int): Идентификатор покупателя
+        dirty (bool): Изменялась ли корзина с момента последнего сохранения (None - проверить в Redis)
+    Возвращает:
+        - Заказ в состоянии PREPARING
+        - None, если корзины в БД нет и сохранять нечего
+    """
+    with redis_db.pipeline() as pipe:
+        pipe.hgetall(CART_KEY.format(user_id))
+        pipe.srem(CART_DIRTY_KEY, user_id)
+        items, removed = pipe.execute()
+    items = {int(item_id): int(quantity) for item_id, quantity in items.items()}
+    dirty = bool(removed) if dirty is None else dirty
+    if not items and not dirty:
+        return Order.objects.filter(user_id=user_id, state=OrderStateChoices.PREPARING).first()
+    with transaction.atomic():
+        existing_ids = list(ProductItem.objects.filter(id__in=items).values_list('id', flat=True))
+        if existing_ids:
+            cart, _ = Order.objects.get_or_create(user_id=user_id, state=OrderStateChoices.PREPARING)
+            OrderItem.objects.bulk_create(
+                [OrderItem(order_id=cart.id, product_item_id=item_id, quantity=items[item_id])
+                 for item_id in existing_ids],
+                update_conflicts=True, unique_fields=['order', 'product_item'], update_fields=['quantity'])
+        else:
+            cart = Order.objects.filter(user_id=user_id, state=OrderStateChoices.PREPARING).first()
+            if cart is None:
+                return None
+        OrderItem.objects.filter(order_id=cart.id).exclude(product_item_id__in=existing_ids).delete()
+    return cart
+
+
+def flush_carts(batch_size: int = CART_FLUSH_BATCH_SIZE) -> int:
+    """
+    Функция сохраняет в БД все корзины, измененные в Redis с момента последнего сохранения (write-behind).
+    Каждая корзина сохраняется отдельно: корзины, которые не удалось сохранить, а также извлеченные,
+    но не обработанные из-за прерывания корзины снова помечаются измененными и сохраняются при следующем запуске.
+
+    Параметры:
+        batch_size (int): Количество корзин, извлекаемых из Redis за один запрос
+    Возвращает:
+        int: Количество сохраненных корзин
+    """
+    count, failed_ids, user_ids = 0, [], []
+    try:
+        while user_ids := redis_db.spop(CART_DIRTY_KEY, batch_size):
+            while user_ids:
+                try:
+                    materialize_cart(int(user_ids[-1]), dirty=True)
+                    count += 1
+                except Exception:
+                    failed_ids.append(user_ids[-1])
+                user_ids.pop()
+    finally:
+        if failed_ids or user_ids:
+            redis_db.sadd(CART_DIRTY_KEY, *failed_ids, *user_ids)
+    return count
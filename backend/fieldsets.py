@@ -0,0 +1,113 @@
+from rest_framework import serializers
+
+
+def parse_fieldset(value: str | None) -> dict | None:
+    """
+    Функция разбирает значение GET-параметра fields/expand в дерево полей.
+    Вложенные поля указываются через точку: "id,ordered_items.quantity" ->
+    {'id': {}, 'ordered_items': {'quantity': {}}}
+
+    Параметры:
+        value (str | None): Значение параметра
+    Возвращает:
+        - Дерево полей
+        - None, если параметр не передан
+    """
+    if value is None:
+        return None
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in filter(None, path.strip().split('.')):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def get_fieldset_params(request) -> dict:
+    """
+    Функция возвращает деревья полей из GET-параметров fields и expand запроса
+    """
+    return {
+        'fields': parse_fieldset(request.query_params.get('fields')),
+        'expand': parse_fieldset(request.query_params.get('expand')),
+    }
+
+
+def is_requested(path: str, fields: dict | None, expand: dict | None, expanded: bool = False) -> bool:
+    """
+    Функция проверяет, будет ли поле выведено сериализатором.
+    Используется для выбора необходимых select_related/prefetch_related.
+
+    Параметры:
+        path (str): Путь к полю через точку
+        fields (dict | None): Дерево запрошенных полей
+        expand (dict | None): Дерево раскрываемых вложенных полей
+        expanded (bool): Требуется ли, чтобы последнее вложенное поле было раскрыто полностью
+    """
+    names = path.split('.')
+    for index, name in enumerate(names):
+        if fields is not None:
+            if name not in fields:
+                return False
+            fields = fields[name] or None
+        if expand is not None and (index < len(names) - 1 or expanded):
+            if name not in expand:
+                return False
+            expand = expand[name]
+    return True
+
+
+def prune_data(data, fields: dict | None):
+    """
+    Функция оставляет в уже сериализованных данных (например, в снимке заказа) только запрошенные поля.
+
+    Параметры:
+        data: Сериализованные данные (словарь, список или значение)
+        fields (dict | None): Дерево запрошенных полей
+    Возвращает:
+        Данные только с запрошенными полями
+    """
+    if fields is None:
+        return data
+    if isinstance(data, list):
+        return [prune_data(item, fields) for item in data]
+    if isinstance(data, dict):
+        return {name: prune_data(value, fields[name] or None) for name, value in data.items() if name in fields}
+    return data
+
+
+def prune_fields(serializer_fields, fields: dict | None, expand: dict | None) -> None:
+    """
+    Функция удаляет из сериализатора незапрошенные поля, а нераскрытые вложенные
+    сериализаторы заменяет первичными ключами.
+    """
+    for name in list(serializer_fields):
+        field = serializer_fields[name]
+        if fields is not None and name not in fields:
+            serializer_fields.pop(name)
+            continue
+        many = isinstance(field, serializers.ListSerializer)
+        nested = field.child if many else field
+        if not isinstance(nested, serializers.BaseSerializer):
+            continue
+        if expand is not None and name not in expand:
+            source = field.source if field.source != name else None
+            serializer_fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, many=many, source=source)
+            continue
+        prune_fields(nested.fields, fields[name] or None if fields is not None else None,
+                     expand[name] if expand is not None else None)
+
+
+class SparseFieldsetMixin:
+    """
+    Примесь для сериализаторов списков, поддерживающая разреженные наборы полей.
+    Запрошенные поля передаются в контексте сериализатора ключами fields и expand (см. get_fieldset_params):
+        - fields: выводятся только перечисленные поля
+        - expand: полностью выводятся только перечисленные вложенные объекты, остальные - первичными ключами.
+          Если параметр не передан, все вложенные объекты выводятся полностью.
+    """
+
+    def get_fields(self):
+        serializer_fields = super().get_fields()
+        prune_fields(serializer_fields, self.context.get('fields'), self.context.get('expand'))
+        return serializer_fields
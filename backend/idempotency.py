@@ -0,0 +1,109 @@
+import hashlib
+import json
+import uuid
+from functools import wraps
+from django.http import HttpResponse
+from django.http.response import JsonResponse
+from redis.exceptions import RedisError
+from rest_framework import status as http_status
+from cacheops.redis import redis_client
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENCY_KEY = 'idempotency:{}:{}'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_TIMEOUT = 60 * 60 * 24
+IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+_acquire_script = redis_client.register_script("""
+    local stored = redis.call('get', KEYS[1])
+    if stored then
+        return {1, stored}
+    end
+    if redis.call('set', KEYS[2], ARGV[1], 'NX', 'EX', ARGV[2]) then
+        return {0, false}
+    end
+    return {2, false}
+""")
+
+_release_script = redis_client.register_script("""
+    if ARGV[2] ~= '' then
+        redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    end
+    if redis.call('get', KEYS[2]) == ARGV[1] then
+        redis.call('del', KEYS[2])
+    end
+""")
+
+
+def _replay(stored: bytes, fingerprint: str) -> HttpResponse:
+    """
+    Функция восстанавливает сохраненный ответ на первый запрос с тем же ключом идемпотентности
+    """
+    record = json.loads(stored)
+    if record['fingerprint'] != fingerprint:
+        return JsonResponse({'success': False, 'error': 'Idempotency-Key was used with a different request'},
+                            status=http_status.HTTP_422_UNPROCESSABLE_ENTITY)
+    response = HttpResponse(record['content'], status=record['status'], content_type=record['content_type'])
+    response[IDEMPOTENCY_REPLAYED_HEADER] = 'true'
+    return response
+
+
+def _dump_response(response, fingerprint: str) -> str:
+    """
+    Функция сериализует ответ для сохранения в Redis.
+    Ответы с ошибкой сервера (5xx) не сохраняются, чтобы повторный запрос мог быть выполнен заново.
+    """
+    if (response is None or response.status_code >= 500 or response.streaming
+            or not getattr(response, 'is_rendered', True)):
+        return ''
+    return json.dumps({'fingerprint': fingerprint, 'status': response.status_code,
+                       'content_type': response['Content-Type'], 'content': response.content.decode()})
+
+
+def idempotent(view_method):
+    """
+    Декоратор метода представления, поддерживающий заголовок Idempotency-Key.
+    Ответ на первый запрос сохраняется в Redis на IDEMPOTENCY_TIMEOUT секунд с ключом, зависящим от пользователя,
+    метода, пути и значения заголовка. Повторный запрос с тем же ключом получает сохраненный ответ
+    (с заголовком Idempotent-Replayed) без повторного выполнения. Пока первый запрос выполняется,
+    ключ защищен короткой блокировкой, и повторные запросы получают ответ 409.
+    Если ключ использован с другим телом запроса, возвращается ответ 422.
+    Запросы без заголовка, а также все запросы при недоступности Redis выполняются как обычно.
+    """
+    @wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view_method(view, request, *args, **kwargs)
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return JsonResponse({'success': False, 'error': 'Invalid Idempotency-Key header'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        digest = hashlib.sha256(f"{request.method}:{request.path}:{key}".encode()).hexdigest()
+        cache_key = IDEMPOTENCY_KEY.format(request.user.id, digest)
+        lock_key = cache_key + ':lock'
+        fingerprint = hashlib.sha256(request.body).hexdigest()
+        token = uuid.uuid4().hex
+        try:
+            result, stored = _acquire_script(keys=[cache_key, lock_key], args=[token, IDEMPOTENCY_LOCK_TIMEOUT])
+        except RedisError:
+            return view_method(view, request, *args, **kwargs)
+        if result == 1:
+            return _replay(stored, fingerprint)
+        if result == 2:
+            return JsonResponse({'success': False, 'error': 'A request with this Idempotency-Key is in progress'},
+                                status=http_status.HTTP_409_CONFLICT)
+
+        response = None
+        try:
+            response = view_method(view, request, *args, **kwargs)
+            return response
+        finally:
+            try:
+                _release_script(keys=[cache_key, lock_key],
+                                args=[token, _dump_response(response, fingerprint), IDEMPOTENCY_TIMEOUT])
+            except RedisError:
+                pass
+
+    return wrapper
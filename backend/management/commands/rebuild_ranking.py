@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from backend.ranking import rebuild_ranking, RANKING_REBUILD_BATCH_SIZE
+from backend.tasks import rebuild_product_ranking
+
+
+class Command(BaseCommand):
+    help = 'Восстановление рейтингов популярности товаров в Redis по истории заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RANKING_REBUILD_BATCH_SIZE,
+                            help='Количество строк в одной пачке')
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help='Выполнить восстановление в задаче Celery')
+
+    def handle(self, *args, **options):
+        if options['run_async']:
+            result = rebuild_product_ranking.delay(options['batch_size'])
+            self.stdout.write(f'Задача восстановления рейтингов запущена: {result.id}')
+            return
+        rows = rebuild_ranking(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Рейтинги восстановлены, обработано строк: {rows}'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from backend.related import rebuild_related, RELATED_REBUILD_BATCH_SIZE
+from backend.tasks import rebuild_related_products
+
+
+class Command(BaseCommand):
+    help = 'Восстановление индекса совместных покупок товаров в Redis по истории заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RELATED_REBUILD_BATCH_SIZE,
+                            help='Количество заказов в одной пачке')
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help='Выполнить восстановление в задаче Celery')
+
+    def handle(self, *args, **options):
+        if options['run_async']:
+            result = rebuild_related_products.delay(options['batch_size'])
+            self.stdout.write(f'Задача восстановления индекса запущена: {result.id}')
+            return
+        orders = rebuild_related(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Индекс совместных покупок восстановлен, обработано заказов: {orders}'))
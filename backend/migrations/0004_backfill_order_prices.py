@@ -0,0 +1,53 @@
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery, Sum
+
+
+BATCH_SIZE = 500
+
+
+def backfill_order_prices(apps, schema_editor):
+    """
+    Заполняет цены позиций и стоимость уже оформленных заказов текущими ценами товаров.
+    Заказы обрабатываются пачками по BATCH_SIZE: одно обновление цен позиций, одна агрегация стоимости
+    и одно массовое обновление заказов на пачку.
+    """
+    Order = apps.get_model('backend', 'Order')
+    OrderItem = apps.get_model('backend', 'OrderItem')
+    ProductItem = apps.get_model('backend', 'ProductItem')
+    price = Subquery(ProductItem.objects.filter(id=OuterRef('product_item_id')).values('price')[:1])
+    order_ids = (Order.objects.exclude(state='PREPARING').filter(total__isnull=True)
+                 .order_by('id').values_list('id', flat=True))
+    batch = []
+    for order_id in order_ids.iterator(chunk_size=BATCH_SIZE):
+        batch.append(order_id)
+        if len(batch) == BATCH_SIZE:
+            _backfill_batch(Order, OrderItem, price, batch)
+            batch = []
+    if batch:
+        _backfill_batch(Order, OrderItem, price, batch)
+
+
+def _backfill_batch(Order, OrderItem, price, order_ids):
+    OrderItem.objects.filter(order_id__in=order_ids, price__isnull=True).update(price=price)
+    subtotals = dict(OrderItem.objects.filter(order_id__in=order_ids).order_by().values('order_id')
+                     .annotate(subtotal=Sum(F('quantity') * F('price'))).values_list('order_id', 'subtotal'))
+    orders = list(Order.objects.filter(id__in=order_ids).select_related('coupon'))
+    for order in orders:
+        order.subtotal = Decimal(subtotals.get(order.id) or 0).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        discount = order.coupon.discount if order.coupon else 0
+        order.total = (order.subtotal * (Decimal(100) - discount) / Decimal(100)).quantize(Decimal('0.01'),
+                                                                                          rounding=ROUND_HALF_UP)
+        order.discount = order.subtotal - order.total
+    Order.objects.bulk_update(orders, ['subtotal', 'discount', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0003_order_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_order_prices, migrations.RunPython.noop),
+    ]
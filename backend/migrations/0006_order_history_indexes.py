@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-19 10:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0005_order_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'state', 'created_at', 'id'], name='order_user_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['state', 'created_at', 'id'], name='order_state_created_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.5 on 2026-10-19 10:41
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0006_order_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата создания заказа')),
+                ('state', models.CharField(choices=[('PREPARING', 'Подготавливается'), ('CREATED', 'Создан'), ('CONFIRMED', 'Подтвержден'), ('ASSEMBLED', 'Собран'), ('SENT', 'Отправлен'), ('DELIVERED', 'Доставлен'), ('CANCELED', 'Отменен')], default='CREATED', verbose_name='Состояние заказа')),
+                ('subtotal', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Стоимость без скидки')),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Итоговая стоимость')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shop_orders', to='backend.order', verbose_name='Заказ')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shop_orders', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Заказ магазина',
+                'verbose_name_plural': 'Список заказов магазинов',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['shop', 'state', 'created_at', 'id'], name='shop_order_state_created_idx')],
+                'constraints': [models.UniqueConstraint(fields=('order', 'shop'), name='unique_shop_order')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import migrations
+from django.db.models import F, Sum
+
+
+BATCH_SIZE = 500
+
+
+def backfill_shop_orders(apps, schema_editor):
+    """
+    Разделяет уже оформленные заказы на части по магазинам.
+    Заказы обрабатываются пачками по BATCH_SIZE: одна агрегация стоимости позиций по магазинам
+    и одна массовая вставка частей заказов на пачку.
+    """
+    Order = apps.get_model('backend', 'Order')
+    order_ids = Order.objects.exclude(state='PREPARING').order_by('id').values_list('id', flat=True)
+    batch = []
+    for order_id in order_ids.iterator(chunk_size=BATCH_SIZE):
+        batch.append(order_id)
+        if len(batch) == BATCH_SIZE:
+            _backfill_batch(apps, batch)
+            batch = []
+    if batch:
+        _backfill_batch(apps, batch)
+
+
+def _apply_discount(subtotal, order):
+    discount = order.coupon.discount if order.coupon else 0
+    return (subtotal * (Decimal(100) - discount) / Decimal(100)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def _backfill_batch(apps, order_ids):
+    """
+    Остаток от округления скидки по частям заказа относится к части с наибольшей стоимостью позиций,
+    чтобы сумма частей совпадала с итоговой стоимостью заказа.
+    """
+    Order = apps.get_model('backend', 'Order')
+    OrderItem = apps.get_model('backend', 'OrderItem')
+    ShopOrder = apps.get_model('backend', 'ShopOrder')
+    orders = Order.objects.filter(id__in=order_ids).select_related('coupon').in_bulk()
+    rows = (OrderItem.objects.filter(order_id__in=order_ids).order_by()
+            .values_list('order_id', 'product_item__shop_id')
+            .annotate(subtotal=Sum(F('quantity') * F('price'))))
+    shop_orders = defaultdict(list)
+    for order_id, shop_id, subtotal in rows:
+        order = orders[order_id]
+        subtotal = Decimal(subtotal or 0).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        shop_orders[order_id].append(ShopOrder(order_id=order_id, shop_id=shop_id, created_at=order.created_at,
+                                               state=order.state, subtotal=subtotal,
+                                               total=_apply_discount(subtotal, order)))
+    for order_id, order_shop_orders in shop_orders.items():
+        order = orders[order_id]
+        total = order.total
+        if total is None:
+            total = _apply_discount(sum(shop_order.subtotal for shop_order in order_shop_orders), order)
+        max(order_shop_orders, key=lambda shop_order: shop_order.subtotal).total += \
+            total - sum(shop_order.total for shop_order in order_shop_orders)
+    shop_orders = [shop_order for order_shop_orders in shop_orders.values() for shop_order in order_shop_orders]
+    ShopOrder.objects.bulk_create(shop_orders, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0007_shop_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_shop_orders, migrations.RunPython.noop),
+    ]
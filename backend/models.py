@@ -6,6 +6,7 @@ from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
+from django.db.models.functions import Coalesce, Now, Round
 from django.conf import settings
 import uuid
 
@@ -339,6 +340,34 @@ class Coupon(models.Model):
         return (self.valid_from <= timezone.now() <= self.valid_to) and self.active
 
 
+class OrderQuerySet(models.QuerySet):
+    """
+    Запросы заказов
+    """
+
+    def with_total_price(self):
+        """
+        Метод добавляет к заказам итоговую стоимость (annotated_total_price), вычисленную в БД.
+        Для оформленных заказов используется стоимость, зафиксированная при оформлении (total),
+        для корзин - сумма стоимостей позиций заказа со скидкой действующего купона, округленная до копеек.
+        Срок действия купона сравнивается с текущим временем БД (Now()), поэтому текст запроса не зависит
+        от момента вызова и запрос кэшируется cacheops под постоянным ключом.
+        """
+        items_cost = (OrderItem.objects.filter(order_id=models.OuterRef('pk')).order_by().values('order_id')
+                      .annotate(cost=models.Sum(models.F('quantity') * Coalesce('price', 'product_item__price')))
+                      .values('cost'))
+        now = Now()
+        discount = models.Case(
+            models.When(coupon__active=True, coupon__valid_from__lte=now, coupon__valid_to__gte=now,
+                        then=models.F('coupon__discount')),
+            default=models.Value(0))
+        total_price = models.ExpressionWrapper(
+            Coalesce(models.Subquery(items_cost), models.Value(Decimal('0')))
+            * (models.Value(100) - discount) / models.Value(Decimal('100')),
+            output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        return self.annotate(annotated_total_price=Coalesce('total', Round(total_price, 2)))
+
+
 class Order(models.Model):
     """
     Модель заказа
@@ -348,8 +377,13 @@ class Order(models.Model):
         - state (str): Состояние заказа
         - contact (Contact): Контакт
         - coupon (Coupon): Купон (опционально)
+        - subtotal (Decimal): Стоимость позиций без скидки, фиксируется при оформлении заказа
+        - discount (Decimal): Сумма скидки по купону, фиксируется при оформлении заказа
+        - total (Decimal): Итоговая стоимость, фиксируется при оформлении заказа
+        - snapshot (dict): Сериализованный заказ, сохраняется при оформлении заказа и обновляется
+          при изменении состояния. Используется для вывода истории заказов без обращения к связанным таблицам
     """
-    objects = models.manager.Manager()
+    objects = OrderQuerySet.as_manager()
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders', verbose_name='Пользователь')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания заказа')
@@ -358,6 +392,12 @@ class Order(models.Model):
     contact = models.ForeignKey(Contact, on_delete=models.CASCADE, blank=True, null=True, related_name='orders',
                                 verbose_name='Контакт')
     coupon = models.ForeignKey(Coupon, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='Купон')
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True,
+                                   verbose_name='Стоимость без скидки')
+    discount = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True, verbose_name='Скидка')
+    total = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True,
+                                verbose_name='Итоговая стоимость')
+    snapshot = models.JSONField(blank=True, null=True, editable=False, verbose_name='Снимок заказа')
 
     def __str__(self):
         return f"{self.created_at} - {self.state}"
@@ -366,24 +406,48 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = 'Список заказов'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'state', 'created_at', 'id'], name='order_user_state_created_idx'),
+            models.Index(fields=['state', 'created_at', 'id'], name='order_state_created_idx'),
+        ]
 
     @property
     def total_price(self):
+        if self.total is not None:
+            return self.total
+        if hasattr(self, 'annotated_total_price'):
+            return Decimal(self.annotated_total_price).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
         if self.coupon and self.coupon.is_valid():
-            discount = Decimal(1 - (self.coupon.discount / 100))
+            discount = (Decimal(100) - self.coupon.discount) / Decimal(100)
             return (Decimal(discount * sum(item.get_cost() for item in self.ordered_items.all()))
                     .quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
         return (Decimal(sum(item.get_cost() for item in self.ordered_items.all()))
                 .quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
 
+    def get_invalid_items(self) -> list[dict] | None:
+        """
+        Метод проверяет все позиции заказа одним запросом к БД.
+
+        Возвращает:
+            - None, если в заказе нет позиций
+            - Список позиций, которые нельзя заказать: id позиции, id товара, заказанное и доступное количество
+              и причина ошибки (inactive_shop - магазин не принимает заказы,
+              insufficient_quantity - недостаточно товара). Пустой список, если заказ можно оформить.
+        """
+        items = list(self.ordered_items.order_by('id').annotate(
+            available=models.F('product_item__quantity'),
+            error=models.Case(
+                models.When(product_item__shop__is_active=False, then=models.Value('inactive_shop')),
+                models.When(product_item__quantity__lt=models.F('quantity'), then=models.Value('insufficient_quantity')),
+                default=None, output_field=models.CharField())
+        ).values('id', 'product_item_id', 'quantity', 'available', 'error'))
+        if not items:
+            return None
+        return [{'id': item['id'], 'product_item': item['product_item_id'], 'quantity': item['quantity'],
+                 'available': item['available'], 'error': item['error']} for item in items if item['error']]
+
     def is_valid(self):
-        if not self.ordered_items.all():
-            return False
-        for item in self.ordered_items.all():
-            is_active_shop = item.product_item.shop.is_active
-            if item.product_item.quantity < item.quantity or is_active_shop is False:
-                return False
-        return True
+        return self.get_invalid_items() == []
 
 
 class OrderItem(models.Model):
@@ -393,6 +457,7 @@ class OrderItem(models.Model):
         - order (Order): Заказ
         - product_item (ProductItem): Экземпляр продукта
         - quantity (int): Количество
+        - price (Decimal): Цена за единицу, фиксируется при оформлении заказа
     """
     objects = models.manager.Manager()
 
@@ -400,6 +465,7 @@ class OrderItem(models.Model):
     product_item = models.ForeignKey(ProductItem, blank=True, on_delete=models.CASCADE, related_name='ordered_items',
                                      verbose_name='Экземпляр продукта')
     quantity = models.PositiveIntegerField(default=1, verbose_name='Количество')
+    price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, verbose_name='Цена')
 
     class Meta:
         verbose_name = 'Позиция заказа'
@@ -409,12 +475,49 @@ class OrderItem(models.Model):
         ]
 
     def get_cost(self):
-        return Decimal(self.quantity * self.product_item.price)
+        price = self.price if self.price is not None else self.product_item.price
+        return Decimal(self.quantity * price)
 
     def __str__(self):
         return f"{self.product_item.product.name}"
 
 
+class ShopOrder(models.Model):
+    """
+    Модель части заказа, относящейся к одному магазину. Создается при оформлении заказа.
+    Поля:
+        - order (Order): Заказ
+        - shop (Shop): Магазин
+        - created_at (datetime): Дата создания заказа
+        - state (str): Состояние части заказа, изменяется продавцом независимо от других магазинов
+        - subtotal (Decimal): Стоимость позиций магазина без скидки
+        - total (Decimal): Стоимость позиций магазина со скидкой
+    """
+    objects = models.manager.Manager()
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='shop_orders', verbose_name='Заказ')
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='shop_orders', verbose_name='Магазин')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Дата создания заказа')
+    state = models.CharField(choices=OrderStateChoices.choices, default=OrderStateChoices.CREATED,
+                             verbose_name='Состояние заказа')
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='Стоимость без скидки')
+    total = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='Итоговая стоимость')
+
+    class Meta:
+        verbose_name = 'Заказ магазина'
+        verbose_name_plural = 'Список заказов магазинов'
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'shop'], name='unique_shop_order')
+        ]
+        indexes = [
+            models.Index(fields=['shop', 'state', 'created_at', 'id'], name='shop_order_state_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.order_id} - {self.shop_id} - {self.state}"
+
+
 class EmailTokenConfirm(models.Model):
     """
     Модель токена для подтверждения email
@@ -444,3 +547,38 @@ class EmailTokenConfirm(models.Model):
 
     def __str__(self):
         return f"Password reset token for {self.user}"
+
+
+class OutboxMessage(models.Model):
+    """
+    Модель сообщения исходящей очереди (transactional outbox).
+    Сообщение сохраняется в одной транзакции с изменением заказа и передается в Celery фоновой задачей.
+    Поля:
+        - created_at (datetime): Дата создания сообщения
+        - tasks (list): Цепочка задач Celery: список [имя задачи, аргументы]
+        - dedup_key (str): Ключ для исключения повторных сообщений (опционально)
+        - attempts (int): Количество неудачных попыток отправки
+        - available_at (datetime): Время следующей попытки отправки
+        - sent_at (datetime): Дата отправки в Celery
+        - last_error (str): Текст последней ошибки отправки
+    """
+    objects = models.manager.Manager()
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    tasks = models.JSONField(verbose_name='Задачи')
+    dedup_key = models.CharField(max_length=200, unique=True, blank=True, null=True, verbose_name='Ключ дедупликации')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Количество попыток')
+    available_at = models.DateTimeField(default=timezone.now, verbose_name='Время следующей попытки')
+    sent_at = models.DateTimeField(blank=True, null=True, verbose_name='Дата отправки')
+    last_error = models.TextField(blank=True, default='', verbose_name='Последняя ошибка')
+
+    class Meta:
+        verbose_name = 'Исходящее сообщение'
+        verbose_name_plural = 'Исходящие сообщения'
+        indexes = [
+            models.Index(fields=['available_at', 'id'], condition=models.Q(sent_at__isnull=True),
+                         name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.id} - {self.tasks[0][0]}"
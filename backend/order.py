@@ -1,42 +1,214 @@
 import csv
 import datetime
-from django.db import IntegrityError
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, When, Value, F, Func, OuterRef, Subquery, Sum, Exists
+from django.db.models.functions import Cast
 from django.http.response import HttpResponse
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import Table
 from reportlab.lib.units import inch
-from .models import Order, ProductItem, OrderStateChoices
+from .models import Order, OrderItem, ProductItem, OrderStateChoices, ShopOrder
+from .cache import invalidate_product_items
+
+
+ORDER_STATE_TRANSITIONS = {
+    OrderStateChoices.CREATED: (OrderStateChoices.CONFIRMED, OrderStateChoices.CANCELED),
+    OrderStateChoices.CONFIRMED: (OrderStateChoices.ASSEMBLED, OrderStateChoices.CANCELED),
+    OrderStateChoices.ASSEMBLED: (OrderStateChoices.SENT, OrderStateChoices.CANCELED),
+    OrderStateChoices.SENT: (OrderStateChoices.DELIVERED,),
+    OrderStateChoices.DELIVERED: (),
+    OrderStateChoices.CANCELED: (),
+}
+
+ORDER_STATE_SEQUENCE = (OrderStateChoices.CREATED, OrderStateChoices.CONFIRMED, OrderStateChoices.ASSEMBLED,
+                        OrderStateChoices.SENT, OrderStateChoices.DELIVERED)
+
+
+def can_change_state(current_state: str, new_state: str) -> bool:
+    """
+    Функция проверяет, допустим ли переход оформленного заказа из одного состояния в другое.
+    Корзина (PREPARING) переводится в состояние CREATED только при оформлении заказа покупателем.
+    """
+    return new_state in ORDER_STATE_TRANSITIONS.get(current_state, ())
+
+
+def get_source_states(new_state: str) -> list[str]:
+    """
+    Функция возвращает состояния, из которых допустим переход в состояние new_state
+    """
+    return [state for state, targets in ORDER_STATE_TRANSITIONS.items() if new_state in targets]
+
+
+def get_order_state(shop_order_states) -> str | None:
+    """
+    Функция возвращает состояние заказа по состояниям его частей: наименее продвинутое из них
+    в цепочке CREATED -> CONFIRMED -> ASSEMBLED -> SENT -> DELIVERED. Каждая часть заказа переходит
+    на один шаг цепочки, поэтому состояние заказа также меняется не более чем на один шаг.
+    Если среди частей есть отмененные, возвращает None.
+
+    Параметры:
+        shop_order_states (Iterable[str]): Состояния частей заказа
+    """
+    states = set(shop_order_states)
+    if not states or not states <= set(ORDER_STATE_SEQUENCE):
+        return None
+    return min(states, key=ORDER_STATE_SEQUENCE.index)
 
 
 def update_ordered_items_quantity(order: Order) -> bool:
     """
-    Функция обновляет количество товаров продавца после успешного создания заказа
+    Функция обновляет количество товаров продавца после создания или отмены заказа.
+    При создании заказа товары резервируются одним условным запросом
+    UPDATE ... SET quantity = quantity - n WHERE quantity >= n без блокировки строк:
+    если хотя бы одного товара недостаточно, не изменяется ни один товар.
+    Функцию нужно вызывать в транзакции вместе с изменением состояния заказа и откатывать транзакцию,
+    если функция вернула False.
+    Товары удаляются из кэша после фиксации транзакции, чтобы параллельный запрос не закэшировал старое количество.
 
     Параметры:
         order (Order): Объект заказа
     Возвращает:
         - True, если обновление прошло успешно
-        - False, если обновление не удалось
+        - False, если обновление не удалось (товара недостаточно)
     """
-    products_to_update = []
-    for ordered_item in order.ordered_items.all():
-        updated_quantity = ordered_item.product_item.quantity
+    quantities = dict(order.ordered_items.values_list('product_item_id', 'quantity'))
+    if not quantities:
+        return True
+    ordered_quantity = Case(*[When(id=item_id, then=Value(quantity)) for item_id, quantity in quantities.items()],
+                            output_field=models.PositiveIntegerField())
+    products = ProductItem.objects.filter(id__in=quantities)
+    try:
         if order.state == OrderStateChoices.CREATED:
-            updated_quantity -= ordered_item.quantity
+            updated = products.filter(quantity__gte=ordered_quantity).update(quantity=F('quantity') - ordered_quantity)
         elif order.state == OrderStateChoices.CANCELED:
-            updated_quantity += ordered_item.quantity
-        if updated_quantity < 0:
-            return False
-        ordered_item.product_item.quantity = updated_quantity
-        products_to_update.append(ordered_item.product_item)
-    try:
-        ProductItem.objects.bulk_update(products_to_update, ["quantity"])
+            updated = products.update(quantity=F('quantity') + ordered_quantity)
+        else:
+            return True
     except IntegrityError:
         return False
+    if updated != len(quantities):
+        return False
+    item_ids = list(quantities)
+    transaction.on_commit(lambda: invalidate_product_items(item_ids))
     return True
 
 
+def _apply_discount(subtotal: Decimal, discount: int) -> Decimal:
+    return (subtotal * (Decimal(100) - discount) / Decimal(100)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def restock_orders(order_ids: list[int]) -> None:
+    """
+    Функция возвращает на склад товары отменяемых заказов.
+    Возвращаются только позиции тех магазинов, части заказа которых еще не отменены, а также все позиции заказов
+    без частей. Количество товаров суммируется по всем заказам в БД, товары обновляются одним запросом
+    UPDATE ... CASE. Функцию нужно вызывать в транзакции до изменения состояния частей заказов.
+    Товары удаляются из кэша после фиксации транзакции.
+
+    Параметры:
+        order_ids (list[int]): Идентификаторы отменяемых заказов
+    """
+    shop_orders = ShopOrder.objects.filter(order_id=OuterRef('order_id'))
+    canceled_lines = (Exists(shop_orders.filter(shop_id=OuterRef('product_item__shop_id'),
+                                                state__in=get_source_states(OrderStateChoices.CANCELED)))
+                      | ~Exists(shop_orders))
+    quantities = dict(OrderItem.objects.filter(canceled_lines, order_id__in=order_ids).order_by()
+                      .values('product_item_id').annotate(total=Sum('quantity')).values_list('product_item_id', 'total'))
+    if not quantities:
+        return
+    restored_quantity = Case(*[When(id=item_id, then=Value(quantity)) for item_id, quantity in quantities.items()],
+                             output_field=models.PositiveIntegerField())
+    ProductItem.objects.filter(id__in=quantities).update(quantity=F('quantity') + restored_quantity)
+    item_ids = list(quantities)
+    transaction.on_commit(lambda: invalidate_product_items(item_ids))
+
+
+def set_orders_state(order_states: dict[int, str]) -> None:
+    """
+    Функция изменяет состояние заказов набором запросов UPDATE: по одному запросу к заказам и к частям заказов
+    на каждое новое состояние. Изменяются только части заказов, переход которых в новое состояние допустим,
+    в снимках заказов обновляется поле state, товары отмененных частей заказов возвращаются на склад.
+    Кэш cacheops заказов и частей заказов инвалидируется после фиксации транзакции.
+    Заказы изменяются условным запросом: только если переход из их текущего состояния допустим.
+    Переходы заказов и их частей должны быть проверены заранее (см. can_change_state),
+    функцию нужно вызывать в транзакции.
+
+    Параметры:
+        order_states (dict[int, str]): Словарь id заказа -> новое состояние
+    """
+    orders_by_state = defaultdict(list)
+    for order_id, state in order_states.items():
+        orders_by_state[state].append(order_id)
+    for state, order_ids in orders_by_state.items():
+        if state == OrderStateChoices.CANCELED:
+            restock_orders(order_ids)
+        snapshot = Func(F('snapshot'),
+                        Func(Cast(Value('state'), models.TextField()), Cast(Value(state), models.TextField()),
+                             function='jsonb_build_object'),
+                        template='%(expressions)s', arg_joiner=' || ', output_field=models.JSONField())
+        Order.objects.filter(id__in=order_ids, state__in=get_source_states(state)).invalidated_update(
+            state=state, snapshot=snapshot)
+        ShopOrder.objects.filter(order_id__in=order_ids, state__in=get_source_states(state)).invalidated_update(
+            state=state)
+
+
+def freeze_order_prices(order: Order, discount: int = 0) -> list[ShopOrder]:
+    """
+    Функция фиксирует цены позиций заказа и стоимость заказа при его оформлении, чтобы последующие изменения
+    цен продавцами не влияли на историю заказов, и разделяет заказ на части по магазинам (ShopOrder).
+    Цены позиций копируются из товаров магазина одним запросом UPDATE, стоимость позиций каждого магазина
+    суммируется в БД одним запросом, части заказа создаются одним запросом INSERT.
+    Скидка округляется для каждой части заказа отдельно, а разница округления относится к части с наибольшей
+    стоимостью, поэтому сумма стоимостей частей всегда равна стоимости заказа.
+    Поля заказа subtotal, discount и total заполняются у объекта заказа и сохраняются вместе с ним,
+    поэтому функцию нужно вызывать в транзакции перед order.save().
+
+    Параметры:
+        order (Order): Объект заказа
+        discount (int): Скидка купона в процентах
+    Возвращает:
+        list[ShopOrder]: Созданные части заказа
+    """
+    order.ordered_items.update(
+        price=Subquery(ProductItem.objects.filter(id=OuterRef('product_item_id')).values('price')[:1]))
+    shop_subtotals = order.ordered_items.order_by().values_list('product_item__shop_id').annotate(
+        subtotal=Sum(F('quantity') * F('price')))
+    shop_orders = [ShopOrder(order_id=order.id, shop_id=shop_id, created_at=order.created_at,
+                             state=OrderStateChoices.CREATED,
+                             subtotal=Decimal(subtotal).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+                             total=_apply_discount(Decimal(subtotal), discount))
+                   for shop_id, subtotal in shop_subtotals]
+    order.subtotal = sum((shop_order.subtotal for shop_order in shop_orders), Decimal('0.00'))
+    order.total = _apply_discount(order.subtotal, discount)
+    order.discount = order.subtotal - order.total
+    if shop_orders:
+        max(shop_orders, key=lambda shop_order: shop_order.subtotal).total += \
+            order.total - sum(shop_order.total for shop_order in shop_orders)
+    return ShopOrder.objects.bulk_create(shop_orders)
+
+
+def get_order_state_message(order_id: int, order_state: str) -> tuple[str, str]:
+    """
+    Функция возвращает тему и текст уведомления об изменении статуса заказа
+    """
+    subject = "Обновление статуса заказа"
+    body = f"Ваш заказ #{order_id}"
+    if order_state == OrderStateChoices.CREATED:
+        body = f"Ваш заказ #{order_id} сформирован"
+    if order_state == OrderStateChoices.CONFIRMED:
+        body = f"Ваш заказ #{order_id} подтвержден. Спасибо за покупку!"
+    if order_state == OrderStateChoices.ASSEMBLED:
+        body = f"Ваш заказ #{order_id} собран"
+    if order_state == OrderStateChoices.DELIVERED:
+        body = f"Ваш заказ #{order_id} доставлен"
+    if order_state == OrderStateChoices.CANCELED:
+        body = f"Ваш заказ #{order_id} отменен"
+    return subject, body
+
+
 def create_order_report(order_obj: Order) -> str | None:
     """
     Функция создает отчет о заказе в формате pdf
@@ -64,7 +236,7 @@ def create_order_report(order_obj: Order) -> str | None:
         for item in order_obj.ordered_items.all():
             table_data.append([
                 item.product_item.product.name,
-                item.product_item.price,
+                item.price if item.price is not None else item.product_item.price,
                 item.quantity,
                 item.get_cost()]
             )
@@ -0,0 +1,70 @@
+from datetime import timedelta
+from celery import chain, signature
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxMessage
+
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_RETRY_DELAY = 60 * 5
+OUTBOX_RETENTION = timedelta(days=7)
+
+
+def enqueue(tasks: list[tuple[str, list]], dedup_key: str | None = None) -> None:
+    """
+    Функция сохраняет цепочку задач Celery в исходящую очередь.
+    Вызывается в транзакции, изменяющей данные, поэтому задачи будут отправлены только после ее фиксации,
+    а запрос не обращается к брокеру сообщений. Повторное сообщение с тем же ключом дедупликации не сохраняется.
+
+    Параметры:
+        tasks (list[tuple[str, list]]): Цепочка задач: список (имя задачи, аргументы).
+            Результат каждой задачи передается первым аргументом следующей.
+        dedup_key (str | None): Ключ дедупликации
+    """
+    OutboxMessage.objects.bulk_create(
+        [OutboxMessage(tasks=[[name, list(args)] for name, args in tasks], dedup_key=dedup_key)],
+        ignore_conflicts=dedup_key is not None)
+
+
+def relay_outbox(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Функция передает в Celery неотправленные сообщения исходящей очереди.
+    Сообщения выбираются пачкой с блокировкой строк (SELECT ... FOR UPDATE SKIP LOCKED), поэтому несколько
+    воркеров не отправляют одно сообщение дважды. Если брокер недоступен, отправка пачки прекращается,
+    а сообщение остается в очереди и отправляется повторно с экспоненциально растущей задержкой.
+
+    Параметры:
+        batch_size (int): Количество сообщений в пачке
+    Возвращает:
+        int: Количество отправленных сообщений
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(OutboxMessage.objects.select_for_update(skip_locked=True)
+                        .filter(sent_at__isnull=True, available_at__lte=now).order_by('available_at', 'id')[:batch_size])
+        sent, failed = [], []
+        for message in messages:
+            try:
+                chain(*[signature(name, args=args) for name, args in message.tasks]).apply_async()
+            except Exception as err:
+                message.attempts += 1
+                message.available_at = now + timedelta(seconds=min(2 ** message.attempts, OUTBOX_MAX_RETRY_DELAY))
+                message.last_error = str(err)
+                failed.append(message)
+                break
+            else:
+                sent.append(message.id)
+        OutboxMessage.objects.filter(id__in=sent).update(sent_at=now)
+        OutboxMessage.objects.bulk_update(failed, ['attempts', 'available_at', 'last_error'])
+    return len(sent)
+
+
+def purge_outbox(retention: timedelta = OUTBOX_RETENTION) -> int:
+    """
+    Функция удаляет отправленные сообщения, которые старше retention
+
+    Возвращает:
+        int: Количество удаленных сообщений
+    """
+    deleted, _ = OutboxMessage.objects.filter(sent_at__lt=timezone.now() - retention).delete()
+    return deleted
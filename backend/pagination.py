@@ -0,0 +1,72 @@
+import base64
+import binascii
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.utils.urls import replace_query_param
+
+
+ORDERS_PAGE_SIZE = 30
+ORDERS_MAX_PAGE_SIZE = 100
+CURSOR_PARAM = 'cursor'
+
+
+def encode_cursor(created_at: datetime, object_id: int) -> str:
+    """
+    Функция кодирует позицию курсора (дата создания и id последнего объекта страницы) в строку
+    """
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{object_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Функция декодирует позицию курсора
+
+    Параметры:
+        cursor (str): Значение GET-параметра cursor
+    Возвращает:
+        tuple[datetime, int]: Дата создания и id последнего объекта предыдущей страницы
+    Исключения:
+        ValueError: Если курсор невалиден
+    """
+    try:
+        created_at, object_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(object_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def paginate_by_cursor(queryset, cursor: str | None = None, page_size: int = ORDERS_PAGE_SIZE) -> tuple[list, str | None]:
+    """
+    Функция возвращает страницу объектов, отсортированных по убыванию (created_at, id).
+    Используется пагинация по ключу (keyset): следующая страница выбирается условием
+    (created_at, id) < позиции курсора, поэтому каждая страница читается диапазоном индекса
+    независимо от ее номера.
+
+    Параметры:
+        queryset (QuerySet): Запрос объектов с полями created_at и id
+        cursor (str | None): Курсор, полученный с предыдущей страницей (None - первая страница)
+        page_size (int): Количество объектов на странице
+    Возвращает:
+        tuple[list, str | None]: Объекты страницы и курсор следующей страницы (None, если страница последняя)
+    Исключения:
+        ValueError: Если курсор невалиден
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, object_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id))
+    page = list(queryset[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, encode_cursor(page[-1].created_at, page[-1].id)
+
+
+def get_paginated_data(request, results: list, next_cursor: str | None) -> dict:
+    """
+    Функция возвращает тело ответа со страницей результатов и ссылкой на следующую страницу
+    """
+    next_url = None
+    if next_cursor is not None:
+        next_url = replace_query_param(request.build_absolute_uri(), CURSOR_PARAM, next_cursor)
+    return {'next': next_url, 'results': results}
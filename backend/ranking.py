@@ -0,0 +1,267 @@
+import datetime
+import pickle
+import uuid
+import redis
+from django.conf import settings
+from django.db.models import Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from .models import OrderItem, OrderStateChoices
+
+
+redis_db = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+RANKING_KEY = 'product_ranking'
+RANKING_CATEGORY_KEY = RANKING_KEY + ':category:{}'
+RANKING_SHOP_KEY = RANKING_KEY + ':shop:{}'
+RANKING_HOUR_KEY = '{}:hour:{:%Y%m%d%H}'
+RANKING_DAY_KEY = '{}:day:{:%Y%m%d}'
+RANKING_WINDOW_KEY = '{}:window:{}'
+RANKING_TOP_KEY = '{}:top:{}:{}'
+RANKING_CHANGES_KEY = '{}:changes'
+RANKING_REBUILD_PREFIX = 'rebuild:{}:'
+RANKING_HOUR_TIMEOUT = 60 * 60 * 25
+RANKING_DAY_TIMEOUT = 60 * 60 * 24 * 8
+RANKING_WINDOW_TIMEOUT = 60
+RANKING_TOP_TIMEOUT = 60
+RANKING_TOP_CHANGES_THRESHOLD = 20
+RANKING_REBUILD_BATCH_SIZE = 5000
+RANKING_REBUILD_TIMEOUT = 60 * 60
+
+RANKING_PERIOD_DAY = '24h'
+RANKING_PERIOD_WEEK = '7d'
+RANKING_PERIOD_ALL = 'all'
+RANKING_PERIODS = (RANKING_PERIOD_DAY, RANKING_PERIOD_WEEK, RANKING_PERIOD_ALL)
+
+
+def get_scope_key(category_id: int = None, shop_id: int = None) -> str:
+    """
+    Функция возвращает ключ рейтинга за все время: общего, по категории или по магазину.
+    Ключи временных корзин и периодов рейтинга образуются добавлением суффикса к этому ключу.
+
+    Параметры:
+        category_id (int): Идентификатор категории
+        shop_id (int): Идентификатор магазина
+    """
+    if category_id is not None:
+        return RANKING_CATEGORY_KEY.format(category_id)
+    if shop_id is not None:
+        return RANKING_SHOP_KEY.format(shop_id)
+    return RANKING_KEY
+
+
+def get_scope_keys(category_id: int, shop_id: int) -> tuple[str, str, str]:
+    """
+    Функция возвращает ключи всех рейтингов, в которые входит товар: общего, его категории и его магазина
+    """
+    return RANKING_KEY, get_scope_key(category_id=category_id), get_scope_key(shop_id=shop_id)
+
+
+def get_bucket_keys(scope_key: str, period: str, now: datetime.datetime = None) -> list[str]:
+    """
+    Функция возвращает ключи временных корзин рейтинга, из которых складывается период:
+        - 24h: 24 часовые корзины, включая текущую
+        - 7d: 7 суточных корзин, включая текущую
+
+    Параметры:
+        scope_key (str): Ключ рейтинга (см. get_scope_key)
+        period (str): Период рейтинга
+        now (datetime): Текущее время (UTC)
+    """
+    now = now or timezone.now()
+    if period == RANKING_PERIOD_DAY:
+        return [RANKING_HOUR_KEY.format(scope_key, now - datetime.timedelta(hours=hours)) for hours in range(24)]
+    return [RANKING_DAY_KEY.format(scope_key, now - datetime.timedelta(days=days)) for days in range(7)]
+
+
+def add_to_ranking(ranking_items: list[tuple[int, int, int, int]]) -> None:
+    """
+    Функция увеличивает рейтинг товаров на заказанное количество в общем рейтинге,
+    в рейтингах категорий и магазинов, а также в их текущих часовых и суточных корзинах.
+    Все изменения отправляются в Redis одним конвейером запросов.
+
+    Параметры:
+        ranking_items (list[tuple]): Позиции заказа в виде (id товара, id категории, id магазина, количество)
+    """
+    scores = {}
+    for product_id, category_id, shop_id, quantity in ranking_items:
+        for scope_key in get_scope_keys(category_id, shop_id):
+            scope_scores = scores.setdefault(scope_key, {})
+            scope_scores[product_id] = scope_scores.get(product_id, 0) + quantity
+    if not scores:
+        return
+    now = timezone.now()
+    with redis_db.pipeline(transaction=False) as pipe:
+        for scope_key, scope_scores in scores.items():
+            hour_key = RANKING_HOUR_KEY.format(scope_key, now)
+            day_key = RANKING_DAY_KEY.format(scope_key, now)
+            for product_id, quantity in scope_scores.items():
+                pipe.zincrby(scope_key, quantity, product_id)
+                pipe.zincrby(hour_key, quantity, product_id)
+                pipe.zincrby(day_key, quantity, product_id)
+            pipe.expire(hour_key, RANKING_HOUR_TIMEOUT)
+            pipe.expire(day_key, RANKING_DAY_TIMEOUT)
+            pipe.incr(RANKING_CHANGES_KEY.format(scope_key))
+        pipe.execute()
+
+
+def get_ranking_key(scope_key: str, period: str) -> str:
+    """
+    Функция возвращает ключ отсортированного множества с рейтингом за период.
+    Рейтинг за 24 часа и 7 дней получается объединением временных корзин (ZUNIONSTORE)
+    и хранится RANKING_WINDOW_TIMEOUT секунд, поэтому объединение выполняется не чаще раза в минуту.
+
+    Параметры:
+        scope_key (str): Ключ рейтинга (см. get_scope_key)
+        period (str): Период рейтинга
+    """
+    if period == RANKING_PERIOD_ALL:
+        return scope_key
+    window_key = RANKING_WINDOW_KEY.format(scope_key, period)
+    if not redis_db.exists(window_key):
+        with redis_db.pipeline() as pipe:
+            pipe.zunionstore(window_key, get_bucket_keys(scope_key, period))
+            pipe.expire(window_key, RANKING_WINDOW_TIMEOUT)
+            pipe.execute()
+    return window_key
+
+
+def get_top_product_ids(count: int, period: str = RANKING_PERIOD_ALL, category_id: int = None,
+                        shop_id: int = None) -> list[int]:
+    """
+    Функция возвращает идентификаторы самых популярных товаров за период,
+    из Redis запрашиваются только первые count элементов рейтинга.
+
+    Параметры:
+        count (int): Количество товаров
+        period (str): Период рейтинга (24h, 7d или all)
+        category_id (int): Идентификатор категории для рейтинга по категории
+        shop_id (int): Идентификатор магазина для рейтинга по магазину
+    """
+    ranking_key = get_ranking_key(get_scope_key(category_id, shop_id), period)
+    return [int(product_id) for product_id in redis_db.zrevrange(ranking_key, 0, count - 1)]
+
+
+def get_cached_top(scope_key: str, period: str, count: int) -> tuple[list | None, int]:
+    """
+    Функция возвращает закэшированный сериализованный список самых популярных товаров.
+    Список и счетчик изменений рейтинга читаются одним запросом к Redis. Список считается устаревшим,
+    если истек RANKING_TOP_TIMEOUT или с момента его построения рейтинг изменился
+    не менее RANKING_TOP_CHANGES_THRESHOLD раз.
+
+    Параметры:
+        scope_key (str): Ключ рейтинга (см. get_scope_key)
+        period (str): Период рейтинга
+        count (int): Количество товаров
+    Возвращает:
+        - Пару (список товаров или None, если его нужно построить заново; текущий счетчик изменений рейтинга)
+    """
+    cached, changes = redis_db.mget(RANKING_TOP_KEY.format(scope_key, period, count),
+                                    RANKING_CHANGES_KEY.format(scope_key))
+    changes = int(changes or 0)
+    if cached is None:
+        return None, changes
+    record = pickle.loads(cached)
+    if changes - record['changes'] >= RANKING_TOP_CHANGES_THRESHOLD:
+        return None, changes
+    return record['data'], changes
+
+
+def set_cached_top(scope_key: str, period: str, count: int, data: list, changes: int) -> None:
+    """
+    Функция кэширует сериализованный список самых популярных товаров на RANKING_TOP_TIMEOUT секунд
+
+    Параметры:
+        scope_key (str): Ключ рейтинга (см. get_scope_key)
+        period (str): Период рейтинга
+        count (int): Количество товаров
+        data (list): Сериализованные товары
+        changes (int): Счетчик изменений рейтинга на момент построения списка
+    """
+    record = {'data': data, 'changes': changes}
+    redis_db.set(RANKING_TOP_KEY.format(scope_key, period, count), pickle.dumps(record, pickle.HIGHEST_PROTOCOL),
+                 ex=RANKING_TOP_TIMEOUT)
+
+
+def _write_rebuild_rows(rows, tmp_prefix: str, rebuilt_keys: dict, batch_size: int, get_keys) -> int:
+    """
+    Функция записывает агрегированные позиции заказов во временные ключи рейтинга пачками по batch_size строк.
+
+    Параметры:
+        rows: Итератор строк (id товара, id категории, id магазина, количество[, час заказа])
+        tmp_prefix (str): Префикс временных ключей
+        rebuilt_keys (dict): Словарь ключ рейтинга -> время жизни в секундах (None - бессрочно), дополняется
+        batch_size (int): Количество строк в одном конвейере запросов к Redis
+        get_keys: Функция, возвращающая пары (ключ, время жизни) для ключа рейтинга и часа заказа строки
+    Возвращает:
+        int: Количество обработанных строк
+    """
+    count = 0
+    with redis_db.pipeline(transaction=False) as pipe:
+        for product_id, category_id, shop_id, quantity, *hour in rows:
+            for scope_key in get_scope_keys(category_id, shop_id):
+                for key, timeout in get_keys(scope_key, *hour):
+                    pipe.zincrby(tmp_prefix + key, quantity, product_id)
+                    if key not in rebuilt_keys:
+                        rebuilt_keys[key] = timeout
+                        pipe.expire(tmp_prefix + key, RANKING_REBUILD_TIMEOUT)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+    return count
+
+
+def rebuild_ranking(batch_size: int = RANKING_REBUILD_BATCH_SIZE) -> int:
+    """
+    Функция заново строит все рейтинги товаров по позициям оформленных заказов.
+    Количество товаров суммируется в БД, результат читается курсором на стороне сервера пачками
+    и записывается во временные ключи, которые затем одной транзакцией переименовываются (RENAME)
+    в рабочие. Производные ключи (периоды, кэш популярных товаров) и рейтинги, для которых
+    не осталось заказов, удаляются в той же транзакции.
+    Временем заказа для часовых и суточных корзин считается время создания заказа.
+
+    Параметры:
+        batch_size (int): Количество строк в одной пачке
+    Возвращает:
+        int: Количество обработанных строк
+    """
+    now = timezone.now()
+    tmp_prefix = RANKING_REBUILD_PREFIX.format(uuid.uuid4().hex)
+    rebuilt_keys = {}
+    items = OrderItem.objects.exclude(order__state=OrderStateChoices.PREPARING).order_by()
+    fields = ('product_item__product_id', 'product_item__product__category_id', 'product_item__shop_id')
+
+    rows = items.values(*fields).annotate(total=Sum('quantity')).values_list(*fields, 'total')
+    count = _write_rebuild_rows(rows.iterator(chunk_size=batch_size), tmp_prefix, rebuilt_keys, batch_size,
+                                lambda scope_key: ((scope_key, None),))
+
+    def get_bucket_keys_for_row(scope_key, hour):
+        hour_timeout = hour + datetime.timedelta(hours=1, seconds=RANKING_HOUR_TIMEOUT) - now
+        day = hour.replace(hour=0)
+        day_timeout = day + datetime.timedelta(days=1, seconds=RANKING_DAY_TIMEOUT) - now
+        keys = [(RANKING_DAY_KEY.format(scope_key, day), int(day_timeout.total_seconds()))]
+        if hour_timeout.total_seconds() > 0:
+            keys.append((RANKING_HOUR_KEY.format(scope_key, hour), int(hour_timeout.total_seconds())))
+        return keys
+
+    since = (now - datetime.timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+    rows = (items.filter(order__created_at__gte=since)
+            .annotate(hour=TruncHour('order__created_at', tzinfo=datetime.timezone.utc))
+            .values(*fields, 'hour').annotate(total=Sum('quantity')).values_list(*fields, 'total', 'hour'))
+    count += _write_rebuild_rows(rows.iterator(chunk_size=batch_size), tmp_prefix, rebuilt_keys, batch_size,
+                                 get_bucket_keys_for_row)
+
+    stale_keys = {key.decode() for key in redis_db.scan_iter(RANKING_KEY + '*')} - set(rebuilt_keys)
+    with redis_db.pipeline() as pipe:
+        for key in stale_keys:
+            if not key.endswith(RANKING_CHANGES_KEY.format('')):
+                pipe.delete(key)
+        for key, timeout in rebuilt_keys.items():
+            pipe.rename(tmp_prefix + key, key)
+            if timeout is None:
+                pipe.persist(key)
+            else:
+                pipe.expire(key, timeout)
+        pipe.execute()
+    return count
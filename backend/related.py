@@ -0,0 +1,116 @@
+import itertools
+import uuid
+from .models import OrderItem, OrderStateChoices
+from .ranking import redis_db, RANKING_REBUILD_PREFIX, RANKING_REBUILD_TIMEOUT
+
+
+RELATED_KEY = 'product_related:{}'
+RELATED_MAX_SIZE = 100
+RELATED_ORDER_MAX_PRODUCTS = 50
+RELATED_REBUILD_BATCH_SIZE = 1000
+
+
+def _add_order_products(pipe, product_ids, key_prefix: str = '') -> list[str]:
+    """
+    Функция добавляет в конвейер запросов увеличение счетчиков совместных покупок для всех пар товаров заказа.
+    Учитываются не более RELATED_ORDER_MAX_PRODUCTS различных товаров заказа.
+
+    Возвращает:
+        list[str]: Ключи измененных множеств (без префикса)
+    """
+    product_ids = list(dict.fromkeys(product_ids))[:RELATED_ORDER_MAX_PRODUCTS]
+    if len(product_ids) < 2:
+        return []
+    keys = []
+    for product_id in product_ids:
+        key = RELATED_KEY.format(product_id)
+        for related_id in product_ids:
+            if related_id != product_id:
+                pipe.zincrby(key_prefix + key, 1, related_id)
+        keys.append(key)
+    return keys
+
+
+def add_to_related(product_ids: list[int]) -> None:
+    """
+    Функция обновляет индекс совместных покупок по товарам оформленного заказа.
+    Для каждого товара в Redis хранится отсортированное множество товаров, купленных вместе с ним,
+    со счетчиком заказов в качестве рейтинга. Все изменения отправляются одним конвейером запросов.
+
+    Параметры:
+        product_ids (list[int]): Идентификаторы товаров заказа
+    """
+    with redis_db.pipeline(transaction=False) as pipe:
+        _add_order_products(pipe, product_ids)
+        pipe.execute()
+
+
+def get_related_product_ids(product_id: int, count: int) -> list[int]:
+    """
+    Функция возвращает идентификаторы товаров, которые чаще всего покупают вместе с товаром
+
+    Параметры:
+        product_id (int): Идентификатор товара
+        count (int): Количество товаров
+    """
+    return [int(related_id) for related_id in redis_db.zrevrange(RELATED_KEY.format(product_id), 0, count - 1)]
+
+
+def prune_related(max_size: int = RELATED_MAX_SIZE) -> int:
+    """
+    Функция оставляет в каждом множестве совместных покупок только max_size товаров с наибольшим рейтингом
+
+    Параметры:
+        max_size (int): Количество хранимых товаров
+    Возвращает:
+        int: Количество обработанных множеств
+    """
+    count = 0
+    with redis_db.pipeline(transaction=False) as pipe:
+        for key in redis_db.scan_iter(RELATED_KEY.format('*'), count=RELATED_REBUILD_BATCH_SIZE):
+            pipe.zremrangebyrank(key, 0, -max_size - 1)
+            count += 1
+            if count % RELATED_REBUILD_BATCH_SIZE == 0:
+                pipe.execute()
+        pipe.execute()
+    return count
+
+
+def rebuild_related(batch_size: int = RELATED_REBUILD_BATCH_SIZE) -> int:
+    """
+    Функция заново строит индекс совместных покупок по истории оформленных заказов.
+    Позиции заказов читаются курсором на стороне сервера в порядке заказов, счетчики записываются
+    во временные ключи пачками по batch_size заказов, после чего временные ключи одной транзакцией
+    переименовываются (RENAME) в рабочие и сокращаются до RELATED_MAX_SIZE товаров.
+
+    Параметры:
+        batch_size (int): Количество заказов в одной пачке
+    Возвращает:
+        int: Количество обработанных заказов
+    """
+    tmp_prefix = RANKING_REBUILD_PREFIX.format(uuid.uuid4().hex)
+    rebuilt_keys = set()
+    rows = (OrderItem.objects.exclude(order__state=OrderStateChoices.PREPARING)
+            .order_by('order_id').values_list('order_id', 'product_item__product_id'))
+    count = 0
+    with redis_db.pipeline(transaction=False) as pipe:
+        for _, order_rows in itertools.groupby(rows.iterator(chunk_size=batch_size * 10), key=lambda row: row[0]):
+            for key in _add_order_products(pipe, [product_id for _, product_id in order_rows], tmp_prefix):
+                if key not in rebuilt_keys:
+                    rebuilt_keys.add(key)
+                    pipe.expire(tmp_prefix + key, RANKING_REBUILD_TIMEOUT)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+
+    stale_keys = {key.decode() for key in redis_db.scan_iter(RELATED_KEY.format('*'))} - rebuilt_keys
+    with redis_db.pipeline() as pipe:
+        for key in stale_keys:
+            pipe.delete(key)
+        for key in rebuilt_keys:
+            pipe.rename(tmp_prefix + key, key)
+            pipe.persist(key)
+            pipe.zremrangebyrank(key, 0, -RELATED_MAX_SIZE - 1)
+        pipe.execute()
+    return count
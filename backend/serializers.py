@@ -1,9 +1,11 @@
 from decimal import Decimal
 from django.utils import timezone
 from backend.models import ProductItem, Contact, Order, OrderItem, Property, ProductProperty, OrderStateChoices
-from backend.models import User, Shop, Category, Product, Coupon
+from backend.models import User, Shop, Category, Product, Coupon, ShopOrder
 from rest_framework import serializers
 from easy_thumbnails.files import get_thumbnailer
+from backend.fieldsets import SparseFieldsetMixin
+from backend.pagination import ORDERS_PAGE_SIZE, ORDERS_MAX_PAGE_SIZE, decode_cursor
 
 
 
@@ -111,7 +113,7 @@ class ProductPropertySerializer(serializers.ModelSerializer):
         fields = ['property', 'value']
 
 
-class ProductItemSerializer(serializers.ModelSerializer):
+class ProductItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_properties = ProductPropertySerializer(many=True, read_only=True)
 
@@ -142,6 +144,11 @@ class ProductItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Цена не может быть отрицательной")
 
 
+class ProductItemBatchSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=0, allow_null=False),
+                                allow_empty=False, max_length=300)
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -171,11 +178,15 @@ class OrderItemDeleteSerializer(serializers.Serializer):
 class OrderItemCreateSerializer(OrderItemSerializer):
     product_item = ProductItemSerializer(read_only=True)
 
+    class Meta(OrderItemSerializer.Meta):
+        fields = OrderItemSerializer.Meta.fields + ['price']
+        read_only_fields = ['id', 'price']
 
-class OrderSerializer(serializers.ModelSerializer):
+
+class OrderSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     ordered_items = OrderItemCreateSerializer(many=True, read_only=True)
     contact = ContactSerializer(read_only=True)
-    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True, min_value=Decimal('0.00'))
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True, min_value=Decimal('0.00'))
 
     class Meta:
         model = Order
@@ -183,13 +194,43 @@ class OrderSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
 
+class ShopOrderSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ShopOrder
+        fields = ['id', 'shop', 'state', 'subtotal', 'total']
+        read_only_fields = ['id', 'shop', 'state', 'subtotal', 'total']
+
+
+class SellerOrderSerializer(OrderSerializer):
+    shop_order = ShopOrderSerializer(read_only=True)
+
+    class Meta(OrderSerializer.Meta):
+        fields = OrderSerializer.Meta.fields + ['shop_order']
+
+
 class OrderStateSerializer(serializers.Serializer):
     id = serializers.IntegerField(min_value=0, allow_null=False)
     state = serializers.ChoiceField(choices=OrderStateChoices.choices)
 
 
+class OrderHistoryFilterSerializer(serializers.Serializer):
+    state = serializers.ChoiceField(choices=OrderStateChoices.choices, required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    cursor = serializers.CharField(max_length=200, required=False)
+    page_size = serializers.IntegerField(min_value=1, max_value=ORDERS_MAX_PAGE_SIZE, default=ORDERS_PAGE_SIZE)
+
+    def validate_cursor(self, value):
+        try:
+            decode_cursor(value)
+        except ValueError as err:
+            raise serializers.ValidationError(str(err))
+        return value
+
+
 class OrderConfirmSerializer(serializers.Serializer):
-    id = serializers.IntegerField(min_value=0, allow_null=False)
+    id = serializers.IntegerField(min_value=0, allow_null=False, required=False)
     contact = serializers.IntegerField(min_value=0, allow_null=False)
     coupon_code = serializers.CharField(max_length=60, required=False, allow_null=True)
 
@@ -1,15 +1,20 @@
 from typing import Type
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
-from backend.models import User, EmailTokenConfirm, OrderStateChoices
+from cacheops.signals import cache_invalidated
+from backend.models import User, EmailTokenConfirm, OrderStateChoices, ProductItem, ProductProperty, Product, Category, \
+    Shop, Property
+from .cache import bump_version, invalidate_reference, reference_cache, invalidate_product_items
+from .outbox import enqueue
 from .tasks import send_email
 
 FROM_EMAIL = settings.EMAIL_HOST_USER
 
 new_user_registered = Signal()
 new_order = Signal()
+orders_state_changed = Signal()
 
 
 @receiver(reset_password_token_created)
@@ -37,29 +42,84 @@ def new_user_registered_signal(sender: Type[User], instance: User, created: bool
 
 
 @receiver(new_order)
-def new_order_signal(user_id, order_id, order_state, report_file=None, **kwargs):
-    """
-    Сигнал для отправки уведомления о статусе заказа
-    """
-    user = User.objects.get(pk=user_id)
-    if user is not None:
-        subject = "Обновление статуса заказа"
-        to_email = [user.email]
-        body = f"Ваш заказ #{order_id}"
-        if order_state == OrderStateChoices.CREATED:
-            body = f"Ваш заказ #{order_id} сформирован"
-        if order_state == OrderStateChoices.CONFIRMED:
-            body = f"Ваш заказ #{order_id} подтвержден. Спасибо за покупку!"
-        if order_state == OrderStateChoices.ASSEMBLED:
-            body = f"Ваш заказ #{order_id} собран"
-        if order_state == OrderStateChoices.DELIVERED:
-            body = f"Ваш заказ #{order_id} доставлен"
-        if order_state == OrderStateChoices.CANCELED:
-            body = f"Ваш заказ #{order_id} отменен"
-        if report_file is not None:
-            send_email.delay(subject, body, FROM_EMAIL, to_email, report_file)
-        else:
-            send_email.delay(subject, body, FROM_EMAIL, to_email)
+def new_order_signal(user_id, order_id, order_state, **kwargs):
+    """
+    Сигнал для отправки уведомления о статусе заказа.
+    Задачи Celery записываются в исходящую очередь в той же транзакции, что и изменение заказа,
+    и передаются в Celery после ее фиксации. Задачи получают только идентификаторы.
+    Для нового заказа сначала генерируется отчет в формате pdf, затем отправляется письмо с отчетом.
+    """
+    if order_state == OrderStateChoices.CREATED:
+        tasks = [('backend.tasks.generate_order_report', [order_id]),
+                 ('backend.tasks.send_order_notification', [user_id, order_id, order_state])]
+    else:
+        tasks = [('backend.tasks.send_order_notification', [None, user_id, order_id, order_state])]
+    enqueue(tasks, dedup_key=f"order:{order_id}:{order_state}")
+
+
+@receiver(orders_state_changed)
+def orders_state_changed_signal(orders: list[tuple[int, int, str]], **kwargs):
+    """
+    Сигнал для отправки уведомлений об изменении состояния нескольких заказов.
+    Одна задача Celery на все заказы записывается в исходящую очередь в той же транзакции.
+
+    Параметры:
+        orders (list[tuple[int, int, str]]): Список (id покупателя, id заказа, новое состояние)
+    """
+    if orders:
+        enqueue([('backend.tasks.send_order_state_emails', [[list(order) for order in orders], FROM_EMAIL])])
+
+
+@receiver(cache_invalidated)
+def cache_invalidated_signal(sender, obj_dict, **kwargs):
+    """
+    Сигнал для пометки устаревшими значений, закэшированных с защитой от cache stampede,
+    и сброса справочных данных во внутрипроцессных кэшах
+    """
+    if sender is None:
+        reference_cache.invalidate()
+        return
+    bump_version(sender._meta.db_table)
+    invalidate_reference(sender._meta.db_table)
+
+
+@receiver([post_save, post_delete], sender=ProductItem)
+def product_item_changed_signal(sender, instance: ProductItem, **kwargs):
+    """
+    Сигнал для удаления измененного товара из кэша
+    """
+    invalidate_product_items([instance.id])
+
+
+@receiver([post_save, post_delete], sender=ProductProperty)
+def product_property_changed_signal(sender, instance: ProductProperty, **kwargs):
+    """
+    Сигнал для удаления из кэша товара, свойства которого изменились
+    """
+    invalidate_product_items([instance.product_item_id])
+
+
+_PRODUCT_ITEM_LOOKUPS = {
+    Product: 'product_id',
+    Category: 'product__category_id',
+    Shop: 'shop_id',
+    Property: 'product_properties__property_id',
+}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Property)
+def product_item_relation_changed_signal(sender, instance, **kwargs):
+    """
+    Сигнал для удаления из кэша товаров, вложенные данные которых (продукт, категория, магазин, свойство)
+    изменились. При удалении этих объектов товары и их свойства удаляются каскадно, и кэш очищается
+    сигналами удаления ProductItem и ProductProperty.
+    """
+    item_ids = (ProductItem.objects.nocache().filter(**{_PRODUCT_ITEM_LOOKUPS[sender]: instance.pk})
+                .values_list('id', flat=True).distinct())
+    invalidate_product_items(list(item_ids))
 
 
 # @receiver(saved_file)
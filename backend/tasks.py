@@ -4,9 +4,29 @@ from typing import Any
 from django.db import IntegrityError
 import yaml
 from celery import shared_task
-from django.core.mail import EmailMultiAlternatives
-from backend.models import Category, Product, ProductItem, Property, ProductProperty
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from backend.models import Category, Product, ProductItem, Property, ProductProperty, Order, User
+from backend.order import create_order_report, get_mail_attachment, get_order_state_message
 from backend.serializers import ShopGoodsImportSerializer
+from backend.cache import reference_cached
+from backend.ranking import rebuild_ranking, RANKING_REBUILD_BATCH_SIZE
+from backend.related import rebuild_related, prune_related, RELATED_REBUILD_BATCH_SIZE
+from backend.cart import flush_carts, is_redis_cart
+from backend.outbox import relay_outbox, purge_outbox, OUTBOX_BATCH_SIZE
+
+
+@reference_cached(Property)
+def get_property_id(name: str) -> int:
+    """
+    Функция возвращает идентификатор свойства товара по его названию, создавая свойство при необходимости.
+    Результат кэшируется во внутрипроцессном кэше справочных данных.
+
+    Параметры:
+        - name (str): Название свойства
+    """
+    property_instance, _ = Property.objects.get_or_create(name=name)
+    return property_instance.id
 
 
 @shared_task
@@ -29,6 +49,64 @@ def send_email(subject: str, message: str, from_email: str, to_email: list[str],
     msg.send()
 
 
+@shared_task
+def generate_order_report(order_id: int) -> str | None:
+    """
+    Задача Celery для генерации отчета о заказе в формате pdf
+
+    Параметры:
+        - order_id (int): Идентификатор заказа
+    Возвращает:
+        - Путь к файлу отчета или None, если создать отчет не удалось
+    """
+    order = (Order.objects.select_related('coupon')
+             .prefetch_related('ordered_items__product_item__product').filter(id=order_id).first())
+    if order is None:
+        return None
+    return create_order_report(order)
+
+
+@shared_task
+def send_order_notification(report_path: str | None, user_id: int, order_id: int, order_state: str):
+    """
+    Задача Celery для отправки уведомления об изменении состояния заказа.
+    Для нового заказа выполняется после generate_order_report и получает путь к файлу отчета, а не его содержимое.
+
+    Параметры:
+        - report_path (str | None): Путь к файлу отчета
+        - user_id (int): Идентификатор покупателя
+        - order_id (int): Идентификатор заказа
+        - order_state (str): Новое состояние заказа
+    """
+    email = User.objects.filter(id=user_id).values_list('email', flat=True).first()
+    if email is None:
+        return
+    subject, message = get_order_state_message(order_id, order_state)
+    attachment = get_mail_attachment(report_path) if report_path else None
+    send_email(subject, message, settings.EMAIL_HOST_USER, [email], attachment)
+
+
+@shared_task
+def send_order_state_emails(orders: list[list], from_email: str):
+    """
+    Задача Celery для отправки уведомлений об изменении состояния нескольких заказов.
+    Адреса покупателей загружаются одним запросом, письма отправляются через одно соединение с почтовым сервером.
+
+    Параметры:
+        - orders (list[list]): Список [id покупателя, id заказа, новое состояние]
+        - from_email (str): Адрес отправителя
+    """
+    emails = dict(User.objects.filter(id__in={user_id for user_id, _, _ in orders}).values_list('id', 'email'))
+    messages = []
+    for user_id, order_id, order_state in orders:
+        if user_id in emails:
+            subject, body = get_order_state_message(order_id, order_state)
+            messages.append(EmailMultiAlternatives(subject=subject, body=body, from_email=from_email,
+                                                   to=[emails[user_id]]))
+    with get_connection() as connection:
+        connection.send_messages(messages)
+
+
 @shared_task
 def import_goods(url: str, shop_id: int, user_id: int):
     """
@@ -69,10 +147,9 @@ def import_goods(url: str, shop_id: int, user_id: int):
                 quantity=item['quantity']
             )
             for key, value in item['properties'].items():
-                property_instance, _ = Property.objects.get_or_create(name=key)
                 ProductProperty.objects.create(
                     product_item_id=product_item.id,
-                    property_id=property_instance.id,
+                    property_id=get_property_id(key),
                     value=value
                 )
         except IntegrityError as err:
@@ -80,6 +157,46 @@ def import_goods(url: str, shop_id: int, user_id: int):
     return {'success': True}
 
 
+@shared_task
+def rebuild_product_ranking(batch_size: int = RANKING_REBUILD_BATCH_SIZE):
+    """
+    Задача Celery для восстановления рейтингов популярности товаров по истории заказов
+
+    Параметры:
+        - batch_size (int): Количество строк в одной пачке
+    """
+    return {'success': True, 'rows': rebuild_ranking(batch_size)}
+
+
+@shared_task
+def rebuild_related_products(batch_size: int = RELATED_REBUILD_BATCH_SIZE):
+    """
+    Задача Celery для восстановления индекса совместных покупок товаров по истории заказов
+
+    Параметры:
+        - batch_size (int): Количество заказов в одной пачке
+    """
+    return {'success': True, 'orders': rebuild_related(batch_size)}
+
+
+@shared_task
+def prune_related_products():
+    """
+    Периодическая задача Celery для сокращения индекса совместных покупок до наиболее частых товаров
+    """
+    return {'success': True, 'keys': prune_related()}
+
+
+@shared_task
+def flush_shopping_carts():
+    """
+    Периодическая задача Celery для сохранения в БД корзин покупателей, измененных в Redis
+    """
+    if not is_redis_cart():
+        return {'success': True, 'carts': 0}
+    return {'success': True, 'carts': flush_carts()}
+
+
 # @shared_task
 # def generate_thumbnails(model_name, pk, field):
 #     try:
@@ -91,3 +208,23 @@ def import_goods(url: str, shop_id: int, user_id: int):
 #         return f"Invalid image format for {model_name}"
 #     except Exception as err:
 #         return f"Error generating thumbnails: {str(err)}"
+
+
+@shared_task
+def relay_outbox_messages(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Задача Celery для передачи в Celery сообщений исходящей очереди и удаления давно отправленных сообщений.
+    Запускается периодически (Celery beat).
+
+    Параметры:
+        - batch_size (int): Количество сообщений в пачке
+    Возвращает:
+        - Количество отправленных сообщений
+    """
+    count = 0
+    while sent := relay_outbox(batch_size):
+        count += sent
+        if sent < batch_size:
+            break
+    purge_outbox()
+    return count
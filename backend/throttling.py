@@ -0,0 +1,76 @@
+import time
+import uuid
+from redis.exceptions import RedisError
+from rest_framework.throttling import SimpleRateThrottle, UserRateThrottle, AnonRateThrottle, ScopedRateThrottle
+from cacheops.redis import redis_client
+
+
+_sliding_window_script = redis_client.register_script("""
+    local now = tonumber(ARGV[1])
+    local window = tonumber(ARGV[2])
+    local limit = tonumber(ARGV[3])
+    redis.call('zremrangebyscore', KEYS[1], '-inf', now - window)
+    if redis.call('zcard', KEYS[1]) < limit then
+        redis.call('zadd', KEYS[1], now, ARGV[4])
+        redis.call('pexpire', KEYS[1], window)
+        return {1, 0}
+    end
+    local oldest = redis.call('zrange', KEYS[1], 0, 0, 'withscores')
+    return {0, tonumber(oldest[2]) + window - now}
+""")
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    Базовый класс ограничения частоты запросов по скользящему окну.
+    Счетчики хранятся в Redis в отсортированных множествах и общие для всех воркеров,
+    проверка и учет запроса выполняются атомарно одним Lua-скриптом (один запрос к Redis).
+    При недоступности Redis запросы не ограничиваются.
+    """
+    wait_time = None
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        now_ms = int(time.time() * 1000)
+        try:
+            allowed, wait_ms = _sliding_window_script(
+                keys=[self.key], args=[now_ms, self.duration * 1000, self.num_requests, uuid.uuid4().hex])
+        except RedisError:
+            return True
+        self.wait_time = int(wait_ms) / 1000
+        return bool(allowed)
+
+    def wait(self):
+        return self.wait_time
+
+
+class UserSlidingWindowThrottle(SlidingWindowRateThrottle, UserRateThrottle):
+    """
+    Ограничение частоты запросов для пользователей (scope 'user')
+    """
+
+
+class AnonSlidingWindowThrottle(SlidingWindowRateThrottle, AnonRateThrottle):
+    """
+    Ограничение частоты запросов для анонимных пользователей (scope 'anon')
+    """
+
+
+class ScopedSlidingWindowThrottle(SlidingWindowRateThrottle, ScopedRateThrottle):
+    """
+    Ограничение частоты запросов для отдельных endpoints.
+    Scope берется из атрибута представления throttle_scopes (словарь HTTP-метод -> scope),
+    а если для метода он не задан - из атрибута throttle_scope.
+    """
+
+    def allow_request(self, request, view):
+        self.scope = getattr(view, 'throttle_scopes', {}).get(request.method, getattr(view, self.scope_attr, None))
+        if not self.scope:
+            return True
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().allow_request(request, view)
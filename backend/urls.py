@@ -2,7 +2,8 @@ from django.urls import path
 from backend.views import AccountRegisterView, AccountConfirmView, AccountView, SellerGoodsView, \
     CategoriesView, ShopsView, ProductItemView, ShoppingCartView, SellerStatusView, SellerOrdersView, \
     ContactView, BuyerOrdersView, CouponView, SellerShopView, PopularProductsView, ManagerOrdersView, \
-    TokenObtain, TokenRefresh, AccountResetPasswordView, AccountResetPasswordConfirmView, SellerProductsView
+    TokenObtain, TokenRefresh, AccountResetPasswordView, AccountResetPasswordConfirmView, SellerProductsView, \
+    ProductItemBatchView, RelatedProductsView
 
 app_name = 'backend'
 
@@ -23,8 +24,10 @@ urlpatterns = [
     path('seller/shop', SellerShopView.as_view(), name='seller-shop'),
     path('shops', ShopsView.as_view(), name='shops'),
     path('products', ProductItemView.as_view(), name='products'),
+    path('products/batch', ProductItemBatchView.as_view(), name='products-batch'),
     path('products/categories', CategoriesView.as_view(), name='product-categories'),
     path('products/popular', PopularProductsView.as_view(), name='popular-products'),
+    path('products/<int:product_id>/related', RelatedProductsView.as_view(), name='related-products'),
     path('buyer/shoppingcart', ShoppingCartView.as_view(), name='shoppingcart'),
     path('buyer/orders', BuyerOrdersView.as_view(), name='orders'),
     path('manager/orders', ManagerOrdersView.as_view(), name='manager-orders'),
@@ -3,19 +3,26 @@ from django.shortcuts import render
 from drf_spectacular.utils import extend_schema
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from rest_framework import status as http_status
 from rest_framework.views import APIView
 from rest_framework.request import Request
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django_rest_passwordreset.views import ResetPasswordRequestToken, ResetPasswordConfirm
-from .backend import UserBackend, ProductsBackend, SellerBackend, BuyerBackend, ContactBackend, ManagerBackend
+from .backend import UserBackend, ProductsBackend, SellerBackend, BuyerBackend, ContactBackend, ManagerBackend, \
+    with_product_item_relations, get_cart_backend
+from .fieldsets import get_fieldset_params
 from .filters import ProductItemFilter
+from .idempotency import idempotent
 from .models import Shop, Category, ProductItem
 from .permissions import IsSeller, IsBuyer
+from .ranking import RANKING_PERIODS, RANKING_PERIOD_ALL
+from .related import RELATED_MAX_SIZE
+from .throttling import ScopedSlidingWindowThrottle
 from .serializers import CategorySerializer, ShopSerializer, ProductItemSerializer
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
 from .api_config import APIConfig
-from cacheops import cached_as
+from .cache import stampede_cached_as, reference_cached
 
 
 class AccountRegisterView(APIView):
@@ -124,9 +131,10 @@ class CategoriesView(ListAPIView):
 
     @extend_schema(**APIConfig.get_category_config())
     def get(self, request, *args, **kwargs):
-        response = super(CategoriesView, self).get(request, *args, **kwargs)
-        categories = response.data
-        return JsonResponse(categories)
+        @reference_cached(Category, extra=request.get_full_path())
+        def get_categories():
+            return super(CategoriesView, self).get(request, *args, **kwargs).data
+        return JsonResponse(get_categories())
 
 
 class ShopsView(ListAPIView):
@@ -147,10 +155,12 @@ class ShopsView(ListAPIView):
     def get(self, request, *args, **kwargs):
         """
         Переопределение метода получения списка магазинов
-        Метод использует кэширование результатов запроса
+        Метод использует двухуровневое кэширование результатов запроса
         """
-        shops = super().get(request, *args, **kwargs).data
-        return JsonResponse(shops)
+        @reference_cached(Shop, extra=request.get_full_path())
+        def get_shops():
+            return super(ShopsView, self).get(request, *args, **kwargs).data
+        return JsonResponse(get_shops())
 
 
 class SellerShopView(APIView):
@@ -171,13 +181,23 @@ class ProductItemView(ListAPIView):
     Доступны фильтры, поиск и сортировка, указанные в GET-параметрах запроса
     """
     permission_classes = (AllowAny,)
+    throttle_classes = (ScopedSlidingWindowThrottle,)
+    throttle_scope = 'products'
 
     serializer_class = ProductItemSerializer
-    queryset = ProductItem.objects.filter(shop__is_active=True, quantity__gt=0).select_related(
-                'shop', 'product').distinct()
+    queryset = ProductItem.objects.filter(shop__is_active=True, quantity__gt=0).distinct()
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     filterset_class = ProductItemFilter
 
+    def get_queryset(self):
+        """
+        Запрос товаров со связями, необходимыми только для запрошенных полей (GET-параметры fields и expand)
+        """
+        return with_product_item_relations(super().get_queryset(), **get_fieldset_params(self.request))
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), **get_fieldset_params(self.request)}
+
     @extend_schema(**APIConfig.get_products_config())
     def get(self, request, *args, **kwargs):
         response = super(ProductItemView, self).get(request, *args, **kwargs)
@@ -185,6 +205,23 @@ class ProductItemView(ListAPIView):
         return JsonResponse(products)
 
 
+class ProductItemBatchView(APIView):
+    """
+    Представление для получения списка товаров по их идентификаторам
+    """
+    permission_classes = (AllowAny,)
+    throttle_classes = (ScopedSlidingWindowThrottle,)
+    throttle_scope = 'products'
+
+    @extend_schema(**APIConfig.get_products_batch_config())
+    def get(self, request, *args, **kwargs):
+        """
+        Получение товаров по идентификаторам
+        Параметр ids - идентификаторы товаров через запятую
+        """
+        return ProductsBackend.get_products_batch(request)
+
+
 class ShoppingCartView(APIView):
     """
     Представление для работы с корзиной покупателя
@@ -197,28 +234,29 @@ class ShoppingCartView(APIView):
         """
         Получение списка товаров в корзине
         """
-        return BuyerBackend.get_shopping_cart(request)
+        return get_cart_backend().get_shopping_cart(request)
 
     @extend_schema(**APIConfig.create_shopping_cart_config())
+    @idempotent
     def post(self, request, *args, **kwargs):
         """
         Добавление товара в корзину
         """
-        return BuyerBackend.create_update_shopping_cart(request)
+        return get_cart_backend().create_update_shopping_cart(request)
 
     @extend_schema(**APIConfig.update_shopping_cart_config())
     def put(self, request, *args, **kwargs):
         """
         Обновление количества товара в корзине
         """
-        return BuyerBackend.update_shopping_cart(request)
+        return get_cart_backend().update_shopping_cart(request)
 
     @extend_schema(**APIConfig.delete_shopping_cart_config())
     def delete(self, request, *args, **kwargs):
         """
         Удаление товара из корзины
         """
-        return BuyerBackend.delete_shopping_cart_items(request)
+        return get_cart_backend().delete_shopping_cart_items(request)
 
 
 class SellerStatusView(APIView):
@@ -233,7 +271,7 @@ class SellerStatusView(APIView):
         """
         Получение статуса продавца
         """
-        @cached_as(Shop.objects.filter(user_id=request.user.id), timeout=60*30)
+        @stampede_cached_as(Shop.objects.filter(user_id=request.user.id), timeout=60*30, extra=request.user.id)
         def get_status():
             return SellerBackend.get_status(request)
         return get_status()
@@ -248,7 +286,7 @@ class SellerStatusView(APIView):
 
 class SellerOrdersView(APIView):
     """
-    Представление для получения списка заказов поступивших продавцу
+    Представление для получения списка заказов поступивших продавцу и изменения состояния заказов магазина
     Доступно только для авторизованного продавца
     """
     permission_classes = (IsAuthenticated, IsSeller)
@@ -257,6 +295,10 @@ class SellerOrdersView(APIView):
     def get(self, request, *args, **kwargs):
         return SellerBackend.get_orders(request)
 
+    @extend_schema(**APIConfig.update_seller_order_config())
+    def put(self, request, *args, **kwargs):
+        return SellerBackend.change_order_state(request, sender=self.__class__)
+
 
 class SellerProductsView(APIView):
     """
@@ -313,6 +355,8 @@ class BuyerOrdersView(APIView):
     Доступно только для авторизованного покупателя
     """
     permission_classes = (IsAuthenticated, IsBuyer)
+    throttle_classes = (*APIView.throttle_classes, ScopedSlidingWindowThrottle)
+    throttle_scopes = {'POST': 'buyer_orders_create'}
 
     @extend_schema(**APIConfig.get_buyer_orders())
     def get(self, request, *args, **kwargs):
@@ -322,6 +366,7 @@ class BuyerOrdersView(APIView):
         return BuyerBackend.get_orders(request)
 
     @extend_schema(**APIConfig.confirm_buyer_order_config())
+    @idempotent
     def post(self, request, *args, **kwargs):
         """
         Подтверждение заказа
@@ -383,7 +428,7 @@ class ManagerOrdersView(APIView):
     @extend_schema(**APIConfig.update_manager_order_config())
     def put(self, request, *args, **kwargs):
         """
-        Изменение статуса заказа
+        Изменение статуса одного или нескольких заказов
         """
         return ManagerBackend.change_orders_state(request, sender=self.__class__)
 
@@ -399,12 +444,47 @@ class PopularProductsView(APIView):
         """
         Получение списка наиболее популярных товаров
         Параметр amount - количество популярных товаров, которое нужно получить
-        """
+        Параметр period - период рейтинга: 24h, 7d или all (по умолчанию)
+        Параметры category_id/shop_id - рейтинг товаров категории/магазина
+        """
+        period = request.GET.get('period', RANKING_PERIOD_ALL)
+        if period not in RANKING_PERIODS:
+            return JsonResponse({'success': False, 'error': f'Period must be one of: {", ".join(RANKING_PERIODS)}'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        category_id = request.GET.get('category_id')
+        shop_id = request.GET.get('shop_id')
+        if category_id and shop_id:
+            return JsonResponse({'success': False, 'error': 'Only one of category_id and shop_id can be specified'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        if any(scope_id and not scope_id.isdigit() for scope_id in (category_id, shop_id)):
+            return JsonResponse({'success': False, 'error': 'category_id and shop_id must be integers'},
+                                status=http_status.HTTP_400_BAD_REQUEST)
+        category_id = int(category_id) if category_id else None
+        shop_id = int(shop_id) if shop_id else None
         amount = request.GET.get('amount')
         if amount and amount.isdigit() and int(amount) > 0:
-            return ProductsBackend.get_product_ranking(int(amount))
+            return ProductsBackend.get_product_ranking(int(amount), period, category_id, shop_id)
+        else:
+            return ProductsBackend.get_product_ranking(5, period, category_id, shop_id)
+
+
+class RelatedProductsView(APIView):
+    """
+    Представление для получения списка товаров, которые покупают вместе с товаром
+    """
+    permission_classes = (AllowAny,)
+
+    @extend_schema(**APIConfig.get_related_products_config())
+    def get(self, request, product_id: int, *args, **kwargs):
+        """
+        Получение списка товаров, которые покупают вместе с товаром
+        Параметр amount - количество товаров, которое нужно получить
+        """
+        amount = request.GET.get('amount')
+        if amount and amount.isdigit() and 0 < int(amount) <= RELATED_MAX_SIZE:
+            return ProductsBackend.get_related_products(product_id, int(amount))
         else:
-            return ProductsBackend.get_product_ranking(5)
+            return ProductsBackend.get_related_products(product_id, 10)
 
 
 def authorize_by_oauth(request):
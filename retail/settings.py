@@ -131,6 +131,14 @@ CACHEOPS = {
 
 CACHEOPS_DEGRADE_ON_FAILURE = True
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://{host}:{port}/{db}'.format(**CACHEOPS_REDIS),
+        'KEY_PREFIX': 'retail',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -195,6 +203,23 @@ CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'prune-related-products': {
+        'task': 'backend.tasks.prune_related_products',
+        'schedule': 60 * 60,
+    },
+    'flush-carts': {
+        'task': 'backend.tasks.flush_shopping_carts',
+        'schedule': int(os.getenv('CART_FLUSH_INTERVAL', 60 * 5)),
+    },
+    'relay-outbox': {
+        'task': 'backend.tasks.relay_outbox_messages',
+        'schedule': int(os.getenv('OUTBOX_RELAY_INTERVAL', 5)),
+    },
+}
+
+# Хранилище корзин покупателей: 'db' - заказы в состоянии PREPARING, 'redis' - хеши в Redis
+CART_BACKEND = os.getenv('CART_BACKEND', 'db')
 
 
 REST_FRAMEWORK = {
@@ -203,12 +228,14 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.UserRateThrottle',
-        'rest_framework.throttling.AnonRateThrottle',
+        'backend.throttling.UserSlidingWindowThrottle',
+        'backend.throttling.AnonSlidingWindowThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'user': '30/minute',
-        'anon': '10/minute'
+        'anon': '10/minute',
+        'products': '120/minute',
+        'buyer_orders_create': '5/minute',
     },
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 30,
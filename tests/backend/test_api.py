@@ -1,13 +1,25 @@
 import random
+import uuid
+from decimal import Decimal
 import pytest
 import mock
 from model_bakery import baker
 from django.urls.base import reverse
-from django.test.utils import override_settings
-from .fixtures import client, user_factory, obtain_users_token, obtain_users_credentials, \
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.core.management import call_command
+from django.core import mail
+from django.utils import timezone
+from .fixtures import client, user_factory, admin_user_factory, obtain_users_token, obtain_users_credentials, \
     make_shops_with_products_factory
-from backend.models import User, EmailTokenConfirm, UserTypeChoices, OrderStateChoices
+from backend.models import User, EmailTokenConfirm, UserTypeChoices, OrderStateChoices, OrderItem, Order, ProductItem, \
+    OutboxMessage, ShopOrder
 from rest_framework import status
+from backend.backend import ProductsBackend
+from backend.ranking import redis_db, get_top_product_ids, RANKING_KEY
+from backend.cart import flush_carts
+from backend.outbox import relay_outbox
+from backend.idempotency import IDEMPOTENCY_REPLAYED_HEADER
 
 
 @pytest.fixture(autouse=True)
@@ -25,6 +37,13 @@ def settings():
     return settings
 
 
+@pytest.fixture(autouse=True)
+def throttle_counters():
+    from cacheops.redis import redis_client
+    for key in redis_client.scan_iter('throttle_*'):
+        redis_client.delete(key)
+
+
 @pytest.mark.parametrize(
     ['email', 'username', 'password', 'first_name', 'last_name', 'expected'],
     (
@@ -249,5 +268,796 @@ def test_confirm_order(client, obtain_users_credentials, make_shops_with_product
 
     response = client.get(url)
     assert response.status_code == status.HTTP_200_OK
-    assert response.data[0]['id'] == order.id
-    assert response.data[0]['state'] == OrderStateChoices.CREATED
+    assert response.data['results'][0]['id'] == order.id
+    assert response.data['results'][0]['state'] == OrderStateChoices.CREATED
+
+
+@override_settings(CACHEOPS_ENABLED=True)
+@pytest.mark.django_db
+def test_stampede_cached_as():
+    from backend.cache import stampede_cached_as, bump_version
+    from backend.models import Shop
+    calls = []
+
+    @stampede_cached_as(Shop, timeout=60, extra=random.random())
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert compute() == 1
+    assert compute() == 1
+    bump_version(Shop._meta.db_table)
+    assert compute() == 2
+    assert len(calls) == 2
+
+
+@override_settings(CACHEOPS_ENABLED=True)
+@pytest.mark.django_db
+def test_reference_cache(client):
+    from backend.cache import reference_cache, invalidate_reference
+    from backend.models import Category
+    url = reverse('backend:product-categories')
+    baker.make('Category', _quantity=3)
+    reference_cache.invalidate()
+    stats = reference_cache.stats()
+    response = client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    response = client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert reference_cache.stats()['hits'] == stats['hits'] + 1
+    assert reference_cache.stats()['misses'] == stats['misses'] + 1
+    invalidate_reference(Category._meta.db_table)
+    assert reference_cache.stats()['size'] == 0
+
+
+@pytest.mark.django_db
+def test_product_items_cache_invalidation(make_shops_with_products_factory):
+    from backend.backend import get_serialized_product_items
+    product_item = make_shops_with_products_factory()[0]
+    get_serialized_product_items([product_item.id])
+    product, category = product_item.product, product_item.product.category
+    product.name, category.name = 'Renamed product', 'Renamed category'
+    product.save()
+    assert get_serialized_product_items([product_item.id])[product_item.id]['product']['name'] == 'Renamed product'
+    category.save()
+    assert get_serialized_product_items([product_item.id])[product_item.id]['product']['category'] == 'Renamed category'
+    category.delete()
+    assert get_serialized_product_items([product_item.id]) == {}
+
+
+@override_settings(CACHEOPS_ENABLED=True)
+@pytest.mark.django_db
+def test_reference_cache_invalidation_from_other_process(client):
+    from backend.cache import reference_cache, invalidate_reference, _handle_invalidation_message, REFERENCE_CHANNEL
+    from backend.models import Category
+    table = Category._meta.db_table
+    baker.make('Category', _quantity=3)
+    reference_cache.invalidate()
+    assert client.get(reverse('backend:product-categories')).status_code == status.HTTP_200_OK
+    assert reference_cache.stats()['size'] == 1
+
+    reference_cache.tables.discard(table)
+    with mock.patch('backend.cache.redis_client.publish') as publish_mock:
+        invalidate_reference(table)
+    publish_mock.assert_called_once_with(REFERENCE_CHANNEL, table)
+    reference_cache.tables.add(table)
+    client.get(reverse('backend:product-categories'))
+    _handle_invalidation_message({'data': table.encode()})
+    assert reference_cache.stats()['size'] == 0
+
+
+@pytest.mark.django_db
+def test_restock_invalidates_product_items_after_commit(user_factory, make_shops_with_products_factory,
+                                                        django_capture_on_commit_callbacks):
+    from backend.backend import get_serialized_product_items
+    from backend.cache import get_product_items
+    from backend.order import restock_orders
+    product_item = make_shops_with_products_factory()[0]
+    order = baker.make('Order', user=user_factory(_quantity=1), state=OrderStateChoices.CREATED)
+    baker.make('OrderItem', order=order, product_item=product_item, quantity=2)
+    get_serialized_product_items([product_item.id])
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        restock_orders([order.id])
+    assert product_item.id in get_product_items([product_item.id])
+    for callback in callbacks:
+        callback()
+    assert get_product_items([product_item.id]) == {}
+
+
+@pytest.mark.django_db
+def test_buyer_orders_throttling(client, obtain_users_credentials):
+    from backend.throttling import ScopedSlidingWindowThrottle
+    from cacheops.redis import redis_client
+    url = reverse('backend:orders')
+    users_info = obtain_users_credentials()
+    token = users_info['token'].get('access')
+    redis_client.delete(f"throttle_buyer_orders_create_{users_info['user_id']}")
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+    with mock.patch.object(ScopedSlidingWindowThrottle, 'THROTTLE_RATES', {'buyer_orders_create': '2/minute'}):
+        assert client.post(url, data={}).status_code == status.HTTP_400_BAD_REQUEST
+        assert client.post(url, data={}).status_code == status.HTTP_400_BAD_REQUEST
+        assert client.post(url, data={}).status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert client.get(url).status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+def test_get_product_items_sparse_fieldset(client, make_shops_with_products_factory, django_assert_max_num_queries):
+    url = reverse('backend:products')
+    make_shops_with_products_factory()
+    with django_assert_max_num_queries(3):
+        response = client.get(url, {'fields': 'id,price,quantity'})
+    assert response.status_code == status.HTTP_200_OK
+    assert set(response.json()['results'][0]) == {'id', 'price', 'quantity'}
+
+    response = client.get(url, {'expand': ''})
+    assert response.status_code == status.HTTP_200_OK
+    assert isinstance(response.json()['results'][0]['product'], int)
+    assert isinstance(response.json()['results'][0]['product_properties'], list)
+
+
+@pytest.mark.django_db
+def test_get_products_batch(client, make_shops_with_products_factory, django_assert_num_queries):
+    url = reverse('backend:products-batch')
+    product_items = make_shops_with_products_factory()
+    ids = [item.id for item in reversed(product_items)]
+    response = client.get(url, {'ids': ','.join(map(str, ids))})
+    assert response.status_code == status.HTTP_200_OK
+    assert [item['id'] for item in response.data] == ids
+    with django_assert_num_queries(0):
+        response = client.get(url, {'ids': ','.join(map(str, ids))})
+    assert len(response.data) == len(ids)
+
+    response = client.get(url, {'ids': 'abc'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_get_popular_products(client, user_factory, make_shops_with_products_factory, django_assert_num_queries):
+    redis_db.delete(*redis_db.keys(RANKING_KEY + '*'), RANKING_KEY)
+    url = reverse('backend:popular-products')
+    product_items = make_shops_with_products_factory()
+    first, second = product_items[0].product_id, product_items[1].product_id
+    category, other_category = baker.make('Category', _quantity=2)
+    shop, other_shop = [baker.make('Shop', user=seller) for seller in user_factory(_quantity=2)]
+    ProductsBackend.update_product_ranking([(first, category.id, shop.id, 1), (second, other_category.id, other_shop.id, 3)])
+    for period in ('24h', '7d', 'all'):
+        response = client.get(url, {'amount': 2, 'period': period})
+        assert response.status_code == status.HTTP_200_OK
+        assert [product['id'] for product in response.data] == [second, first]
+    with django_assert_num_queries(0):
+        response = client.get(url, {'amount': 2})
+    assert [product['id'] for product in response.data] == [second, first]
+    with mock.patch('backend.ranking.RANKING_TOP_CHANGES_THRESHOLD', 1):
+        ProductsBackend.update_product_ranking([(first, category.id, shop.id, 5)])
+        response = client.get(url, {'amount': 2})
+    assert [product['id'] for product in response.data] == [first, second]
+    response = client.get(url, {'period': '24h', 'category_id': category.id})
+    assert [product['id'] for product in response.data] == [first]
+    response = client.get(url, {'shop_id': other_shop.id})
+    assert [product['id'] for product in response.data] == [second]
+    response = client.get(url, {'shop_id': 1, 'category_id': 1})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.get(url, {'period': '1y'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_rebuild_ranking(user_factory, make_shops_with_products_factory):
+    redis_db.delete(*redis_db.keys(RANKING_KEY + '*'), RANKING_KEY)
+    product_items = make_shops_with_products_factory()
+    buyer = user_factory(_quantity=1)
+    order = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED)
+    baker.make('OrderItem', order=order, product_item=product_items[0], quantity=2)
+    baker.make('OrderItem', order=order, product_item=product_items[1], quantity=5)
+    cart = baker.make('Order', user=buyer, state=OrderStateChoices.PREPARING)
+    baker.make('OrderItem', order=cart, product_item=product_items[2], quantity=10)
+    redis_db.zadd(RANKING_KEY, {product_items[3].product_id: 100})
+
+    call_command('rebuild_ranking', batch_size=1)
+    expected = [product_items[1].product_id, product_items[0].product_id]
+    for period in ('24h', '7d', 'all'):
+        assert get_top_product_ids(5, period) == expected
+    assert get_top_product_ids(5, category_id=product_items[0].product.category_id) == expected
+    assert redis_db.ttl(RANKING_KEY) == -1
+    assert not redis_db.keys('rebuild:*')
+
+
+@pytest.mark.django_db
+def test_get_related_products(client, user_factory, make_shops_with_products_factory):
+    redis_db.delete(*redis_db.keys('product_related:*'), 'product_related:0')
+    product_items = make_shops_with_products_factory()
+    first, second, third = [item.product_id for item in product_items[:3]]
+    ProductsBackend.update_related_products([first, second, third])
+    ProductsBackend.update_related_products([first, third])
+    response = client.get(reverse('backend:related-products', args=[first]))
+    assert response.status_code == status.HTTP_200_OK
+    assert [product['id'] for product in response.data] == [third, second]
+
+    buyer = user_factory(_quantity=1)
+    for items in (product_items[:2], product_items[1:3], product_items[1:3]):
+        order = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED)
+        for item in items:
+            baker.make('OrderItem', order=order, product_item=item)
+    call_command('rebuild_related', batch_size=1)
+    response = client.get(reverse('backend:related-products', args=[second]), {'amount': 1})
+    assert [product['id'] for product in response.data] == [third]
+    response = client.get(reverse('backend:related-products', args=[first]))
+    assert [product['id'] for product in response.data] == [second]
+
+
+@pytest.mark.django_db
+def test_shopping_cart_bulk_add(client, obtain_users_credentials, make_shops_with_products_factory,
+                                django_assert_max_num_queries):
+    url = reverse('backend:shoppingcart')
+    product_items = make_shops_with_products_factory()
+    users_info = obtain_users_credentials()
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+
+    payload = [{'product_item': item.id, 'quantity': 1} for item in product_items]
+    with django_assert_max_num_queries(10):
+        response = client.post(url, payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+
+    payload = [{'product_item': product_items[0].id, 'quantity': 2}, {'product_item': product_items[0].id, 'quantity': 3}]
+    response = client.post(url, payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    ordered_items = OrderItem.objects.filter(order__user_id=users_info['user_id'])
+    assert ordered_items.count() == len(product_items)
+    assert ordered_items.get(product_item=product_items[0]).quantity == 6
+
+    response = client.post(url, [{'product_item': product_items[1].id, 'quantity': 4}], format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert ordered_items.get(product_item=product_items[1]).quantity == 5
+
+    response = client.post(url, [{'product_item': 0, 'quantity': 1}], format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_bulk_operations_query_count(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_items = make_shops_with_products_factory()
+    cart = baker.make('Order', user_id=user_id, state=OrderStateChoices.PREPARING)
+    ordered_items = [baker.make('OrderItem', order=cart, product_item=item, quantity=1) for item in product_items]
+    contacts = baker.make('Contact', user_id=user_id, _quantity=len(product_items))
+    query_counts = []
+    for size in (2, len(product_items) // 2):
+        batch, ordered_items = ordered_items[:size], ordered_items[size:]
+        contacts_batch, contacts = contacts[:size], contacts[size:]
+        with CaptureQueriesContext(connection) as update_queries:
+            response = client.put(reverse('backend:shoppingcart'), [{'id': item.id, 'quantity': 3} for item in batch],
+                                  format='json')
+        assert response.status_code == status.HTTP_200_OK
+        assert all(item.quantity == 3 for item in OrderItem.objects.filter(id__in=[item.id for item in batch]))
+        with CaptureQueriesContext(connection) as delete_queries:
+            response = client.delete(reverse('backend:shoppingcart'), {'items': [item.id for item in batch]},
+                                     format='json')
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        with CaptureQueriesContext(connection) as contact_queries:
+            response = client.delete(reverse('backend:user-contact'), {'items': [item.id for item in contacts_batch]},
+                                     format='json')
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        query_counts.append((len(update_queries), len(delete_queries), len(contact_queries)))
+    assert query_counts[0] == query_counts[1]
+    assert OrderItem.objects.filter(order=cart).count() == len(ordered_items)
+
+
+@override_settings(CART_BACKEND='redis', CELERY_TASK_ALWAYS_EAGER=True)
+@pytest.mark.django_db
+def test_redis_shopping_cart(client, obtain_users_credentials, make_shops_with_products_factory):
+    url = reverse('backend:shoppingcart')
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    redis_db.delete(f'cart:{user_id}')
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_items = make_shops_with_products_factory()[:3]
+    contact = baker.make('Contact', user_id=user_id)
+
+    response = client.post(url, [{'product_item': item.id, 'quantity': 1} for item in product_items], format='json')
+    assert response.status_code == status.HTTP_200_OK
+    response = client.post(url, [{'product_item': product_items[1].id, 'quantity': 2}], format='json')
+    assert response.status_code == status.HTTP_200_OK
+    response = client.put(url, [{'id': product_items[0].id, 'quantity': 2}], format='json')
+    assert response.status_code == status.HTTP_200_OK
+    response = client.delete(url, {'items': [product_items[2].id]}, format='json')
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = client.get(url)
+    assert {item['id']: item['quantity'] for item in response.data[0]['ordered_items']} == \
+           {product_items[0].id: 2, product_items[1].id: 3}
+    assert not OrderItem.objects.filter(order__user_id=user_id).exists()
+
+    flush_carts()
+    assert OrderItem.objects.filter(order__user_id=user_id, order__state=OrderStateChoices.PREPARING).count() == 2
+
+    response = client.post(reverse('backend:orders'), {'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert OrderItem.objects.get(order__user_id=user_id, product_item=product_items[0]).order.state == \
+           OrderStateChoices.CREATED
+    assert client.get(url).data == []
+
+
+@override_settings(CART_BACKEND='redis', CELERY_TASK_ALWAYS_EAGER=True)
+@pytest.mark.django_db
+def test_redis_cart_keeps_items_added_during_confirmation(client, obtain_users_credentials,
+                                                          make_shops_with_products_factory):
+    from backend.cart import add_cart_items, get_cart_items, materialize_cart, CART_DIRTY_KEY
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    redis_db.delete(f'cart:{user_id}')
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    first, second = make_shops_with_products_factory()[:2]
+    contact = baker.make('Contact', user_id=user_id)
+    add_cart_items(user_id, {first.id: 1})
+
+    def materialize(cart_user_id, dirty=None):
+        cart = materialize_cart(cart_user_id, dirty)
+        add_cart_items(cart_user_id, {first.id: 2, second.id: 1})
+        return cart
+
+    with mock.patch('backend.backend.materialize_cart', side_effect=materialize):
+        response = client.post(reverse('backend:orders'), {'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert OrderItem.objects.get(order__user_id=user_id, order__state=OrderStateChoices.CREATED).quantity == 1
+    assert get_cart_items(user_id) == {first.id: 2, second.id: 1}
+    assert str(user_id).encode() in redis_db.smembers(CART_DIRTY_KEY)
+
+
+@pytest.mark.django_db
+def test_flush_carts_keeps_failed_carts_dirty(user_factory, make_shops_with_products_factory):
+    from backend.cart import add_cart_items, materialize_cart, CART_DIRTY_KEY
+    product_item = make_shops_with_products_factory()[0]
+    failing, saved = user_factory(_quantity=2)
+    redis_db.delete(CART_DIRTY_KEY)
+    for user in (failing, saved):
+        redis_db.delete(f'cart:{user.id}')
+        add_cart_items(user.id, {product_item.id: 1})
+
+    def materialize(user_id, dirty=None):
+        if user_id == failing.id:
+            raise ValueError('Cart cannot be saved')
+        return materialize_cart(user_id, dirty)
+
+    with mock.patch('backend.cart.materialize_cart', side_effect=materialize):
+        assert flush_carts() == 1
+    assert redis_db.smembers(CART_DIRTY_KEY) == {str(failing.id).encode()}
+    assert OrderItem.objects.filter(order__user=saved, order__state=OrderStateChoices.PREPARING).exists()
+    assert not OrderItem.objects.filter(order__user=failing).exists()
+    assert flush_carts() == 1
+    assert OrderItem.objects.filter(order__user=failing, order__state=OrderStateChoices.PREPARING).exists()
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+@pytest.mark.django_db
+def test_confirm_order_stock_reservation(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    first, second = make_shops_with_products_factory()[:2]
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=first, quantity=first.quantity)
+    baker.make('OrderItem', order=order, product_item=second, quantity=second.quantity + 1)
+
+    response = client.post(reverse('backend:orders'), {'id': order.id, 'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()['items'] == [{'id': OrderItem.objects.get(order=order, product_item=second).id,
+                                         'product_item': second.id, 'quantity': second.quantity + 1,
+                                         'available': second.quantity, 'error': 'insufficient_quantity'}]
+
+    with mock.patch('backend.models.Order.get_invalid_items', return_value=[]):
+        response = client.post(reverse('backend:orders'), {'id': order.id, 'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_409_CONFLICT
+    order.refresh_from_db()
+    first.refresh_from_db()
+    assert order.state == OrderStateChoices.PREPARING
+    assert first.quantity == 10
+
+    OrderItem.objects.filter(order=order, product_item=second).update(quantity=second.quantity)
+    response = client.post(reverse('backend:orders'), {'id': order.id, 'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert first.quantity == second.quantity == 0
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+@pytest.mark.django_db
+def test_confirm_order_outbox(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_item = make_shops_with_products_factory()[0]
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=product_item, quantity=1)
+
+    with mock.patch('backend.tasks.create_order_report', return_value=None) as report_mock:
+        response = client.post(reverse('backend:orders'), {'id': order.id, 'contact': contact.id}, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        message = OutboxMessage.objects.get()
+        assert message.dedup_key == f"order:{order.id}:CREATED" and message.sent_at is None
+        assert not report_mock.called and not mail.outbox
+
+        with mock.patch('backend.outbox.chain', side_effect=ConnectionError('Broker is unavailable')):
+            assert relay_outbox() == 0
+        message.refresh_from_db()
+        assert message.attempts == 1 and message.sent_at is None and message.available_at > timezone.now()
+        assert relay_outbox() == 0
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        assert relay_outbox() == 1
+        assert relay_outbox() == 0
+    report_mock.assert_called_once()
+    assert report_mock.call_args.args[0].id == order.id
+    assert len(mail.outbox) == 1
+    assert mail.outbox[0].to == [User.objects.get(id=user_id).email]
+    message.refresh_from_db()
+    assert message.sent_at is not None
+
+
+@pytest.mark.django_db
+def test_confirm_order_idempotency_key(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_item = make_shops_with_products_factory()[0]
+    quantity = product_item.quantity
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=product_item, quantity=1)
+    url, payload = reverse('backend:orders'), {'id': order.id, 'contact': contact.id}
+    first_key, second_key, third_key = (str(uuid.uuid4()) for _ in range(3))
+
+    response = client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY=first_key)
+    assert response.status_code == status.HTTP_200_OK
+    assert IDEMPOTENCY_REPLAYED_HEADER not in response
+    with CaptureQueriesContext(connection) as queries:
+        replayed = client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY=first_key)
+    assert replayed.status_code == status.HTTP_200_OK
+    assert replayed[IDEMPOTENCY_REPLAYED_HEADER] == 'true'
+    assert replayed.content == response.content
+    assert not [query for query in queries.captured_queries if 'backend_order' in query['sql']]
+    product_item.refresh_from_db()
+    assert product_item.quantity == quantity - 1
+    assert OutboxMessage.objects.count() == 1
+
+    response = client.post(url, {**payload, 'coupon_code': 'SALE'}, format='json', HTTP_IDEMPOTENCY_KEY=first_key)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    with mock.patch('backend.idempotency._acquire_script', return_value=[2, None]):
+        response = client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY=second_key)
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+    response = client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY=third_key)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert IDEMPOTENCY_REPLAYED_HEADER not in response
+
+
+@pytest.mark.django_db
+def test_orders_total_price_query_count(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_items = make_shops_with_products_factory()
+    ProductItem.objects.filter(id__in=[item.id for item in product_items]).update(price=Decimal('10.55'))
+    coupon = baker.make('Coupon', discount=15)
+    query_counts = []
+    for amount in (2, 6):
+        for index in range(amount):
+            order = baker.make('Order', user_id=user_id, state=OrderStateChoices.CREATED,
+                               coupon=coupon if index % 2 else None)
+            for item in product_items[:3]:
+                baker.make('OrderItem', order=order, product_item=item, quantity=index + 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('backend:orders'))
+        assert response.status_code == status.HTTP_200_OK
+        query_counts.append(len(queries))
+        for order_data in response.data['results']:
+            assert Decimal(order_data['total_price']) == Order.objects.get(id=order_data['id']).total_price
+    assert query_counts[0] == query_counts[1]
+    assert str(Order.objects.with_total_price().query) == str(Order.objects.with_total_price().query)
+
+
+@pytest.mark.django_db
+def test_confirm_order_price_snapshot(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    first, second = make_shops_with_products_factory()[:2]
+    ProductItem.objects.filter(id__in=[first.id, second.id]).update(price=Decimal('10.55'))
+    baker.make('Coupon', code='SNAPSHOT15', discount=15)
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=first, quantity=1)
+    baker.make('OrderItem', order=order, product_item=second, quantity=2)
+
+    response = client.post(reverse('backend:orders'),
+                           {'id': order.id, 'contact': contact.id, 'coupon_code': 'SNAPSHOT15'}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    order.refresh_from_db()
+    assert (order.subtotal, order.discount, order.total) == (Decimal('31.65'), Decimal('4.75'), Decimal('26.90'))
+    assert set(order.ordered_items.values_list('price', flat=True)) == {Decimal('10.55')}
+    assert list(order.shop_orders.values_list('shop_id', 'subtotal', 'total')) == \
+        [(first.shop_id, Decimal('31.65'), Decimal('26.90'))]
+
+    ProductItem.objects.filter(id__in=[first.id, second.id]).update(price=Decimal('99.00'))
+    response = client.get(reverse('backend:orders'))
+    assert response.status_code == status.HTTP_200_OK
+    order_data = next(item for item in response.data['results'] if item['id'] == order.id)
+    assert Decimal(order_data['total_price']) == Decimal('26.90')
+    assert {item['price'] for item in order_data['ordered_items']} == {'10.55'}
+
+
+@pytest.mark.django_db
+def test_confirm_order_shop_totals_match_order_total(client, obtain_users_credentials, user_factory,
+                                                     make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    first = make_shops_with_products_factory()[0]
+    shop = baker.make('Shop', user=user_factory(type=UserTypeChoices.SELLER, _quantity=1), is_active=True)
+    second = baker.make('ProductItem', shop=shop, product=first.product, quantity=10)
+    ProductItem.objects.filter(id__in=[first.id, second.id]).update(price=Decimal('0.10'))
+    baker.make('Coupon', code='ROUNDING15', discount=15)
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=first, quantity=1)
+    baker.make('OrderItem', order=order, product_item=second, quantity=1)
+
+    response = client.post(reverse('backend:orders'),
+                           {'id': order.id, 'contact': contact.id, 'coupon_code': 'ROUNDING15'}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    order.refresh_from_db()
+    assert (order.subtotal, order.total) == (Decimal('0.20'), Decimal('0.17'))
+    assert sorted(order.shop_orders.values_list('total', flat=True)) == [Decimal('0.08'), Decimal('0.09')]
+
+
+@pytest.mark.django_db
+def test_orders_history_snapshots(client, obtain_users_credentials, make_shops_with_products_factory):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    product_item = make_shops_with_products_factory()[0]
+    contact = baker.make('Contact', user_id=user_id)
+    order = baker.make('Order', user_id=user_id)
+    baker.make('OrderItem', order=order, product_item=product_item, quantity=1)
+    response = client.post(reverse('backend:orders'), {'id': order.id, 'contact': contact.id}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    order.refresh_from_db()
+    assert order.snapshot['state'] == OrderStateChoices.CREATED
+
+    old_name = product_item.product.name
+    product_item.product.name = 'renamed'
+    product_item.product.save()
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('backend:orders'))
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['results'] == [order.snapshot]
+    assert response.json()['results'][0]['ordered_items'][0]['product_item']['product']['name'] == old_name
+    assert len([query for query in queries if 'backend_order' in query['sql']]) == 1
+
+    response = client.get(reverse('backend:orders'), {'fields': 'id,state,ordered_items.quantity'})
+    assert response.json()['results'] == [{'id': order.id, 'state': OrderStateChoices.CREATED,
+                                           'ordered_items': [{'quantity': 1}]}]
+
+    legacy = baker.make('Order', user_id=user_id, state=OrderStateChoices.SENT)
+    baker.make('OrderItem', order=legacy, product_item=product_item, quantity=2)
+    response = client.get(reverse('backend:orders'))
+    legacy.refresh_from_db()
+    assert legacy.snapshot is not None
+    assert next(item for item in response.json()['results'] if item['id'] == legacy.id) == legacy.snapshot
+    with CaptureQueriesContext(connection) as queries:
+        assert client.get(reverse('backend:orders')).json() == response.json()
+    assert len([query for query in queries if 'backend_order' in query['sql']]) == 1
+
+
+@pytest.mark.django_db
+def test_orders_history_pagination(client, obtain_users_credentials):
+    users_info = obtain_users_credentials()
+    user_id = users_info['user_id']
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    orders = baker.make('Order', user_id=user_id, state=OrderStateChoices.CREATED, _quantity=5)
+    baker.make('Order', user_id=user_id, state=OrderStateChoices.CANCELED, _quantity=2)
+    baker.make('Order', user_id=user_id)
+    Order.objects.filter(id=orders[0].id).update(created_at=orders[1].created_at)
+    expected = list(Order.objects.filter(user_id=user_id, state=OrderStateChoices.CREATED)
+                    .order_by('-created_at', '-id').values_list('id', flat=True))
+
+    received = []
+    url, params = reverse('backend:orders'), {'state': OrderStateChoices.CREATED, 'page_size': 2}
+    while url:
+        response = client.get(url, params)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data['results']) <= 2
+        received.extend(order['id'] for order in response.data['results'])
+        url, params = response.data['next'], None
+    assert received == expected
+
+    response = client.get(reverse('backend:orders'))
+    assert len(response.data['results']) == 7
+    response = client.get(reverse('backend:orders'), {'created_after': '2000-01-01T00:00:00Z',
+                                                      'created_before': '2000-01-02T00:00:00Z'})
+    assert response.data == {'next': None, 'results': []}
+    response = client.get(reverse('backend:orders'), {'cursor': 'invalid'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_seller_orders_only_own_items(client, obtain_users_credentials, user_factory):
+    users_info = obtain_users_credentials(user_type=UserTypeChoices.SELLER)
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    shop = baker.make('Shop', user_id=users_info['user_id'])
+    other_shop = baker.make('Shop', user=user_factory(_quantity=1))
+    own_item, other_item = baker.make('ProductItem', shop=shop), baker.make('ProductItem', shop=other_shop)
+    buyer = user_factory(_quantity=1)
+    order = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED)
+    own_line = baker.make('OrderItem', order=order, product_item=own_item)
+    baker.make('OrderItem', order=order, product_item=other_item)
+    shop_order = baker.make('ShopOrder', order=order, shop=shop, created_at=order.created_at)
+    baker.make('ShopOrder', order=order, shop=other_shop, created_at=order.created_at)
+    other_order = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED)
+    baker.make('OrderItem', order=other_order, product_item=other_item)
+    baker.make('ShopOrder', order=other_order, shop=other_shop)
+
+    for params in ({}, {'expand': 'ordered_items,contact,shop_order'}):
+        response = client.get(reverse('backend:seller-orders'), params)
+        assert response.status_code == status.HTTP_200_OK
+        assert [order_data['id'] for order_data in response.data['results']] == [order.id]
+        assert [item['id'] for item in response.data['results'][0]['ordered_items']] == [own_line.id]
+        assert response.data['results'][0]['shop_order']['id'] == shop_order.id
+
+    response = client.put(reverse('backend:seller-orders'), {'id': other_order.id, 'state': 'ASSEMBLED'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = client.put(reverse('backend:seller-orders'), {'id': order.id, 'state': 'CANCELED'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.put(reverse('backend:seller-orders'), {'id': order.id, 'state': 'ASSEMBLED'})
+    assert response.status_code == status.HTTP_409_CONFLICT
+    response = client.put(reverse('backend:seller-orders'), {'id': order.id, 'state': 'CONFIRMED'})
+    assert response.status_code == status.HTTP_200_OK
+    shop_order.refresh_from_db()
+    order.refresh_from_db()
+    assert shop_order.state == OrderStateChoices.CONFIRMED
+    assert order.state == OrderStateChoices.CREATED
+    response = client.get(reverse('backend:seller-orders'), {'state': 'CONFIRMED'})
+    assert [order_data['id'] for order_data in response.data['results']] == [order.id]
+
+
+@pytest.mark.django_db
+def test_seller_change_order_state_syncs_order(client, obtain_users_credentials, user_factory):
+    users_info = obtain_users_credentials(user_type=UserTypeChoices.SELLER)
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    shop = baker.make('Shop', user_id=users_info['user_id'])
+    other_shop = baker.make('Shop', user=user_factory(_quantity=1))
+    order = baker.make('Order', user=user_factory(_quantity=1), state=OrderStateChoices.CREATED,
+                       snapshot={'state': 'CREATED'})
+    shop_order = baker.make('ShopOrder', order=order, shop=shop, state=OrderStateChoices.CREATED)
+    baker.make('ShopOrder', order=order, shop=other_shop, state=OrderStateChoices.ASSEMBLED)
+    url = reverse('backend:seller-orders')
+
+    for state in ('CONFIRMED', 'ASSEMBLED'):
+        assert client.put(url, {'id': order.id, 'state': state}).status_code == status.HTTP_200_OK
+        order.refresh_from_db()
+        assert order.state == order.snapshot['state'] == state
+
+    canceled = baker.make('Order', user=order.user, state=OrderStateChoices.CANCELED)
+    canceled_shop_order = baker.make('ShopOrder', order=canceled, shop=shop, state=OrderStateChoices.CREATED)
+    response = client.put(url, {'id': canceled.id, 'state': 'CONFIRMED'})
+    assert response.status_code == status.HTTP_409_CONFLICT
+    canceled.refresh_from_db()
+    canceled_shop_order.refresh_from_db()
+    shop_order.refresh_from_db()
+    assert canceled.state == OrderStateChoices.CANCELED
+    assert canceled_shop_order.state == OrderStateChoices.CREATED
+    assert shop_order.state == OrderStateChoices.ASSEMBLED
+
+
+@override_settings(CACHEOPS_ENABLED=True)
+@pytest.mark.django_db(transaction=True)
+def test_seller_change_order_state_invalidates_cache(client, obtain_users_credentials, user_factory):
+    from backend.cache import bump_version
+    users_info = obtain_users_credentials(user_type=UserTypeChoices.SELLER)
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + users_info['token'].get('access'))
+    shop = baker.make('Shop', user_id=users_info['user_id'])
+    other_shop = baker.make('Shop', user=user_factory(_quantity=1))
+    order = baker.make('Order', user=user_factory(_quantity=1), state=OrderStateChoices.CREATED)
+    baker.make('OrderItem', order=order, product_item=baker.make('ProductItem', shop=shop))
+    baker.make('ShopOrder', order=order, shop=shop, created_at=order.created_at)
+    baker.make('ShopOrder', order=order, shop=other_shop, created_at=order.created_at)
+    for model in (Order, ShopOrder):
+        bump_version(model._meta.db_table)
+
+    url = reverse('backend:seller-orders')
+    assert client.get(url).data['results'][0]['shop_order']['state'] == OrderStateChoices.CREATED
+    assert client.put(url, {'id': order.id, 'state': 'CONFIRMED'}).status_code == status.HTTP_200_OK
+    assert client.get(url).data['results'][0]['shop_order']['state'] == OrderStateChoices.CONFIRMED
+
+
+@pytest.mark.django_db
+def test_manager_bulk_change_orders_state(client, admin_user_factory, user_factory, make_shops_with_products_factory):
+    client.force_authenticate(user=admin_user_factory(_quantity=1))
+    product_item = make_shops_with_products_factory()[0]
+    buyer = user_factory(_quantity=1)
+    canceled = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED, snapshot={'state': 'CREATED'})
+    baker.make('OrderItem', order=canceled, product_item=product_item, quantity=3)
+    shop_order = baker.make('ShopOrder', order=canceled, shop=product_item.shop)
+    assembled = baker.make('Order', user=buyer, state=OrderStateChoices.CONFIRMED)
+    delivered = baker.make('Order', user=buyer, state=OrderStateChoices.DELIVERED)
+    baker.make('OrderItem', order=delivered, product_item=product_item, quantity=5)
+    missing_id = delivered.id + 1000
+
+    payload = [{'id': canceled.id, 'state': 'CANCELED'}, {'id': assembled.id, 'state': 'ASSEMBLED'},
+               {'id': delivered.id, 'state': 'CANCELED'}, {'id': missing_id, 'state': 'SENT'}]
+    response = client.put(reverse('backend:manager-orders'), payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert sorted(response.json()['updated']) == sorted([canceled.id, assembled.id])
+    assert sorted(error['id'] for error in response.json()['errors']) == sorted([delivered.id, missing_id])
+    [(task_name, (orders, _))] = OutboxMessage.objects.get().tasks
+    assert task_name == 'backend.tasks.send_order_state_emails'
+    assert sorted(orders) == sorted([[buyer.id, canceled.id, 'CANCELED'], [buyer.id, assembled.id, 'ASSEMBLED']])
+
+    canceled.refresh_from_db()
+    shop_order.refresh_from_db()
+    product_item.refresh_from_db()
+    delivered.refresh_from_db()
+    assert canceled.state == shop_order.state == canceled.snapshot['state'] == OrderStateChoices.CANCELED
+    assert delivered.state == OrderStateChoices.DELIVERED
+    assert product_item.quantity == 13
+
+    response = client.put(reverse('backend:manager-orders'), {'id': canceled.id, 'state': 'CONFIRMED'}, format='json')
+    assert response.status_code == status.HTTP_409_CONFLICT
+    response = client.put(reverse('backend:manager-orders'), {'id': missing_id, 'state': 'CONFIRMED'}, format='json')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_manager_change_order_state_checks_shop_orders(client, admin_user_factory, user_factory,
+                                                       make_shops_with_products_factory):
+    client.force_authenticate(user=admin_user_factory(_quantity=1))
+    product_item = make_shops_with_products_factory()[0]
+    other_shop = baker.make('Shop', user=user_factory(type=UserTypeChoices.SELLER, _quantity=1), is_active=True)
+    other_item = baker.make('ProductItem', shop=other_shop, product=product_item.product, quantity=10)
+    order = baker.make('Order', user=user_factory(_quantity=1), state=OrderStateChoices.CREATED)
+    baker.make('OrderItem', order=order, product_item=product_item, quantity=2)
+    baker.make('OrderItem', order=order, product_item=other_item, quantity=3)
+    shop_order = baker.make('ShopOrder', order=order, shop=product_item.shop, state=OrderStateChoices.CREATED)
+    other_shop_order = baker.make('ShopOrder', order=order, shop=other_shop, state=OrderStateChoices.SENT)
+    url = reverse('backend:manager-orders')
+
+    response = client.put(url, {'id': order.id, 'state': 'CANCELED'}, format='json')
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()['errors'][0]['error'] == 'Invalid shop order state transition SENT -> CANCELED'
+    assert ProductItem.objects.get(id=other_item.id).quantity == 10
+
+    ShopOrder.objects.filter(id=other_shop_order.id).update(state=OrderStateChoices.CONFIRMED)
+    response = client.put(url, {'id': order.id, 'state': 'CONFIRMED'}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    response = client.put(url, {'id': order.id, 'state': 'CANCELED'}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert set(ShopOrder.objects.filter(order=order).values_list('state', flat=True)) == {OrderStateChoices.CANCELED}
+    assert ProductItem.objects.get(id=product_item.id).quantity == 12
+    assert ProductItem.objects.get(id=other_item.id).quantity == 13
+
+
+@override_settings(CACHEOPS_ENABLED=True)
+@pytest.mark.django_db(transaction=True)
+def test_manager_change_orders_state_invalidates_cache(client, admin_user_factory, user_factory):
+    from backend.cache import bump_version
+    admin, buyer = admin_user_factory(_quantity=1), user_factory(_quantity=1)
+    order = baker.make('Order', user=buyer, state=OrderStateChoices.CREATED)
+    baker.make('ShopOrder', order=order, shop=baker.make('Shop', user=user_factory(_quantity=1)))
+    for model in (Order, ShopOrder):
+        bump_version(model._meta.db_table)
+
+    def get_state(user, url):
+        client.force_authenticate(user=user)
+        return next(item['state'] for item in client.get(url).data['results'] if item['id'] == order.id)
+
+    assert get_state(buyer, reverse('backend:orders')) == OrderStateChoices.CREATED
+    assert get_state(admin, reverse('backend:manager-orders')) == OrderStateChoices.CREATED
+    response = client.put(reverse('backend:manager-orders'), {'id': order.id, 'state': 'CONFIRMED'}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert get_state(buyer, reverse('backend:orders')) == OrderStateChoices.CONFIRMED
+    assert get_state(admin, reverse('backend:manager-orders')) == OrderStateChoices.CONFIRMED